@@ -0,0 +1,342 @@
+"""
+ DSKM DNSsec Key Management
+
+ Copyright (c) 2012 Axel Rau, axel.rau@chaos1.de
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -----------------------------------------
+REG/fake.py - local stand-in servers for the Joker.com DMAPI and the RIPE REST API
+
+FakeJoker speaks the DMAPI line protocol (login, domain-modify,
+result-retrieve, result-list, result-delete), FakeRipe the whois XML
+search and PUT of domain objects. Both listen on 127.0.0.1 with TLS
+(see selfSignedCert), keep connections alive and inject latency and
+errors as told by Faults. Used by REG/loadtest.py.
+"""
+
+# -----------------------------------------
+import http.server
+import os
+import random
+import socketserver
+import ssl
+import subprocess
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as etree
+
+# -----------------------------------------
+
+#--------------------------
+#   functions
+#--------------------------
+
+def selfSignedCert(directory):          # (cert file, key file) for 127.0.0.1, valid for 1 day
+    cert_file = os.path.join(directory, 'fake_cert.pem')
+    key_file = os.path.join(directory, 'fake_key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-keyout', key_file, '-out', cert_file, '-subj', '/CN=127.0.0.1',
+                    '-addext', 'subjectAltName=IP:127.0.0.1,DNS:localhost'],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    return (cert_file, key_file)
+
+def whoisResources(domains, messages=()):   # whois-resources document of domain objects and error messages
+    root = etree.Element('whois-resources')
+    if domains:
+        ose = etree.SubElement(root, 'objects')
+        for domain_atts in domains:
+            oe = etree.SubElement(ose, 'object')
+            oe.set('type', 'domain')
+            se = etree.SubElement(oe, 'source')
+            se.set('id', 'ripe')
+            ase = etree.SubElement(oe, 'attributes')
+            for (name, value) in domain_atts:
+                a = etree.SubElement(ase, 'attribute')
+                a.set('name', name)
+                a.set('value', value)
+    if messages:
+        ems = etree.SubElement(root, 'errormessages')
+        for (severity, text) in messages:
+            em = etree.SubElement(ems, 'errormessage')
+            em.set('severity', severity)
+            em.set('text', text)
+    return etree.tostring(root, encoding='unicode')
+
+#--------------------------
+#   classes
+#--------------------------
+
+class Faults(object):
+    """Latency and error injection of a fake server"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, drop_rate=0.0, seed=None):
+        self.latency = latency          # seconds before each response ...
+        self.jitter = jitter            # ... plus up to this (uniformly distributed)
+        self.error_rate = error_rate    # fraction of requests answered with an error
+        self.drop_rate = drop_rate      # fraction of connections closed without response
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def chance(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def delay(self):
+        with self.lock:
+            seconds = self.latency + self.random.uniform(0, self.jitter)
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class FakeServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTP(S) server on 127.0.0.1, one thread per connection, served in background"""
+
+    daemon_threads = True
+    handler = None                      # set by subclass
+
+    def __init__(self, port=0, cert=None, faults=None):
+        http.server.HTTPServer.__init__(self, ('127.0.0.1', port), self.handler)
+        if cert:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert[0], cert[1])
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.faults = faults or Faults()
+        self.counts = {}                # request name -> number of requests
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def address(self):                  # 'host:port' as in conf.registrar[...]['server']
+        return '%s:%d' % self.server_address
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+    """Keep-alive request handler with latency and error injection"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True      # headers and body are written separately
+
+    def log_message(self, format, *args):   # quiet
+        pass
+
+    def reply(self, status, body, content_type='text/plain'):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def dropped(self):                  # delay response; True if connection is to be dropped
+        self.server.faults.delay()
+        if self.server.faults.chance(self.server.faults.drop_rate):
+            self.close_connection = True
+            return True
+        return False
+
+
+class JokerHandler(FakeHandler):
+    """DMAPI: GET /request/<command>?<parameters>, answered by header lines, empty line, result lines"""
+
+    def do_GET(self):
+        u = urllib.parse.urlsplit(self.path)
+        command = u.path.rpartition('/')[2]
+        params = dict(urllib.parse.parse_qsl(u.query))
+        self.server.count(command)
+        if self.dropped():
+            return
+        (status, headers, lines) = self.server.dispatch(command, params)
+        body = ''.join('%s: %s\n' % (k, v) for (k, v) in headers) + '\n' + ''.join(line + '\n' for line in lines)
+        self.reply(status, body)
+
+
+class FakeJoker(FakeServer):
+    """Stand-in for the Joker.com DMAPI server"""
+
+    handler = JokerHandler
+
+    def __init__(self, port=0, cert=None, faults=None, completion_delay=0.0, nack_rate=0.0,
+                        session_lifetime=3600, account=('fake', 'fake')):
+        FakeServer.__init__(self, port, cert, faults)
+        self.completion_delay = completion_delay    # seconds until a request is completed ...
+        self.nack_rate = nack_rate      # ... and fraction of requests completed with nack
+        self.session_lifetime = session_lifetime
+        self.account = account          # (username, password)
+        self.sessions = {}              # Auth-Sid -> expiry time
+        self.results = {}               # Tracking-Id -> request
+        self.next_id = 1
+
+    def dispatch(self, command, params):    # (HTTP status, [(header, value)], [result line])
+        if command == 'login':
+            if (params.get('username'), params.get('password')) != self.account:
+                return (200, [('Status-Code', '2200'), ('Status-Text', 'Authentication error')], [])
+            sid = '%032x' % (random.getrandbits(128),)
+            with self.lock:
+                self.sessions[sid] = time.time() + self.session_lifetime
+            return (200, [('Auth-Sid', sid), ('UID', '1'), ('Status-Code', '0'),
+                            ('Status-Text', 'Command completed successfully')], [])
+        with self.lock:
+            valid = self.sessions.get(params.get('auth-sid'), 0) > time.time()
+        if not valid:
+            return (200, [('Status-Code', '2200'), ('Status-Text', 'Authentication error')], [])
+        if self.faults.chance(self.faults.error_rate):
+            return (200, [('Status-Code', '2400'), ('Status-Text', 'Command failed (injected)')], [])
+        if command == 'domain-modify':
+            return self.domainModify(params)
+        elif command == 'result-retrieve':
+            return self.resultRetrieve(params)
+        elif command == 'result-list':
+            return self.resultList(params)
+        elif command == 'result-delete':
+            return self.resultDelete(params)
+        return (200, [('Status-Code', '2000'), ('Status-Text', 'Unknown request')], [])
+
+    def state(self, request):           # 'ack', 'nack' or '?' (not yet completed)
+        if time.time() < request['completes']:
+            return '?'
+        return request['result']
+
+    def domainModify(self, params):
+        if 'domain' not in params or params.get('dnssec') not in ('0', '1'):
+            return (200, [('Status-Code', '2003'), ('Status-Text', 'Missing parameter')], [])
+        for k in params:
+            if k.startswith('ds-') and len(params[k].split(':')) != 4:
+                return (200, [('Status-Code', '2005'), ('Status-Text', 'Syntax error in ' + k)], [])
+        now = time.time()
+        with self.lock:
+            tid = 'FAKE-%08d' % (self.next_id,)
+            proc_id = '%d' % (100000 + self.next_id,)
+            self.next_id += 1
+            self.results[tid] = {'timestamp': time.strftime('%Y%m%d%H%M%S', time.gmtime(now)),
+                                 'proc_id': proc_id, 'task': 'domain-modify', 'domain': params['domain'],
+                                 'completes': now + self.completion_delay,
+                                 'result': 'nack' if self.faults.chance(self.nack_rate) else 'ack'}
+        return (200, [('Tracking-Id', tid), ('Proc-ID', proc_id), ('Status-Code', '0'),
+                        ('Status-Text', 'Command completed successfully')], [])
+
+    def resultRetrieve(self, params):
+        with self.lock:
+            request = self.results.get(params.get('SvTrID'))
+        if not request:
+            return (200, [('Status-Code', '2303'), ('Status-Text', 'Object does not exist')], [])
+        return (200, [('Tracking-Id', params['SvTrID']), ('Proc-ID', request['proc_id']),
+                        ('Domain', request['domain']), ('Completion-Status', self.state(request)),
+                        ('Status-Code', '0'), ('Status-Text', 'Command completed successfully')], [])
+
+    def resultList(self, params):
+        with self.lock:
+            requests = list(self.results.items())
+        lines = ['%s %s %s %s %s %s' % (request['timestamp'], tid, request['proc_id'], request['task'],
+                                        request['domain'], self.state(request)) for (tid, request) in requests]
+        return (200, [('Status-Code', '0'), ('Status-Text', 'Command completed successfully')], lines)
+
+    def resultDelete(self, params):
+        with self.lock:
+            request = self.results.pop(params.get('SvTrID'), None)
+        if not request:
+            return (200, [('Status-Code', '2303'), ('Status-Text', 'Object does not exist')], [])
+        return (200, [('Status-Code', '0'), ('Status-Text', 'Command completed successfully')], [])
+
+
+class RipeHandler(FakeHandler):
+    """RIPE REST API: GET /search?..., PUT /ripe/domain/<name>?password=...[&dry-run]"""
+
+    def do_GET(self):
+        u = urllib.parse.urlsplit(self.path)
+        self.server.count('search')
+        if self.dropped():
+            return
+        (status, body) = self.server.search(u.path, dict(urllib.parse.parse_qsl(u.query)))
+        self.reply(status, body, 'application/xml')
+
+    def do_PUT(self):
+        u = urllib.parse.urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        self.server.count('put')
+        if self.dropped():
+            return
+        params = dict(urllib.parse.parse_qsl(u.query, keep_blank_values=True))
+        (status, body) = self.server.put(u.path, params, body)
+        self.reply(status, body, 'application/xml')
+
+
+class FakeRipe(FakeServer):
+    """Stand-in for the RIPE whois data base REST API server, domain objects only"""
+
+    handler = RipeHandler
+
+    def __init__(self, port=0, cert=None, faults=None, maintainer='FAKE-MNT', password='fake'):
+        FakeServer.__init__(self, port, cert, faults)
+        self.maintainer = maintainer
+        self.password = password
+        self.domains = {}               # domain name -> [(attribute name, value)]
+
+    def addDomain(self, domain_name, ds_rdata=()):
+        atts = [('domain', domain_name), ('descr', 'fake domain'), ('admin-c', 'FAKE-RIPE'),
+                ('tech-c', 'FAKE-RIPE'), ('zone-c', 'FAKE-RIPE'), ('nserver', 'ns.example.net'),
+                ('mnt-by', self.maintainer), ('source', 'RIPE')]
+        atts.extend(('ds-rdata', ds) for ds in ds_rdata)
+        with self.lock:
+            self.domains[domain_name] = atts
+
+    def search(self, path, params):     # (HTTP status, whois-resources)
+        if path != '/search':
+            return (404, whoisResources([], [('Error', 'Unknown resource %s' % (path,))]))
+        if self.faults.chance(self.faults.error_rate):
+            return (500, whoisResources([], [('Error', 'Internal error (injected)')]))
+        query = params.get('query-string', '')
+        with self.lock:
+            if params.get('inverse-attribute') == 'mnt-by':
+                found = [atts for atts in self.domains.values() if ('mnt-by', query) in atts]
+            else:
+                found = [self.domains[query]] if query in self.domains else []
+        if not found:
+            return (404, whoisResources([], [('Error', 'ERROR:101: no entries found')]))
+        return (200, whoisResources(found))
+
+    def put(self, path, params, body):  # (HTTP status, whois-resources)
+        domain_name = path.rpartition('/')[2]
+        if not path.startswith('/ripe/domain/'):
+            return (404, whoisResources([], [('Error', 'Unknown resource %s' % (path,))]))
+        if params.get('password') != self.password:
+            return (401, whoisResources([], [('Error', 'Authorisation for [domain] %s failed' % (domain_name,))]))
+        if self.faults.chance(self.faults.error_rate):
+            return (500, whoisResources([], [('Error', 'Internal error (injected)')]))
+        try:
+            tree = etree.fromstring(body)
+        except etree.ParseError:
+            return (400, whoisResources([], [('Error', 'Malformed request body')]))
+        atts = [(a.get('name'), a.get('value')) for a in tree.findall('objects/object/attributes/attribute')]
+        if ('domain', domain_name) not in atts:
+            return (400, whoisResources([], [('Error', 'Domain in body does not match %s' % (domain_name,))]))
+        if 'dry-run' in params:
+            return (200, whoisResources([atts], [('Info', 'Dry-run performed, no changes to the database have been made')]))
+        with self.lock:
+            self.domains[domain_name] = atts
+        return (200, whoisResources([atts]))
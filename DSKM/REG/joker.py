@@ -23,8 +23,12 @@ REG/joker.py - Interface module to the registrar Joker.com Domain Management API
 
 
 # -----------------------------------------
+import concurrent.futures
 import http.client
+import json
+import os
 import ssl
+import threading
 import time
 import urllib.parse
 
@@ -34,7 +38,11 @@ import sys
 # -----------------------------------------
 # Globals
 # -----------------------------------------
-theConnection = None
+theConnections = threading.local()      # one ConnectionJoker per thread: pool of sessions
+theResultList = None                    # (time of retrieval, Tracking-Id -> Completion-Status)
+resultListLock = threading.Lock()
+sessionFileLock = threading.Lock()
+RESULT_LIST_MAX_AGE = 60                # seconds, before result-list is requested again
 # -----------------------------------------
 
 import DSKM.logger as logger
@@ -48,96 +56,147 @@ l = logger.Logger()
 import DSKM.config as conf
 #------------------------------------------------------------------------------
 
+import DSKM.registrar as reg
+
 #--------------------------
 #   classes
 #--------------------------
 class ConnectionJoker(object):
-    """Connection to Joker.com DMAPI server"""
+    """Connection to Joker.com DMAPI server, session (Auth-Sid) cached in JOKER_SESSION_FILE"""
     global l
     def __init__(self):
-        self.myConnection = 0
+        self.myConnection = None
         self.session = {}
+        self.expires = 0
         self.sslContext = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=conf.ca_file)
+        self.connect()
+        if not self.loadSession():
+            self.login()
+    
+    def connect(self):                  # HTTPS connection, kept alive between requests
+        if self.myConnection:
+            self.myConnection.close()
+        self.myConnection = http.client.HTTPSConnection(conf.registrar['Joker']['server'],
+                                            context=self.sslContext, timeout=conf.REGISTRAR_TIMEOUT)
+    
+    def login(self):
+        self.session = {}
         try:
-            self.myConnection = http.client.HTTPSConnection(conf.registrar['Joker']['server'], context=self.sslContext)
-            l.logDebug('HTTPS- connection succeeded. Authentication follows.')
             self.myConnection.request("GET", '/request/login?username=' + 
                 conf.registrar['Joker']['account_name'] + '&password=' + conf.registrar['Joker']['account_pw'])
             l.logDebug('Authentication initiated.')
-        except Exception:
-            l.logError('Failed to connect to Joker.com DMAPI server, because ', str(sys.exc_info()[1]))
-            return None
-        
-        r1 = self.myConnection.getresponse()
+            r1 = self.myConnection.getresponse()
+            body = r1.read().decode('ASCII')
+        except (http.client.HTTPException, OSError):
+            l.logError('Failed to connect to Joker.com DMAPI server, because ' + str(sys.exc_info()[1]))
+            self.connect()
+            return False
         l.logDebug('Got authentication response.')
         if r1.status != 200:
             l.logError('Failed to connect to Joker.com DMAPI server, because: ' + r1.reason)
-        while not r1.closed:
-            for line in r1.read().decode('ASCII').splitlines():
-                l.logDebug('Got line from Joker: {}'.format(line))
-                k = v = ''
-                if len(line) > 2:
-                    try:
-                        (kv) =  line.split(':')
-                        k = kv[0]
-                        v = ''.join(kv[1:])
-                    except (ValueError):
-                        l.logError('Parsing error while reading data from Joker.com. Line: {}'.format(line))
-                        return None
-                    self.session[k] = v.strip()
-                    l.logDebug('Response: ' + k + ': ' + v)
-                else:
-                    l.logDebug('Got line shorter then 2 chars: ' + line)
-                    break
-            l.logDebug('No more lines to read from response.')
-            break
+        for line in body.splitlines():
+            l.logDebug('Got line from Joker: {}'.format(line))
+            if len(line) <= 2:
+                l.logDebug('Got line shorter then 2 chars: ' + line)
+                break
+            kv = line.split(':')
+            self.session[kv[0]] = ''.join(kv[1:]).strip()
         l.logDebug('Collected authentication response.')
-        if self.session['Status-Code'] != '0':
-            l.logError('Failed to sign-on at Joker.com, because: ' + self.session['Status-Text'])
+        if self.session.get('Status-Code') != '0' or 'Auth-Sid' not in self.session:
+            l.logError('Failed to sign-on at Joker.com, because: ' + self.session.get('Status-Text', 'no Auth-Sid'))
             for k in self.session.keys():
                 print(k, ': ',  self.session[k])
-            return None
+            self.session = {}
+            return False
         l.logDebug('Authentication succeeded.')
+        self.touch()
+        return True
+    
+    def loadSession(self):              # reuse Auth-Sid of previous run, if not expired
+        if not conf.JOKER_SESSION_FILE:
+            return False
+        try:
+            with open(conf.JOKER_SESSION_FILE, 'r') as fd:
+                cached = json.load(fd)
+            if cached['expires'] <= time.time() or cached['account_name'] != conf.registrar['Joker']['account_name']:
+                return False
+            self.session = {'Auth-Sid': cached['Auth-Sid']}
+            self.expires = cached['expires']
+        except (IOError, ValueError, KeyError, TypeError):
+            return False
+        l.logDebug('Reusing Joker.com session, valid until %s' % (time.ctime(self.expires),))
+        return True
+    
+    def touch(self):                    # session used: extend and save it
+        self.expires = time.time() + conf.JOKER_SESSION_LIFETIME
+        if not conf.JOKER_SESSION_FILE or 'Auth-Sid' not in self.session:
+            return
+        try:
+            with sessionFileLock:       # threads of session pool
+                fd = os.open(conf.JOKER_SESSION_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump({'Auth-Sid': self.session['Auth-Sid'], 'expires': self.expires,
+                                'account_name': conf.registrar['Joker']['account_name']}, f)
+        except IOError:
+            l.logWarn("Can't save Joker.com session, because %s" % (sys.exc_info()[1],))
+    
+    def forget(self):                   # session rejected by server
+        self.session = {}
+        if conf.JOKER_SESSION_FILE:
+            try:
+                os.remove(conf.JOKER_SESSION_FILE)
+            except OSError:
+                pass
     
     def conn(self):
         return self.myConnection
     
     def sid(self):
-        return self.session['Auth-Sid']
+        return self.session.get('Auth-Sid')
 
 
 # -----------------------------------------
 # Functions
 # -----------------------------------------
+def isAuthError(http_status, status):   # Auth-Sid unknown or expired?
+    if http_status in (401, 403):
+        return True
+    return 'auth' in status.get('Status-Text', '').lower() and status.get('Status-Code') != '0'
+
 def requestJoker(query_string):
     
-    status = {}
-    result = []
-    header_done = False
-    global theConnection
-    
-    if not theConnection:
-        theConnection = ConnectionJoker()
-        if not theConnection: return None
-    c = theConnection.conn()
-    if not c:  return None
-    if '?' in query_string:
-        s = '/request/' + query_string + '&auth-sid=' + theConnection.sid()
-    else:
-        s = '/request/' + query_string + '?auth-sid=' + theConnection.sid()
-    l.logDebug(s)
-    try:
-        c.request("GET", s)
-    except Exception:
-        l.logError('Request to Joker.com DMAPI server failed, because: ', str(sys.exc_info()[1]))
-        l.logError('Query was: "' + query_string + '"')
-        return None
-    r1 = c.getresponse()
-    l.logDebug('Got response.')
-    if r1.status != 200:
-        l.logError('Request to Joker.com DMAPI server failed , because: ' + r1.reason + ' - HTTP - status ' + repr(r1.status))
-    while not r1.closed:
-        for line in r1.read().decode('ASCII').splitlines():
+    if not getattr(theConnections, 'connection', None):
+        theConnections.connection = ConnectionJoker()
+    theConnection = theConnections.connection
+    for attempt in (1, 2):              # 2nd attempt after reconnect or new login
+        status = {}
+        result = []
+        if not theConnection.sid() and not theConnection.login():
+            return None
+        c = theConnection.conn()
+        if '?' in query_string:
+            s = '/request/' + query_string + '&auth-sid=' + theConnection.sid()
+        else:
+            s = '/request/' + query_string + '?auth-sid=' + theConnection.sid()
+        l.logDebug(s)
+        try:
+            c.request("GET", s)
+            r1 = c.getresponse()
+            body = r1.read().decode('ASCII')
+        except (http.client.HTTPException, OSError):   # e.g. RemoteDisconnected
+            if attempt == 1:
+                l.logDebug('Connection to Joker.com lost (%s); reconnecting.' % (sys.exc_info()[1],))
+                theConnection.connect()
+                continue
+            l.logError('Request to Joker.com DMAPI server failed, because: ' + str(sys.exc_info()[1]))
+            l.logError('Query was: "' + query_string + '"')
+            return None
+        except Exception:
+            l.logError('Request to Joker.com DMAPI server failed, because: ' + str(sys.exc_info()[1]))
+            l.logError('Query was: "' + query_string + '"')
+            return None
+        l.logDebug('Got response.')
+        for line in body.splitlines():
             items = line.split(':')
             if len(items) == 2:
                 (k,v) = line.split(':')
@@ -146,15 +205,21 @@ def requestJoker(query_string):
             else:
                 result.append(line)
                 l.logDebug('Line: ' + line)
-
+        if attempt == 1 and isAuthError(r1.status, status):
+            l.logDebug('Joker.com session expired; signing on again.')
+            theConnection.forget()
+            continue
         break
-    if status['Status-Code'] != '0':
+    if r1.status != 200:
+        l.logError('Request to Joker.com DMAPI server failed , because: ' + r1.reason + ' - HTTP - status ' + repr(r1.status))
+    if status.get('Status-Code') != '0':
         lines = []
         for k in status.keys():
             lines.append(str('%s:\t%s\n' % (k, status[k])))
         l.logDebug('Request to Joker.com DMAPI server failed, because:\n%s' % ''.join(lines))
         l.logError('Request to Joker.com DMAPI server failed')
         return None
+    theConnection.touch()
     status['result'] = result        
     return status
 
@@ -166,22 +231,11 @@ def regRemoveAllDS(zone):
             if not cl: return None
             for c in cl:
                 l.logDebug(c + ':   ' + str(cl[c]))
-            if 'Tracking-Id' in cl:
-                stat = getResult(cl['Tracking-Id'])
-                if 'request_state' in stat and stat['request_state'] == 'SUCCESS':
-                    return stat
-                else:
-                    for c in stat:
-                        l.logDebug(c + ':   ' + str(stat[c]))
-                    l.logError('Unsuccesfull request state received.')
-                    return None
+            if 'Tracking-Id' in cl:                 # completion is looked up later
+                return pendingResult(cl)
             else:
                 l.logError('Missing Tracking-Id in response from Joker while removing DS-RR of %s' % zone)
                 return None
-            l.logError('Request remove all DS-RR of zone %s to Joker failed, because: %s' % (zone, stat['result_msg']))
-            l.logError('Order Number is %s, and request, sent to Joker was "%s"' % (stat['order number'], q))
-            printStatus(stat, ('ds-', 'result_'))
-            return None
         except (KeyError):
             l.logError('Request remove all DS-RR of zone %s to Joker failed' % (zone))
             return None
@@ -208,22 +262,11 @@ def regAddDS(zone, args):
                 if not cl: return None
                 for c in cl:
                     l.logDebug(c + ':   ' + str(cl[c]))
-                if 'Tracking-Id' in cl:
-                    stat = getResult(cl['Tracking-Id'])
-                    if 'request_state' in stat and stat['request_state'] == 'SUCCESS':
-                        return stat
-                    else:
-                        for c in stat:
-                            l.logDebug(c + ':   ' + str(stat[c]))
-                        l.logError('Unsuccesfull request state received.')
-                        return None
+                if 'Tracking-Id' in cl:                 # completion is looked up later
+                    return pendingResult(cl)
                 else:
                     l.logError('Missing Tracking-Id in response from Joker while updating DS-RR for %s' % zone)
                     return None
-                l.logError('Request update DS-RR of zone %s to Joker failed, because: %s' % (zone, stat['result_msg']))
-                l.logError('Order Number is %s, and request, sent to Joker was "%s"' % (stat['order number'], q))
-                printStatus(stat, ('ds-', 'result_'))
-                return None
             else:
                 q = str('domain-modify?domain=%s&dnssec=1' % zone)
                 i = 1
@@ -241,22 +284,11 @@ def regAddDS(zone, args):
                 if not cl: return None
                 for c in cl:
                     l.logDebug(c + ':   ' + str(cl[c]))
-                if 'Tracking-Id' in cl:
-                    stat = getResult(cl['Tracking-Id'])
-                    if 'request_state' in stat and stat['request_state'] == 'SUCCESS':
-                        return stat
-                    else:
-                        for c in stat:
-                            l.logDebug(c + ':   ' + str(stat[c]))
-                        l.logError('Unsuccesfull request state received.')
-                        return None
+                if 'Tracking-Id' in cl:                 # completion is looked up later
+                    return pendingResult(cl)
                 else:
                     l.logError('Missing Tracking-Id in response from Joker while updating DS-RR for %s' % zone)
                     return None
-                l.logError('Request update DS-RR of zone %s to Joker failed, because: %s' % (zone, stat['result_msg']))
-                l.logError('Order Number is %s, and request, sent to Joker was "%s"' % (stat['order number'], q))
-                printStatus(stat, ('ds-', 'result_'))
-                return None
         except (KeyError):
             l.logError('Request update DS-RR of zone %s to Joker failed' % (zone))
             return None
@@ -264,27 +296,54 @@ def regAddDS(zone, args):
         l.logError('Internal inconsitency: regAddDS(): submission of DS-RR of .arpa. not implemented')
         return None
 
-def getResultList(rid):
-    cl = ''
-    if rid == None:
-        cl = requestJoker('result-list')
-    else:
-        cl = requestJoker('result-retrieve?SvTrID=%s' % rid)
-    if not cl: return False
-    return cl
-
-def getResult(transactionID):
+def getResult(transactionID):           # does not wait for completion
     stat = requestJoker('result-retrieve?SvTrID=%s' % transactionID)
-    while stat['Completion-Status'] == '?':
-        l.logVerbose('Retrieving completion status from Joker...')
-        time.sleep(5)
-        stat = requestJoker('result-retrieve?SvTrID=%s' % transactionID)
+    if not stat: return None
     stat['TID'] = transactionID
     return stat        
 
+def pendingResult(cl):                  # request accepted, but not yet completed
+    cl['TID'] = cl['Tracking-Id']
+    cl['pending'] = True
+    l.logVerbose('Request accepted by Joker.com with Tracking-Id %s' % (cl['Tracking-Id'],))
+    return cl
+
+def completionStates(transactionIDs):   # Completion-Status ('ack', 'nack' or '?') of each transaction
+    global theResultList
+    with resultListLock:
+        if not theResultList or theResultList[0] < time.time() - RESULT_LIST_MAX_AGE:
+            cl = requestJoker('result-list')    # one request for all zones of this run
+            if not cl: return {}
+            states = {}
+            for items in resultLines(cl):
+                states[items[1]] = items[5]
+            theResultList = (time.time(), states)
+    states = {}
+    missing = []                        # not (yet) in list
+    for tid in transactionIDs:
+        if tid in theResultList[1]:
+            states[tid] = theResultList[1][tid]
+        else:
+            missing.append(tid)
+    if missing:                         # retrieve them concurrently over pool of sessions
+        with concurrent.futures.ThreadPoolExecutor(max_workers=sessions()) as pool:
+            for (tid, stat) in zip(missing, pool.map(getResult, missing)):
+                if stat and 'Completion-Status' in stat:
+                    states[tid] = stat['Completion-Status']
+    return states
+
+def resultLines(cl):                    # result-list split into timestamp Tracking-Id Proc-ID task domain result
+    for line in cl['result']:
+        items = line.split()
+        if len(items) >= 6:
+            yield items
+
+def sessions():                         # max number of concurrent sessions
+    return max(1, conf.REGISTRAR_LIMITS.get('Joker', {}).get('sessions', 1))
+
 def deleteResult(transactionID):
     stat = requestJoker('result-delete?SvTrID=%s' % transactionID)
-    if stat['Status-Code'] != '0':
+    if not stat or stat['Status-Code'] != '0':
         l.logVerbose('Deleting completion entry at Joker failed for {}'.format(
                                                                 transactionID))
         return None
@@ -299,3 +358,47 @@ def printStatus(stat, show):
                 break
     l.logError(' DNSsec related status info follows: ------------\n%s? End of DNSsec related status info   ------------\n' % ''.join(lines))
 
+
+class JokerBackend(reg.Backend):
+    """Registrar backend of Joker.com: submissions complete asynchronously"""
+    
+    has_transactions = True
+    
+    def submit(self, zone_name, ds_set):
+        if len(ds_set) == 0:
+            return regRemoveAllDS(zone_name)
+        return regAddDS(zone_name, ds_set)
+    
+    def poll(self, handles):
+        statuses = {}
+        states = completionStates(handles)
+        for handle in handles:
+            state = states.get(handle, '?')
+            if state == 'ack':
+                statuses[handle] = 'done'
+            elif state == 'nack':
+                statuses[handle] = 'failed'
+            else:
+                statuses[handle] = 'pending'
+        return statuses
+    
+    def test(self, zone_name, ds_set, dry_run):
+        return None                     # no test submissions with Joker.com
+    
+    def transactions(self):
+        cl = requestJoker('result-list')
+        if not cl:
+            return None
+        return [{'timestamp': items[0], 'Tracking-Id': items[1], 'Proc-ID': items[2], 'task': items[3],
+                 'domain': items[4], 'state': items[5] if items[5] in ('ack', 'nack') else 'pending'}
+                    for items in resultLines(cl)]
+    
+    def retrieve(self, transactionID):
+        stat = requestJoker('result-retrieve?SvTrID=%s' % transactionID)
+        if not stat:
+            return None
+        stat.pop('result', None)
+        return stat
+    
+    def deleteResult(self, transactionID):
+        return deleteResult(transactionID)
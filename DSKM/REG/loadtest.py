@@ -0,0 +1,211 @@
+"""
+ DSKM DNSsec Key Management
+
+ Copyright (c) 2012 Axel Rau, axel.rau@chaos1.de
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -----------------------------------------
+REG/loadtest.py - load test of the registrar clients against the fake servers of REG/fake.py
+
+Pushes DS changes of N zones through registrar.regAddDS over a pool of
+sessions and reports throughput and latency percentiles, e.g.:
+
+    python -m DSKM.REG.loadtest -z 500 -s 4 --latency 0.05 --error_rate 0.01
+
+With --remove, a 2nd round removes all DS-RRs again by empty DS sets
+(registrar.regRemoveAllDS, as sent by stopSigning and zone deletion).
+
+The registrar account data of the config file are replaced by those of
+the fake servers for the run; the config file must exist nevertheless.
+"""
+
+# -----------------------------------------
+import concurrent.futures
+import math
+import optparse
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+import sys
+# -----------------------------------------
+
+import DSKM.logger as logger
+l = logger.Logger()
+
+import DSKM.registrar as reg
+import DSKM.REG.fake as fake
+
+# -----------------------------------------
+# Configurables
+# -----------------------------------------
+import DSKM.config as conf
+#------------------------------------------------------------------------------
+
+parser = optparse.OptionParser(description='Load test of DSKM registrar clients against local fake servers.')
+parser.add_option('--registrar', '-r', action='store', default='Joker',
+                   help='Registrar to test: Joker, Ripe or both (default: Joker).')
+parser.add_option('--zones', '-z', action='store', type='int', default=100,
+                   help='Number of zones with a DS change (default: 100).')
+parser.add_option('--sessions', '-s', action='store', type='int', default=1,
+                   help='Concurrent sessions per registrar (default: 1).')
+parser.add_option('--latency', action='store', type='float', default=0.0,
+                   help='Seconds of server latency per request (default: 0).')
+parser.add_option('--jitter', action='store', type='float', default=0.0,
+                   help='Up to this many seconds added to latency (default: 0).')
+parser.add_option('--error_rate', action='store', type='float', default=0.0,
+                   help='Fraction of requests answered with an error (default: 0).')
+parser.add_option('--drop_rate', action='store', type='float', default=0.0,
+                   help='Fraction of requests, whose connection is dropped (default: 0).')
+parser.add_option('--completion_delay', action='store', type='float', default=0.0,
+                   help='Seconds until Joker completes a request (default: 0).')
+parser.add_option('--nack_rate', action='store', type='float', default=0.0,
+                   help='Fraction of Joker requests completed with nack (default: 0).')
+parser.add_option('--seed', action='store', type='int', default=None,
+                   help='Seed of random error injection.')
+parser.add_option('--remove', action='store_true', default=False,
+                   help='Remove all DS-RRs again in a 2nd round (empty DS sets).')
+parser.add_option('--verbose', '-v', action='store_true', default=False,
+                   help='Show log messages of registrar clients.')
+
+#--------------------------
+#   functions
+#--------------------------
+
+def percentile(values, p):              # nearest rank of sorted values
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1))]
+
+def dsArgs(rnd):                        # one random DS-RR as returned by zone.argsForDSsubmission()
+    return [{'tag': rnd.randrange(65536), 'alg': 13, 'digest_type': 2, 'flags': 257,
+             'digest': '%064X' % (rnd.getrandbits(256),),
+             'pubkey': '%0128x' % (rnd.getrandbits(512),)}]
+
+def zoneNames(registrar, n):
+    if registrar == 'Ripe':             # RIPE serves reverse zones only
+        return ['%d.%d.10.in-addr.arpa' % (i % 256, i // 256) for i in range(n)]
+    return ['load%05d.example' % (i,) for i in range(n)]
+
+def submit(zone, args):                 # runs in thread of session pool: (zone, seconds, result); no args: remove
+    start = time.time()
+    try:
+        if args:
+            res = reg.regAddDS(zone, args)
+        else:
+            res = reg.regRemoveAllDS(zone)
+    except Exception:
+        res = None
+        l.logError('%s(%s) raised %s' % ('regAddDS' if args else 'regRemoveAllDS', zone.name, sys.exc_info()[1]))
+    return (zone, time.time() - start, res)
+
+def run(registrar, opts, rnd, remove=False):    # (elapsed seconds, sorted latencies, results)
+    zones = [LoadZone(name, registrar) for name in zoneNames(registrar, opts.zones)]
+    results = []
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, opts.sessions)) as pool:
+        for f in concurrent.futures.as_completed([pool.submit(submit, zone, [] if remove else dsArgs(rnd))
+                                                    for zone in zones]):
+            results.append(f.result())
+    elapsed = time.time() - start
+    return (elapsed, sorted(r[1] for r in results), results)
+
+def report(registrar, elapsed, latencies, results, server):
+    ok = len([r for r in results if r[2]])
+    print('%s: %d zones, %d ok, %d failed in %.3f s: %.1f zones/s' % (
+            registrar, len(results), ok, len(results) - ok, elapsed, len(results) / elapsed if elapsed else 0))
+    print('  latency ms: p50 %.1f  p90 %.1f  p99 %.1f  max %.1f' % tuple(
+            1000 * percentile(latencies, p) for p in (50, 90, 99, 100)))
+    print('  server requests: %s' % (', '.join('%s %d' % (k, server.counts[k]) for k in sorted(server.counts)),))
+
+def pollJoker(results, completion_delay):   # completion states of accepted Joker requests
+    tids = [r[2]['Tracking-Id'] for r in results if r[2] and r[2].get('pending')]
+    if not tids:
+        return
+    time.sleep(completion_delay)
+    import DSKM.REG.joker as reg_joker
+    reg_joker.theResultList = None      # request fresh result-list
+    start = time.time()
+    statuses = reg.backend('Joker').poll(tids)
+    counts = {}
+    for tid in tids:
+        counts[statuses.get(tid, '?')] = counts.get(statuses.get(tid, '?'), 0) + 1
+    print('  poll of %d Tracking-Ids in %.3f s: %s' % (len(tids), time.time() - start,
+            ', '.join('%s %d' % (k, counts[k]) for k in sorted(counts))))
+
+def execute_from_command_line():
+    (opts, args) = parser.parse_args()
+    registrars = ('Joker', 'Ripe') if opts.registrar == 'both' else (opts.registrar,)
+    for registrar in registrars:
+        if registrar not in ('Joker', 'Ripe'):
+            parser.error('Unknown registrar %s' % (registrar,))
+    logger.Logger(verbose=opts.verbose)
+    rnd = random.Random(opts.seed)
+
+    tmp_dir = tempfile.mkdtemp(prefix='dskm_loadtest')
+    try:
+        try:
+            cert = fake.selfSignedCert(tmp_dir)
+        except (OSError, subprocess.CalledProcessError):
+            print("Can't create certificate of fake servers with openssl, because %s" % (sys.exc_info()[1],))
+            return 1
+        conf.ca_file = cert[0]
+        conf.JOKER_SESSION_FILE = os.path.join(tmp_dir, 'joker_session')
+        conf.registrar = dict(conf.registrar)
+        conf.REGISTRAR_LIMITS = dict(conf.REGISTRAR_LIMITS)
+        for registrar in registrars:
+            faults = fake.Faults(opts.latency, opts.jitter, opts.error_rate, opts.drop_rate, opts.seed)
+            if registrar == 'Joker':
+                server = fake.FakeJoker(cert=cert, faults=faults, completion_delay=opts.completion_delay,
+                                        nack_rate=opts.nack_rate).start()
+                conf.registrar['Joker'] = {'server': server.address, 'account_name': 'fake', 'account_pw': 'fake'}
+            else:
+                server = fake.FakeRipe(cert=cert, faults=faults).start()
+                for zone_name in zoneNames('Ripe', opts.zones):
+                    server.addDomain(zone_name)
+                conf.registrar['Ripe'] = {'server': server.address, 'account_name': server.maintainer,
+                                          'account_pw': server.password, 'changed_email': 'fake@example.net'}
+            conf.REGISTRAR_LIMITS[registrar] = {'sessions': opts.sessions}
+            try:
+                (elapsed, latencies, results) = run(registrar, opts, rnd)
+                report(registrar, elapsed, latencies, results, server)
+                if registrar == 'Joker':
+                    pollJoker(results, opts.completion_delay)
+                if opts.remove:
+                    (elapsed, latencies, results) = run(registrar, opts, rnd, remove=True)
+                    report(registrar + ' (remove)', elapsed, latencies, results, server)
+            finally:
+                server.stop()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return 0
+
+#--------------------------
+#   classes
+#--------------------------
+
+class LoadZone(object):
+    """What registrar.regAddDS needs of a zone"""
+
+    def __init__(self, name, registrar):
+        self.name = name
+        self.pcfg = {'Registrar': registrar}
+
+
+if __name__ == '__main__':
+    sys.exit(execute_from_command_line())
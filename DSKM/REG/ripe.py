@@ -21,10 +21,12 @@ REG/ripe.py - Interface module to the Regional Internet Registry RIPE's REST API
           see https://labs.ripe.net/ripe-database/database-api/api-documentation
 """
 # -----------------------------------------
+import copy
 from datetime import date, datetime
 import http.client
 import pprint
 import ssl
+import threading
 import time
 import urllib.parse
 import xml.etree.ElementTree as etree
@@ -37,6 +39,9 @@ import sys
 # -----------------------------------------
 theConnection = None
 theSecureConnection = None
+theDomains = None                       # (time of bulk query, domain name -> attributes)
+DOMAINS_MAX_AGE = 300                   # seconds, before bulk query is repeated
+domainsLock = threading.Lock()
 
 # -----------------------------------------
 
@@ -51,6 +56,8 @@ l = logger.Logger()
 import DSKM.config as conf
 #------------------------------------------------------------------------------
 
+import DSKM.registrar as reg
+
 #--------------------------
 #   classes
 #--------------------------
@@ -77,35 +84,39 @@ class ConnectionRipe():
         return ConnectionRipe.conn
 
 class SecureConnectionRipe():
-    """Connection to Ripe.net whois-db server"""
+    """Connection to Ripe.net whois-db server, one per thread, kept alive"""
     
-    _singleton = None
-    conn = 0
+    _local = threading.local()
     
     
     def __new__(cls, *args, **kwargs):
-        if not cls._singleton:
-            cls._singleton = super(SecureConnectionRipe, cls ).__new__(cls, *args, **kwargs)
-        return cls._singleton
+        if not getattr(cls._local, 'instance', None):
+            cls._local.instance = super(SecureConnectionRipe, cls ).__new__(cls, *args, **kwargs)
+            cls._local.instance.conn = None
+        return cls._local.instance
     
     
     def __init__(self):
         
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-        context.load_verify_locations('/usr/local/share/certs/ca-root-nss.crt')
-        SecureConnectionRipe.conn = http.client.HTTPSConnection(conf.registrar['Ripe']['server'], context = context)
-        ##SecureConnectionRipe.conn.set_debuglevel(10)
+        if self.conn:                   # keep alive connection of this thread
+            return
+        self.reconnect()
+    
+    def reconnect(self):
+        if self.conn:
+            self.conn.close()
+        context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=conf.ca_file)
+        self.conn = http.client.HTTPSConnection(conf.registrar['Ripe']['server'],
+                                            context = context, timeout=conf.REGISTRAR_TIMEOUT)
+        ##self.conn.set_debuglevel(10)
         l.logDebug('Securely connected.')
-        
-    def conn(self):
-        return SecureConnectionRipe.conn
 
 # -----------------------------------------
 # Functions
 # -----------------------------------------
 def regRemoveAllDS(zone_name):
 
-    return makeRequest(zone_name, ())
+    return makeRequest(zone_name, (), False, False)
 
 def regAddDS(zone_name, args, test_run, dry_run):
 
@@ -120,47 +131,56 @@ def getResultList(rid):
 # Internal functions
 # -----------------------------------------
 
-def dbQuery(url):
+def httpRequest(method, u, body=None, headers={}):  # response parsed while read
     
-    c = SecureConnectionRipe().conn
+    for attempt in (1, 2):              # 2nd attempt after reconnect
+        c = SecureConnectionRipe().conn
+        try:
+            c.request(method, u, body, headers)
+            with c.getresponse() as r1:
+                t = parseResponse(r1)
+            break
+        except (http.client.HTTPException, OSError):   # e.g. RemoteDisconnected
+            if attempt == 2:
+                raise
+            l.logDebug('Connection to RIPE.NET lost (%s); reconnecting.' % (sys.exc_info()[1],))
+            SecureConnectionRipe().reconnect()
+    if r1.status != 200:
+        l.logError('Request to RIPE.NET whois DB server failed , because: %s - HTTP - status: %s' %
+            (r1.reason, repr(r1.status)))
+    l.logDebug('%s %s returned %d domain object(s) and %d message(s)' %
+                (method, u.split('?')[0], len(t['domains']), len(t['messages'])))
+    return t
+
+def dbQuery(url):
     
     u = '/' + url
     l.logDebug('dbQuery: Host: %s GET %s' % (conf.registrar['Ripe']['server'], u))
-    c.request('GET', u)
-    
-    with c.getresponse() as r1:
-        t = etree.fromstring(r1.read())
-        if r1.status != 200:
-            l.logError('Query of RIPE.NET whois DB server failed , because: % - HTTP - status: %' %
-                (r1.reason, repr(r1.status)))
-    if l.debug:
-        print('[Dumping XML tree of dbQuery response:]')
-        etree.dump(t)
-    return t
+    return httpRequest('GET', u)
 
 def dbRequest(method, url, dry_run, body=None, headers={}):
     
-    c = SecureConnectionRipe().conn
-    
     dr = ''
     if dry_run: dr = '&dry-run'
     u = '/' + url + '?password=' + conf.registrar['Ripe']['account_pw'] + dr
-    # l.logDebug seems dysfunctional here:
-    l.logDebug('dbRequest(method,url,,,): %s %s' % (method, u))
+    l.logDebug('dbRequest(method,url,,,): %s %s' % (method, '/' + url + dr))
     l.logDebug('dbRequest(,,,headers,): %s' % (repr(headers)))
     l.logDebug('dbRequest(,,body,,): %s' % (body))
-    l.logDebug('dbRequest(method,url,,,): %s %s' % (method, u))
-    c.request(method, u, body, headers)
-    
-    with c.getresponse() as r1:
-        t = etree.fromstring(r1.read())
-        if r1.status != 200:
-            l.logError('Update of RIPE.NET whois DB server failed , because: %s - HTTP - status: %s' %
-                (r1.reason, repr(r1.status)))
-    if l.debug:
-        print('[Dumping XML tree of dbRequest response:]')
-        etree.dump(t)
-    return t
+    return httpRequest(method, u, body, headers)
+
+def domainsOfMaintainer():              # all domain objects, maintained by us, in one query
+    global theDomains
+    with domainsLock:                   # one bulk query for all threads
+        if theDomains and theDomains[0] >= time.time() - DOMAINS_MAX_AGE:
+            return theDomains[1]
+        try:
+            t = dbQuery('search?source=ripe&query-string=' + urllib.parse.quote(conf.registrar['Ripe']['account_name']) +
+                        '&inverse-attribute=mnt-by&type-filter=domain&flags=no-filtering&flags=no-referenced')
+        except (http.client.HTTPException, OSError, etree.ParseError):
+            l.logWarn('Bulk query of domain objects at Ripe failed, because %s' % (sys.exc_info()[1],))
+            return {}
+        theDomains = (time.time(), t['domains'])
+        return theDomains[1]
 
 def makeRequest(zone_name, args, test_run, dry_run):   # construct and perform the request for Ripe
     newChangedValue = ''
@@ -174,17 +194,22 @@ def makeRequest(zone_name, args, test_run, dry_run):   # construct and perform t
         return None
 
     newChangedValue = changedTimestamp()    # sets up value of 'changed' attribute
-    try:
-        # query current config
-        received_tree = dbQuery('search?source=ripe&query-string=' + zone_name + '&flags=no-filtering')
-        assert received_tree != None
-    except:
-        l.logError('Request query DS-RR of zone %s at Ripe failed' % (zone_name))
-        return None
-    
-    domain_atts = extract_domain_atts(received_tree)
-    if not extract_and_report_error_messages(received_tree):
-        return None
+    domains = domainsOfMaintainer()
+    if zone_name in domains:
+        domain_atts = copy.deepcopy(domains[zone_name])
+    else:                               # not maintained by us or bulk query failed
+        try:
+            # query current config
+            received_tree = dbQuery('search?source=ripe&query-string=' + zone_name + '&flags=no-filtering')
+            assert received_tree != None
+        except:
+            l.logError('Request query DS-RR of zone %s at Ripe failed' % (zone_name))
+            return None
+        
+        domain_atts = received_tree['domains'].get(zone_name, {})
+        if not extract_and_report_error_messages(received_tree):
+            return None
+    showDomainAtts(domain_atts)
     
     for arg in args:
         if (None, '') in (arg['tag'], arg['alg'], arg['digest_type'], str(arg['digest'])):
@@ -211,58 +236,61 @@ def makeRequest(zone_name, args, test_run, dry_run):   # construct and perform t
     except:
         l.logError('Request update DS-RR of zone %s to Ripe failed' % (zone_name))
         return None
-    domain_atts = extract_domain_atts(received_tree)
+    domain_atts = received_tree['domains'].get(zone_name, {})
     if not extract_and_report_error_messages(received_tree):
         return None
-    ts = set(domain_atts['ds-rdata'])
+    if theDomains and not dry_run:
+        theDomains[1][zone_name] = domain_atts
+    ts = set(domain_atts.get('ds-rdata', []))
     if ns != ts:
         l.logError('DS-RR of zone %s returned from Ripe differ from request' % (zone_name))
         return None
     return {'TID': newChangedValue}
     
-def extract_domain_atts(received_tree):
-    domain_atts = {}
-    for obj in received_tree.findall('objects/*'):
-        for (k,v) in obj.attrib.items():
-            if k == 'type' and v == 'domain':
-                for att in obj.findall('attributes/*'):
+def parseResponse(stream):              # incremental parse of whois-resources into domain objects and messages
+    domains = {}                        # domain name -> {attribute name: sorted list of values}
+    messages = []                       # (severity, [text, arg values])
+    for (event, elem) in etree.iterparse(stream, events=('end',)):
+        if elem.tag == 'object':
+            if elem.get('type') == 'domain':
+                domain_atts = {}
+                for att in elem.findall('attributes/attribute'):
                     name = att.get('name')
                     value = att.get('value')
                     ## RIPE-NCC introduced last-modified on 2015-06, which must not be provided
                     if name == 'last-modified':
                         continue
-                    print('%s: %s' % (name, value))
-                    if name in domain_atts:
-                        domain_atts[name].append(value)
-                    else:
-                        domain_atts[name] = [value]
-                        
-    for k in domain_atts:
-        domain_atts[k].sort()
-    return domain_atts
+                    domain_atts.setdefault(name, []).append(value)
+                for k in domain_atts:
+                    domain_atts[k].sort()
+                if 'domain' in domain_atts:
+                    domains[domain_atts['domain'][0].rstrip('.').lower()] = domain_atts
+            elem.clear()                # keep memory flat with many objects
+        elif elem.tag == 'errormessage':
+            arg_list = [elem.get('text')]
+            for arg in elem.findall('args'):
+                arg_list.append(arg.get('value'))
+            messages.append((elem.get('severity'), arg_list))
+            elem.clear()
+    return {'domains': domains, 'messages': messages}
+
+def showDomainAtts(domain_atts):
+    for name in domain_atts:
+        for value in domain_atts[name]:
+            l.logDebug('%s: %s' % (name, value))
 
 def extract_and_report_error_messages(received_tree):
-    error_messages = []
     no_error = True
-    for em in received_tree.findall('errormessages/*'):
-        if em.tag == 'errormessage':
-            err = False
-            severity = em.get('severity')
-            if severity == 'Error':
-                no_error = False
-                err = True
-            arg_list = []
-            arg_list.append(em.get('text'))
-            args = em.findall('args')
-            if args:
-                for arg in args:
-                    a = arg.get('value')
-                    arg_list.append(a)
-            for arg in arg_list:
-                if err:
-                    l.logError(arg)
-                else:
-                    l.logWarn(arg)
+    for (severity, arg_list) in received_tree['messages']:
+        err = False
+        if severity == 'Error':
+            no_error = False
+            err = True
+        for arg in arg_list:
+            if err:
+                l.logError(arg)
+            else:
+                l.logWarn(arg)
     return no_error
 
 def updateDomainAtts(domain_atts, ns, newChangedValue):
@@ -305,3 +333,25 @@ def changedTimestamp():
     newChangedValue = str('%s %s' % (conf.registrar['Ripe']['changed_email'], timestamp.strftime('%Y%m%d')))
     return newChangedValue
 
+
+class RipeBackend(reg.Backend):
+    """Registrar backend of RIPE: submissions complete synchronously"""
+    
+    def submit(self, zone_name, ds_set):
+        if len(ds_set) == 0:
+            return regRemoveAllDS(zone_name)
+        return regAddDS(zone_name, ds_set, False, False)
+    
+    def fetch_current(self, zone_names):    # from bulk query of our domain objects
+        current = {}
+        domains = domainsOfMaintainer()
+        for zone_name in zone_names:
+            if zone_name in domains:
+                current[zone_name] = set()
+                for rdata in domains[zone_name].get('ds-rdata', []):
+                    items = rdata.split()
+                    current[zone_name].add((int(items[0]), int(items[1]), int(items[2]), ''.join(items[3:]).upper()))
+        return current
+    
+    def test(self, zone_name, ds_set, dry_run):
+        return regAddDS(zone_name, ds_set, True, dry_run)
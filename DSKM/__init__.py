@@ -1 +1 @@
-__all__ = ["config", "key", "logger", "misc", "operate", "registrar", "utils", "zone", "REG"]
+__all__ = ["cache", "chain", "config", "health", "key", "logger", "misc", "operate", "outbox", "probe", "registrar", "scheduler", "statestore", "transactions", "transport", "utils", "watcher", "xfr", "zone", "REG"]
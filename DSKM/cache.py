@@ -0,0 +1,120 @@
+"""
+ DSKM DNSsec Key Management
+
+ Copyright (c) 2012-2019 Axel Rau, axel.rau@chaos1.de
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -----------------------------------------
+cache.py - DnsCache class module - persistent, TTL aware cache of DNS answers
+"""
+
+import fcntl
+import json
+import os
+import sys
+import time
+
+# -----------------------------------------
+
+import DSKM.logger as logger
+l = logger.Logger()
+
+# -----------------------------------------
+# Configurables
+# -----------------------------------------
+import DSKM.config as conf
+#------------------------------------------------------------------------------
+
+#--------------------------
+#   classes
+#--------------------------
+
+class DnsCache():
+    """Answers (list of rdata texts) or negative answers (None), keyed by qname and RR type"""
+
+    _singleton = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._singleton:
+            cls._singleton = super(DnsCache, cls ).__new__(cls, *args, **kwargs)
+            cls._singleton.entries = None
+        return cls._singleton
+
+    def __init__(self):
+        if self.entries is None:
+            self.entries = {}               # key -> [expires, value]
+            self.dirty = False
+            self.entries = self.load()
+
+    def key(self, qname, rrtype):
+        return '%s/%s' % (str(qname).rstrip('.').lower(), rrtype)
+
+    def get(self, qname, rrtype):           # return (hit, value)
+        k = self.key(qname, rrtype)
+        entry = self.entries.get(k)         # threads of -V may drop it meanwhile
+        if entry:
+            (expires, value) = entry
+            if expires > time.time():
+                l.logDebug('DnsCache: hit %s' % (k,))
+                return (True, value)
+            self.entries.pop(k, None)
+        return (False, None)
+
+    def put(self, qname, rrtype, value, ttl):
+        self.entries[self.key(qname, rrtype)] = [int(time.time()) + int(ttl), value]
+        self.dirty = True
+
+    def evict(self, entries):               # drop expired entries and limit size
+        now = time.time()
+        for k in [k for k in entries if entries[k][0] <= now]:
+            del entries[k]
+        if len(entries) > conf.DNS_CACHE_SIZE:
+            for k in sorted(entries, key=lambda k: entries[k][0])[:len(entries) - conf.DNS_CACHE_SIZE]:
+                del entries[k]
+        return entries
+
+    def load(self):
+        if not conf.DNS_CACHE_FILE:
+            return {}
+        try:
+            with open(conf.DNS_CACHE_FILE, 'r') as fd:
+                return self.evict(json.load(fd))
+        except IOError:                     # first run
+            return {}
+        except ValueError:
+            l.logWarn('Ignoring garbled DNS cache %s' % (conf.DNS_CACHE_FILE,))
+            return {}
+
+    def save(self):                         # merge our entries into cache file
+        if not conf.DNS_CACHE_FILE or not self.dirty:
+            return
+        try:
+            with open(conf.DNS_CACHE_FILE + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)    # other worker processes may save too
+                entries = self.load()
+                for k in self.entries:
+                    if k not in entries or entries[k][0] < self.entries[k][0]:
+                        entries[k] = self.entries[k]
+                entries = self.evict(entries)
+                tmp_name = conf.DNS_CACHE_FILE + '.tmp'
+                with open(tmp_name, 'w') as fd:
+                    json.dump(entries, fd)
+                os.replace(tmp_name, conf.DNS_CACHE_FILE)
+        except IOError:
+            (exc_type, exc_value, exc_traceback) = sys.exc_info()
+            l.logWarn("Can't save DNS cache, because %s" % (exc_value))
+            return
+        self.entries = entries
+        self.dirty = False
@@ -0,0 +1,174 @@
+"""
+ DSKM DNSsec Key Management
+
+ Copyright (c) 2012-2019 Axel Rau, axel.rau@chaos1.de
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -----------------------------------------
+chain.py - local validation of the chain of trust from parent to zone
+
+validateZone() checks each link with dns.dnssec.validate:
+  1. DNSKEY RRset of parent, signed by itself (taken as trust anchor)
+  2. DS RRset of zone at parent, signed by DNSKEY of parent
+  3. DNSKEY RRset of zone, signed by a key, which matches a DS
+  4. SOA of zone, signed by a DNSKEY of zone
+Answers are taken from the probes and the zone copy of this run, if any.
+Verified DNSKEY RRsets of parents are kept in the DNS cache, so zones
+with the same parent cost one query less.
+"""
+
+import socket
+import time
+
+import dns.dnssec, dns.exception, dns.message, dns.name, dns.query
+import dns.rcode, dns.rdataclass, dns.rdatatype, dns.rrset
+
+# -----------------------------------------
+
+import DSKM.logger as logger
+l = logger.Logger()
+
+import DSKM.cache as cache
+import DSKM.health as health
+import DSKM.key as dnsKey
+import DSKM.misc as misc
+import DSKM.transport as transport
+
+VERIFIED_DNSKEY = 'DNSKEY-verified'     # RR type of verified parent keys in DnsCache
+
+#--------------------------
+#   classes
+#--------------------------
+
+class BrokenLink(Exception):
+    """Link of chain of trust, which failed to validate"""
+
+    def __init__(self, link, reason):
+        self.link = link
+        self.reason = reason
+
+    def __str__(self):
+        return '%s: %s' % (self.link, self.reason)
+
+
+#--------------------------
+#   functions
+#--------------------------
+
+def response(servers, qname, rdtype, probes=None):   # first NOERROR response with DNSSEC RRs or None
+    request = dns.message.make_query(qname, rdtype, want_dnssec=True, payload=4096)
+    board = health.scoreboard()
+    half_open = board.halfOpen(servers)
+    for server in board.order(servers): # fastest healthy first
+        try:
+            if probes and (server, qname, rdtype) in probes:
+                res = probes.response(server, qname, rdtype)
+            else:
+                l.logDebug('Querying %s for %s of %s' % (server, dns.rdatatype.to_text(rdtype), qname))
+                res = transport.query(request, server, half_open=half_open)
+        except (socket.error, dns.exception.Timeout, dns.query.UnexpectedSource,
+                dns.query.BadResponse, dns.exception.FormError, EOFError):
+            continue
+        if res.rcode() == dns.rcode.NOERROR:
+            return res
+    return None
+
+def signedRRset(res, name, rdtype):     # (RRset, RRSIG RRset) of answer section; None if missing
+    rrset = res.get_rrset(res.answer, name, dns.rdataclass.IN, rdtype)
+    rrsigs = res.get_rrset(res.answer, name, dns.rdataclass.IN, dns.rdatatype.RRSIG, rdtype)
+    return (rrset, rrsigs)
+
+def fetch(link, servers, name, rdtype, probes=None):  # signed RRset from first answering server
+    res = response(servers, name.to_text(), rdtype, probes)
+    if res is None:
+        raise BrokenLink(link, 'no answer from %s' % (', '.join(servers),))
+    (rrset, rrsigs) = signedRRset(res, name, rdtype)
+    if rrset is None:
+        raise BrokenLink(link, 'no %s RRset' % (dns.rdatatype.to_text(rdtype),))
+    if rrsigs is None:
+        raise BrokenLink(link, '%s RRset not signed' % (dns.rdatatype.to_text(rdtype),))
+    return (rrset, rrsigs)
+
+def verify(link, rrset, rrsigs, keys):  # raise BrokenLink, unless an RRSIG validates with keys
+    try:
+        dns.dnssec.validate(rrset, rrsigs, keys)
+    except dns.dnssec.ValidationFailure as e:
+        raise BrokenLink(link, '%s (key tags of RRSIGs: %s)' % (
+                            e, ', '.join(str(rrsig.key_tag) for rrsig in rrsigs)))
+
+def parentKeys(parent):                 # verified DNSKEY RRset of parent, cached across zones
+    name = dns.name.from_text(parent)
+    c = cache.DnsCache()
+    (hit, value) = c.get(parent, VERIFIED_DNSKEY)
+    if hit and value:
+        return dns.rrset.from_text_list(name, 0, dns.rdataclass.IN, dns.rdatatype.DNSKEY, value)
+    link = 'DNSKEY of parent %s' % (parent,)
+    (keys, rrsigs) = fetch(link, misc.authNS(parent), name, dns.rdatatype.DNSKEY)
+    verify(link, keys, rrsigs, {name: keys})
+    ttl = min([keys.ttl] + [rrsig.expiration - int(time.time()) for rrsig in rrsigs])
+    if ttl > 0:
+        c.put(parent, VERIFIED_DNSKEY, [rdata.to_text() for rdata in keys], ttl)
+    return keys
+
+def dsMatches(name, key, ds_rrset):     # DS-RR of ds_rrset made from key?
+    for ds in ds_rrset:
+        if ds.key_tag != dns.dnssec.key_id(key) or ds.algorithm != key.algorithm:
+            continue
+        try:
+            if dns.dnssec.make_ds(name, key, ds.digest_type) == ds:
+                return True
+        except dns.dnssec.UnsupportedAlgorithm:
+            continue
+    return False
+
+def zoneRRset(zone, name, rdtype):      # (RRset, RRSIG RRset) of apex of zone, from copy or auth NS
+    zone_copy = zone.zoneCopy()
+    link = '%s of %s' % (dns.rdatatype.to_text(rdtype), zone.name)
+    if zone_copy:
+        rrset = zone_copy.zone.get_rrset(name, rdtype)
+        rrsigs = zone_copy.zone.get_rrset(name, dns.rdatatype.RRSIG, rdtype)
+        if rrset is None:
+            raise BrokenLink(link, 'no %s RRset in copy of zone' % (dns.rdatatype.to_text(rdtype),))
+        if rrsigs is None:
+            raise BrokenLink(link, '%s RRset not signed in copy of zone' % (dns.rdatatype.to_text(rdtype),))
+        return (rrset, rrsigs)
+    servers = [dnsKey.inclusionServer(zone)]    # probed by state checks
+    servers.extend(server for server in misc.authNS(zone.name) if server not in servers)
+    return fetch(link, servers, name, rdtype, zone.probes)
+
+def validateZone(zone):                 # None, if chain of trust from parent validates, else failed link
+    name = dns.name.from_text(zone.name)
+    try:
+        keys_of_parent = parentKeys(zone.parent)
+        parent_name = dns.name.from_text(zone.parent)
+
+        link = 'DS of %s at parent %s' % (zone.name, zone.parent)
+        (ds_rrset, rrsigs) = fetch(link, misc.authNS(zone.parent), name, dns.rdatatype.DS, zone.probes)
+        verify(link, ds_rrset, rrsigs, {parent_name: keys_of_parent})
+
+        (keys, rrsigs) = zoneRRset(zone, name, dns.rdatatype.DNSKEY)
+        link = 'DNSKEY of %s' % (zone.name,)
+        secure = [key for key in keys if dsMatches(name, key, ds_rrset)]
+        if not secure:
+            raise BrokenLink(link, 'no DNSKEY matches a DS (key tags of DS: %s)' % (
+                                ', '.join(str(ds.key_tag) for ds in ds_rrset),))
+        verify(link, keys, rrsigs, {name: dns.rrset.from_rdata_list(name, keys.ttl, secure)})
+
+        (soa, rrsigs) = zoneRRset(zone, name, dns.rdatatype.SOA)
+        verify('SOA of %s' % (zone.name,), soa, rrsigs, {name: keys})
+    except BrokenLink as e:
+        return str(e)
+    l.logDebug('Chain of trust of %s validated: DNSKEY of %s, DS, DNSKEY, SOA' % (zone.name, zone.parent))
+    return None
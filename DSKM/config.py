@@ -33,3 +33,59 @@ sys.path.append(CONFIG_MODULE_DIRS[0])
 sys.path.append(CONFIG_MODULE_DIRS[1])
 
 from dskm_conf import *
+
+# optional settings, which may be missing in config files of older releases
+_optional = {
+    'DNS_CACHE_FILE': None,             # None: <ROOT_PATH>/.dskm_dns_cache, '': no persistent cache
+    'DNS_CACHE_SIZE': 10000,            # max number of cached answers
+    'ZONE_TRANSFER': False,             # answer key checks from local copies of zones, kept by IXFR
+    'ZONE_COPY_DIR': None,              # None: <ROOT_PATH>/.dskm_zone_copies
+    'XFR_LIFETIME': 60,                 # max seconds of one zone transfer
+    'DNS_TCP_IDLE': 10,                 # seconds an idle TCP connection to a name server is kept open
+    'NS_HEALTH_FILE': None,             # None: <ROOT_PATH>/.dskm_ns_health, '': scoreboard not kept between runs
+    'NS_TIMEOUT_MIN': 1,                # lower bound of adaptive name server timeout (upper: NS_TIMEOUT)
+    'NS_FAILURES': 3,                   # consecutive failures, after which a name server is skipped ...
+    'NS_COOLDOWN': 600,                 # ... for this many seconds
+    'DNS_CACHE_NEGATIVE_TTL': 3600,     # TTL of NXDOMAIN/NoAnswer, if no SOA in response
+    'STATE_STORE': 'files',             # 'files': dnssec-conf-*/dnssec-stat-* or 'sqlite'
+    'STATE_DB': None,                   # None: <ROOT_PATH>/.dskm_state.db
+    'DAEMON_POLL_MIN': 300,             # seconds between polls of zones, waiting for propagation ...
+    'DAEMON_POLL_MAX': 3600,            # ... doubled after each poll without state change up to this
+    'DAEMON_RESCAN': 3600,              # seconds between scans for new zone directories
+    'DAEMON_WATCH_INTERVAL': 60,        # seconds between polls of zone directories, if no inotify
+    'CHANGE_LOG': None,                 # None: <ROOT_PATH>/.dskm_changes, '': no change log
+    'SKIP_MAX': 24 * 3600,              # max seconds a zone with unchanged inputs is skipped
+    'REGISTRAR_TIMEOUT': 60,            # seconds to wait for registrar servers
+    'DS_CHECK_PARENT': False,           # don't submit DS-RRs to registrar, if parent serves them already
+    'OUTBOX_FILE': None,                # None: <ROOT_PATH>/.dskm_outbox
+    'OUTBOX_BACKOFF_MIN': 300,          # seconds before 1st retry of failed DS submission ...
+    'OUTBOX_BACKOFF_MAX': 6 * 3600,     # ... doubled after each failure up to this
+    'OUTBOX_WARN_ATTEMPTS': 5,          # failures of a DS submission before errors are mailed
+    'REGISTRAR_LIMITS': {},             # registrar -> {'interval': seconds between requests,
+                                        #   'burst': max requests per run, 'sessions': max concurrent requests}
+    'TRANSACTION_DB': None,             # None: <ROOT_PATH>/.dskm_transactions.db
+    'TRANSACTION_MAX_AGE': 60,          # seconds before result lists of registrars are fetched again
+    'REGISTRAR_BACKENDS': {},           # registrar name -> 'module:class' of additional registrar backend
+    'JOKER_SESSION_FILE': None,         # None: <ROOT_PATH>/.dskm_joker_session, '': no reuse of session
+    'JOKER_SESSION_LIFETIME': 3000,     # seconds a Joker.com session (Auth-Sid) is reused after last use
+}
+for _k in _optional:
+    if _k not in globals():
+        globals()[_k] = _optional[_k]
+
+if DNS_CACHE_FILE is None:
+    DNS_CACHE_FILE = ROOT_PATH + '/.dskm_dns_cache'
+if NS_HEALTH_FILE is None:
+    NS_HEALTH_FILE = ROOT_PATH + '/.dskm_ns_health'
+if STATE_DB is None:
+    STATE_DB = ROOT_PATH + '/.dskm_state.db'
+if ZONE_COPY_DIR is None:
+    ZONE_COPY_DIR = ROOT_PATH + '/.dskm_zone_copies'
+if CHANGE_LOG is None:
+    CHANGE_LOG = ROOT_PATH + '/.dskm_changes'
+if TRANSACTION_DB is None:
+    TRANSACTION_DB = ROOT_PATH + '/.dskm_transactions.db'
+if OUTBOX_FILE is None:
+    OUTBOX_FILE = ROOT_PATH + '/.dskm_outbox'
+if JOKER_SESSION_FILE is None:
+    JOKER_SESSION_FILE = ROOT_PATH + '/.dskm_joker_session'
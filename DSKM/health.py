@@ -0,0 +1,179 @@
+"""
+ DSKM DNSsec Key Management
+
+ Copyright (c) 2012-2019 Axel Rau, axel.rau@chaos1.de
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -----------------------------------------
+health.py - Scoreboard class module - persistent health of name servers
+
+Per server, the scoreboard keeps a smoothed round trip time and its
+variation (EWMA, as TCP does), the number of consecutive and of all
+failures and the time of the last answer. From these come the timeout of
+the next query (between NS_TIMEOUT_MIN and NS_TIMEOUT) and the order, in
+which servers are tried (fastest healthy first). After NS_FAILURES
+consecutive failures, the circuit of a server is opened: it is skipped for
+NS_COOLDOWN seconds, then tried once again. A set of servers, whose circuits
+are all open, is tried anyway (half open), and the circuits of our masters
+are never opened.
+Worker processes merge their scoreboards into NS_HEALTH_FILE.
+"""
+
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+
+# -----------------------------------------
+
+import DSKM.logger as logger
+l = logger.Logger()
+
+# -----------------------------------------
+# Configurables
+# -----------------------------------------
+import DSKM.config as conf
+#------------------------------------------------------------------------------
+
+RTT_GAIN = 0.125                        # weight of new sample in smoothed RTT
+RTTVAR_GAIN = 0.25                      # weight of new sample in RTT variation
+MAX_AGE = 7 * 24 * 3600                 # forget servers, not used for that many seconds
+
+theScoreboard = None
+
+#--------------------------
+#   classes
+#--------------------------
+
+class Scoreboard(object):
+    """Health of name servers, keyed by address"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.entries = self.load()          # server -> dict, see entry()
+
+    def entry(self, server):
+        if server not in self.entries:
+            self.entries[server] = {'rtt': None, 'rttvar': 0.0, 'failures': 0, 'failures_total': 0,
+                                    'last_seen': 0, 'open_until': 0, 'updated': 0}
+        return self.entries[server]
+
+    def timeout(self, server):          # seconds to wait for server: RTT + 4 * variation, bounded
+        e = self.entries.get(server)
+        if not e or e['rtt'] is None or e['failures'] > 0:
+            return conf.NS_TIMEOUT
+        return max(conf.NS_TIMEOUT_MIN, min(conf.NS_TIMEOUT, e['rtt'] + 4 * e['rttvar']))
+
+    def available(self, server):        # circuit closed or cooldown over?
+        e = self.entries.get(server)
+        return not e or e['open_until'] <= time.time()
+
+    def halfOpen(self, servers):        # circuits of all servers open? then try them anyway
+        return not any(self.available(str(server)) for server in servers)
+
+    def order(self, servers):           # available servers, fastest first; all, if none available
+        servers = [str(server) for server in servers]
+        healthy = [server for server in servers if self.available(server)]
+        if not healthy:
+            return servers
+        def rank(server):
+            e = self.entries.get(server)
+            if not e:
+                return (0, 0.0)         # unknown: try first, to learn its RTT
+            return (1 if e['failures'] else 0, e['rtt'] or 0.0)
+        return sorted(healthy, key=rank)    # stable: order of config kept for equal rank
+
+    def success(self, server, rtt):
+        with self.lock:
+            e = self.entry(server)
+            if e['rtt'] is None:
+                e['rtt'] = rtt
+                e['rttvar'] = rtt / 2
+            else:
+                e['rttvar'] = (1 - RTTVAR_GAIN) * e['rttvar'] + RTTVAR_GAIN * abs(e['rtt'] - rtt)
+                e['rtt'] = (1 - RTT_GAIN) * e['rtt'] + RTT_GAIN * rtt
+            if e['open_until']:
+                l.logVerbose('Name server %s answers again; closing circuit' % (server,))
+            e['failures'] = 0
+            e['open_until'] = 0
+            e['last_seen'] = e['updated'] = time.time()
+            self.dirty = True
+
+    def failure(self, server):
+        with self.lock:
+            e = self.entry(server)
+            e['failures'] += 1
+            e['failures_total'] += 1
+            e['updated'] = time.time()
+            if e['failures'] >= conf.NS_FAILURES and server not in conf.master:  # no retry without master
+                if e['open_until'] <= e['updated']:
+                    l.logWarn('Name server %s failed %d times; skipping it for %d seconds' %
+                                (server, e['failures'], conf.NS_COOLDOWN))
+                e['open_until'] = e['updated'] + conf.NS_COOLDOWN
+            self.dirty = True
+
+    def evict(self, entries):           # drop servers not used for long
+        now = time.time()
+        for server in [server for server in entries if entries[server]['updated'] < now - MAX_AGE]:
+            del entries[server]
+        return entries
+
+    def load(self):
+        if not conf.NS_HEALTH_FILE:
+            return {}
+        try:
+            with open(conf.NS_HEALTH_FILE, 'r') as fd:
+                return self.evict(json.load(fd))
+        except IOError:                 # first run
+            return {}
+        except ValueError:
+            l.logWarn('Ignoring garbled name server scoreboard %s' % (conf.NS_HEALTH_FILE,))
+            return {}
+
+    def save(self):                     # merge our entries into scoreboard file and take merged entries
+        if not conf.NS_HEALTH_FILE:
+            return
+        try:
+            with open(conf.NS_HEALTH_FILE + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)    # other worker processes may save too
+                entries = self.load()
+                with self.lock:
+                    for server in self.entries:
+                        if server not in entries or entries[server]['updated'] < self.entries[server]['updated']:
+                            entries[server] = self.entries[server]
+                    if self.dirty:
+                        tmp_name = conf.NS_HEALTH_FILE + '.tmp'
+                        with open(tmp_name, 'w') as fd:
+                            json.dump(entries, fd)
+                        os.replace(tmp_name, conf.NS_HEALTH_FILE)
+                    self.entries = entries
+                    self.dirty = False
+        except IOError:
+            (exc_type, exc_value, exc_traceback) = sys.exc_info()
+            l.logWarn("Can't save name server scoreboard, because %s" % (exc_value))
+
+
+#--------------------------
+#   functions
+#--------------------------
+
+def scoreboard():
+    global theScoreboard
+    if not theScoreboard:
+        theScoreboard = Scoreboard()
+    return theScoreboard
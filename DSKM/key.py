@@ -95,6 +95,7 @@ import script
 import fnmatch
 from datetime import date, datetime
 import time
+import calendar
 
 # for salt
 from Crypto import Random as rand
@@ -103,7 +104,7 @@ import binascii
 import copy
 
 import dns.resolver, dns.message, dns.query, dns.rdatatype, dns.rdtypes.ANY.DNSKEY, dns.rcode
-import dns.dnssec, dns.zone
+import dns.dnssec, dns.name, dns.rdata, dns.rdataclass, dns.zone
 
 import json
 import os
@@ -118,6 +119,8 @@ import pprint
 import DSKM.logger as logger
 l = logger.Logger()
 import DSKM.misc as misc
+import DSKM.registrar as reg
+import DSKM.statestore as statestore
 
 # -----------------------------------------
 
@@ -151,6 +154,24 @@ secondary_resolver.use_edns(edns=0, ednsflags=0, payload=4096)
 
 
 
+# timing meta data lines in key files ("; Publish: 20190301120000 (Fri Mar  1 ...)")
+# and private key files ("Publish: 20190301120000")
+timing_re = re.compile(r'^;?\s*(Created|Publish|Activate|Inactive|Delete):\s*(\d{14})')
+timing_types = {'Publish': 'P', 'Activate': 'A', 'Inactive': 'I', 'Delete': 'D'}
+
+# DS digest types by dnssec-dsfromkey option in conf.DIGEST_ALGO_DS and their hash algorithms
+ds_digest_types = {'': (1, 2), '-1': (1,), '-2': (2,)}
+ds_digest_algos = {1: 'SHA1', 2: 'SHA256', 4: 'SHA384'}
+
+#--------------------------
+#   functions
+#--------------------------
+
+def inclusionServer(zone):          # server asked whether keys sign zone
+    if zone.pcfg['Registrar'] == 'Local':       # zone maintained local?
+        return conf.master[0]
+    return conf.external_secondaries[-2]        # use 2nd to last of our secondaries for now **FIXME**
+
 #--------------------------
 #   classes
 #--------------------------
@@ -181,6 +202,7 @@ class SigningKey(object):
         self.sepkey = 0         # sep flag =KSK)
         self.dnssec_alg = 0     # key algorithm
         self.pubkey_base64 = ''
+        self.dnskey_rdata = None
 
         self.dsHash = [None,None]  # 2 DS hashes
         
@@ -192,7 +214,7 @@ class SigningKey(object):
         # functions in SigningKey.__init__
         #-----------------------------
         # Read key meta data from key file
-        def readKey(keyFileName):
+        def parseKey(keyFileName):
             
             #   Read timing meta data from key
             def readKeyTimingData(keyFileName, type):
@@ -213,6 +235,30 @@ class SigningKey(object):
                 else:
                     return int(result)
             
+            #   Read timing meta data, written by bind into .private and .key file (no fork of dnssec-settime)
+            def readKeyTimingMetaData(keyFileName):
+                timingData = {}
+                found = False
+                for fn in (keyFileName, keyFileName[:-len('.key')] + '.private'):   # .private overrides .key
+                    try:
+                        with open(fn, 'r', encoding="ASCII") as fd:
+                            for line in fd:
+                                m = timing_re.match(line)
+                                if not m:
+                                    continue
+                                found = True
+                                if m.group(1) in timing_types:
+                                    timingData[timing_types[m.group(1)]] = \
+                                        calendar.timegm(time.strptime(m.group(2), '%Y%m%d%H%M%S'))
+                    except IOError:
+                        l.logDebug('readKeyTimingMetaData(): Can\'t read %s' % (fn,))
+                if not found:                   # no meta data in files: old format?
+                    return None
+                for type in 'PAID':
+                    if type not in timingData:
+                        timingData[type] = 0    # UNSET
+                return timingData
+            
             fd = None
             try:
                 fd = open(keyFileName, 'r')
@@ -236,12 +282,7 @@ class SigningKey(object):
                     st = line.find('DNSKEY ')
                     tok = dns.tokenizer.Tokenizer(line[st+7:])
                     dnskey_rdata = dns.rdtypes.ANY.DNSKEY.DNSKEY.from_text(dns.rdataclass.ANY, dns.rdatatype.DNSKEY, tok, origin=name, relativize=False)
-                    self.keytag = dns.dnssec.key_id(dnskey_rdata)
-                    self.dnssec_flags = dnskey_rdata.flags
-                    self.sepkey = self.dnssec_flags & 0x1;
-                    self.dnssec_alg = dnskey_rdata.algorithm
-                    ##self.pubkey_base64 = dns.rdata._base64ify(dnskey_rdata.key)
-                    self.pubkey_base64 = dns.rdata._base64ify(dnskey_rdata.key, chunksize=2000)
+                    self.setDNSKEY(dnskey_rdata)
                     
                     l.logDebug('Read DNSSEC key id=%d with flags=%d alg=%d' % (self.keytag, self.dnssec_flags, self.dnssec_alg))
                 else:
@@ -271,10 +312,36 @@ class SigningKey(object):
             
             fd.close()
             
-            self.timingData['P'] = readKeyTimingData(keyFileName, 'P')
-            self.timingData['A'] = readKeyTimingData(keyFileName, 'A')
-            self.timingData['I'] = readKeyTimingData(keyFileName, 'I')
-            self.timingData['D'] = readKeyTimingData(keyFileName, 'D')
+            timingData = readKeyTimingMetaData(keyFileName)
+            if timingData:
+                self.timingData = timingData
+            else:
+                l.logDebug('No timing meta data in %s; calling dnssec-settime' % (keyFileName,))
+                self.timingData['P'] = readKeyTimingData(keyFileName, 'P')
+                self.timingData['A'] = readKeyTimingData(keyFileName, 'A')
+                self.timingData['I'] = readKeyTimingData(keyFileName, 'I')
+                self.timingData['D'] = readKeyTimingData(keyFileName, 'D')
+        
+        # Read key meta data from cache of state store or from key file
+        def readKey(keyFileName):
+            store = statestore.store()
+            mtime = []
+            for fn in (keyFileName, keyFileName[:-len('.key')] + '.private'):
+                try:
+                    mtime.append(str(os.stat(fn).st_mtime_ns))
+                except OSError:
+                    mtime.append('0')
+            mtime = '/'.join(mtime)
+            cached = store.loadKey(self.name, keyFileName, mtime)
+            if cached:
+                l.logDebug('readKey(%s) using cached key meta data.' % (keyFileName))
+                self.setDNSKEY(dns.rdata.from_text(dns.rdataclass.ANY, dns.rdatatype.DNSKEY, cached['dnskey']))
+                self.type = cached['type']
+                self.timingData = cached['timingData']
+            else:
+                parseKey(keyFileName)
+                store.saveKey(self.name, keyFileName, mtime, {'dnskey': self.dnskey_rdata.to_text(),
+                                            'type': self.type, 'timingData': self.timingData})
             
             if self.type == 'KSK' and self.zone.pcfg['Registrar'] != 'Local':
                 self.digestOfDS()
@@ -361,6 +428,15 @@ class SigningKey(object):
         l.logVerbose('%s' % self.__str__())
         l.logDebug('Instantiated public key %s' % self.pubkey_base64)
 
+    def setDNSKEY(self, dnskey_rdata):
+        self.keytag = dns.dnssec.key_id(dnskey_rdata)
+        self.dnssec_flags = dnskey_rdata.flags
+        self.sepkey = self.dnssec_flags & 0x1;
+        self.dnssec_alg = dnskey_rdata.algorithm
+        ##self.pubkey_base64 = dns.rdata._base64ify(dnskey_rdata.key)
+        self.pubkey_base64 = dns.rdata._base64ify(dnskey_rdata.key, chunksize=2000)
+        self.dnskey_rdata = dnskey_rdata
+    
     def __str__(self):
         def getKeyTimingData(type):
             if self.timingData[type] == 0:
@@ -371,27 +447,26 @@ class SigningKey(object):
         return str('%s/%s/%d/%d(A:%s, I:%s, D:%s)' % (self.name, self.type, self.keytag, self.zone.pstat[self.type.lower()]['State'],
                     getKeyTimingData('A'), getKeyTimingData('I'), getKeyTimingData('D')))
     
+    def dsRdata(self, digest_type):     # DS rdata of our DNSKEY, computed in process
+        try:
+            return dns.dnssec.make_ds(dns.name.from_text(self.name), self.dnskey_rdata,
+                                        ds_digest_algos[digest_type])
+        except (KeyError, ValueError, dns.dnssec.UnsupportedAlgorithm):
+            (exc_type, exc_value, exc_traceback) = sys.exc_info()
+            l.logError('Error while creating DS RR for %s, because %s' % (self.name, exc_value))
+            e = misc.AbortedZone("")
+            raise e
+    
+    def dsLine(self, digest_type):      # DS-RR as written by dnssec-dsfromkey
+        ds = self.dsRdata(digest_type)
+        return '%s. IN DS %d %d %d %s\n' % (self.name, ds.key_tag, ds.algorithm, ds.digest_type,
+                                        binascii.hexlify(ds.digest).decode('ASCII').upper())
+    
     def digestOfDS(self):
-        self.mypath.cd()
         def read1DS(i):
-            digest = ''
-            s = str(conf.BIND_TOOLS + 'dnssec-dsfromkey -%d %s' % (i, self.file_name))
-            try:                                      
-                result = shell(s, stdout='PIPE').stdout.strip()
-                l.logDebug('digestOfDS(): dnssec-dsfromkey returned: "%s"' % (result,))
-                rr = result.split(None)
-                if len(rr) == 7:
-                    digest = rr[6]
-                elif len(rr) == 8:
-                    digest = rr[6]+rr[7]
-                else:
-                    assert('?Wrong result from dnssec-dsfromkey: %s' % (rr,))
-                l.logDebug('digestOfDS(): returning: "%s"' % digest)
-                return digest                
-            except script.CommandFailed:              
-                l.logError('Error while creating DS RR for ' + self.name)
-                e = misc.AbortedZone("")
-                raise e
+            digest = binascii.hexlify(self.dsRdata(i).digest).decode('ASCII').upper()
+            l.logDebug('digestOfDS(): returning: "%s"' % digest)
+            return digest                
         
         if self.type != 'KSK':
             l.logError("Can't create/delete DS from ZSK (internal inconsitency)" + self.name)
@@ -422,15 +497,13 @@ class SigningKey(object):
         
         if activity != 'retire' and activity != 'delete':
             l.logVerbose('Creating DS-RR from KSK %s' % self.__str__())
-            s = conf.BIND_TOOLS + 'dnssec-dsfromkey ' + conf.DIGEST_ALGO_DS + ' ' + self.file_name
-            l.logDebug(s)                   
-            try:                                      
-                result = shell(s, stdout='PIPE').stdout.strip()
-                result = result + '\n'
-            except script.CommandFailed:              
-                l.logError('Error while creating DS RR for ' + self.name)
+            if conf.DIGEST_ALGO_DS not in ds_digest_types:
+                l.logError('Configuration error: Unknown DIGEST_ALGO_DS "%s"' % (conf.DIGEST_ALGO_DS,))
                 e = misc.AbortedZone("")
                 raise e
+            for digest_type in ds_digest_types[conf.DIGEST_ALGO_DS]:
+                result = result + self.dsLine(digest_type)
+            l.logDebug('DS-RR created: %s' % (result,))
         elif activity == 'retire':
             l.logVerbose('Deleting local DS-RR from KSK %s' % self.__str__())
         else:
@@ -459,46 +532,9 @@ class SigningKey(object):
             l.logError('Error while reading/writing local DS-RR file for KSK %s \n\tbecause %s' % (self.__str__(), exc_value))
             e = misc.AbortedZone("")
             raise e
-        self.updateSOA(self.zone.parent_dir + '/' + self.zone.parent + '.zone')
+        self.zone.parentChanged()           # serial of parent incremented and parent reloaded at end of run
         return True        
     
-    def updateSOA(self, filename): # update serial of SOA in zone file
-        timestamp = datetime.now()
-        current_date = timestamp.strftime('%Y%m%d')
-        self.mypath.cd()
-        
-        zf = ''
-        with open(filename, 'r', encoding="ASCII") as fd:
-            try:
-                zf = fd.read()
-            except:                 # file not found or not readable
-                l.logError("Can't read zone file " + filename)
-                e = misc.AbortedZone('')
-                raise e
-        ##l.logDebug('Updating SOA: zone file before update:' + zf)
-        sea = re.search('(\d{8})(\d{2})(\s*;\s*)(Serial number)', zf)
-        old_date = sea.group(1)
-        daily_change = sea.group(2)
-        if old_date == current_date:
-           daily_change = str('%02d' % (int(daily_change) +1, ))
-        else:
-            daily_change = '01'
-        zf = re.sub('\d{10}', current_date + daily_change, zf, count=1)
-        ##l.logDebug('Updating SOA: zone file after update:' + zf)
-        with open(filename, 'w', encoding="ASCII") as fd:
-            try:
-                fd.write(zf)
-            except:                 # file not found or not readable
-                l.logError("Can't write zone file " + filename)
-                e = misc.AbortedZone('')
-                raise e
-        try:
-             res = str(shell('rndc reload', stderr='PIPE').stderr)
-             l.logDebug('Rndc reload returned: %s' % (res))
-        except script.CommandFailed:
-             l.logError('Error while reloading zones after updating SOA of %s ( %s )' % (self.name, res))
-             e = misc.AbortedZone("")
-             raise e
                                                     # check if condition for state transition is true and do action if so
     def state_transition(self, secondKey):          # secondKey is true if we are 2nd KSK/ZSK
         
@@ -627,7 +663,7 @@ class SigningKey(object):
     # -----------------------------
     # Tests for state transitions in SigningKey
     # -----------------------------
-    def test_if_included(self, key_type, secondKey):    # test, if included in zone by our master
+    def test_if_included(self, key_type, secondKey, registrar_view=True):  # test, if included in zone by our master
         global master_resolver,secondary_resolver       # included means: used for signing
         
         l.logDebug('test_if_included(' + key_type + ', ' + str(secondKey) + ') called with name %s' % (self.name))
@@ -637,14 +673,22 @@ class SigningKey(object):
         l.logDebug('test_if_included(' + key_type + ', ' + str(secondKey) + ') testing %s' % (self.name))
         
         r = master_resolver
+        probes = self.zone.snapshot()                   # apex snapshot: probed once per run
         if 'ds' in key_type:
             if self.zone.pcfg['Registrar'] != 'Local':  # DS maintained by registrar?
                 r = misc.authResolver(self.zone.parent) # yes - use resolver bound to their auth NS
             elif not self.zone.parent_dir:              # locally maintained - do we have a parent?
                 return True                             # no - no parent: no DS - state test always succeeds
+            if self.zone.submissionPending():           # registrar not yet done
+                l.logDebug('test_if_included(): DS submission of %s still pending' % (self.name))
+                return False
+            current = reg.currentDS(self.zone.pcfg['Registrar'], self.name) if registrar_view else None
+            if current is not None and self.keytag not in set(ds[0] for ds in current):
+                l.logDebug('test_if_included(): DS of %s not at registrar; parent can not serve it' % (self.name))
+                return False                            # prefetched view of registrar: no query needed
             l.logDebug('test_if_included(): List of auth NS to query: %s' % (repr(r.nameservers)))
             try:
-                res = r.query(self.name, 'DS')
+                res = probes.firstAnswer(r.nameservers, self.name, 'DS')
             except dns.resolver.NoAnswer:
                 return False
             except (dns.exception.Timeout, dns.resolver.NXDOMAIN):
@@ -692,29 +736,29 @@ class SigningKey(object):
                         l.logDebug('test_if_included(key_type, secondKey) RRSIG matched ourselves')
                         return True                 # at least one RR signed by ourselves
                 """
-                ns = None
-                if self.zone.pcfg['Registrar'] == 'Local':  # zone maintained local?
-                    ns = conf.master[0]
-                else:
-                    ns = conf.external_secondaries[-2]      # use 2nd to last of our secondaries for now **FIXME**
+                ns = inclusionServer(self.zone)
                 my_covers = dns.rdatatype.DNSKEY       # DNSKEYs signed by KSK
                 if self.type == 'ZSK':
                     my_covers = dns.rdatatype.SOA      # others signed by ZSK
-                q = dns.message.make_query (self.name, my_covers, want_dnssec=True)
-                ##l.logDebug('test_if_included(): Querying %s from %s' % (dns.rdatatype._by_value[my_covers], ns))
-                l.logDebug('test_if_included(): Querying %s from %s' % (dns.rdatatype.to_text(my_covers), ns))
-                my_answer = dns.query.tcp (q, ns, conf.NS_TIMEOUT)
-                for rdata in my_answer.answer:
-                    for item in rdata.items:
-                        if item.rdtype == dns.rdatatype.RRSIG:
-                            if item.covers() == my_covers:
-                                if my_covers == dns.rdatatype.SOA:
-                                    l.logDebug('test_if_included() RRSIG matched ourselves')
-                                    return True
-                                else:
-                                    l.logDebug('test_if_included(matching keytag: %s == %s' % (item.key_tag, self.keytag))
-                                    if item.key_tag == self.keytag:
-                                        return True
+                zone_copy = self.zone.zoneCopy()
+                if zone_copy:
+                    l.logDebug('test_if_included(): Looking up RRSIGs of %s in copy of zone' % (dns.rdatatype.to_text(my_covers),))
+                    rrsigs = zone_copy.rrsigs(my_covers)
+                else:
+                    l.logDebug('test_if_included(): Looking up probed %s from %s' % (dns.rdatatype.to_text(my_covers), ns))
+                    my_answer = probes.response(ns, self.name, my_covers)
+                if not zone_copy:
+                    rrsigs = [item for rdata in my_answer.answer for item in rdata.items
+                                if item.rdtype == dns.rdatatype.RRSIG]
+                for item in rrsigs:
+                    if item.covers() == my_covers:
+                        if my_covers == dns.rdatatype.SOA:
+                            l.logDebug('test_if_included() RRSIG matched ourselves')
+                            return True
+                        else:
+                            l.logDebug('test_if_included(matching keytag: %s == %s' % (item.key_tag, self.keytag))
+                            if item.key_tag == self.keytag:
+                                return True
                 
             except (dns.resolver.NoAnswer, KeyError): # KeyError if no RRSIG of type <covers> and class IN exist
                 (exc_type, exc_value, exc_traceback) = sys.exc_info()
@@ -744,7 +788,9 @@ class SigningKey(object):
     
     def test_if_excluded(self, key_type, secondKey):       # test, if excluded from zone by our master
         l.logDebug('test_if_excluded(' + key_type + ') called') # (no longer used for signing)
-        return not self.test_if_included(key_type, secondKey)
+        if 'ds' in key_type and self.zone.submissionPending():  # registrar not yet done
+            return False
+        return not self.test_if_included(key_type, secondKey, False)   # absence confirmed at parent only
     
     def test_if_deleted(self, key_type, secondKey):         # test if DNSKEY has been deleted from RRset by master
         l.logDebug('test_if_deleted: keytype: {} secondKey: {}'.format(key_type, secondKey))
@@ -762,11 +808,13 @@ class SigningKey(object):
         return True
         
     def masters_DNSKEYs(self):  # prevent from bruteforcing named by querying too often for DNSKEY
+        if len(self.zone.master_DNSKEY_cache) == 0 and self.zone.zoneCopy():
+            self.zone.master_DNSKEY_cache.extend(self.zone.zoneCopy().keytags())
         if len(self.zone.master_DNSKEY_cache) == 0:
             r = master_resolver
             res = None
             try:
-                res = r.query(self.name, 'DNSKEY')
+                res = self.zone.snapshot().firstAnswer(r.nameservers[:1], self.name, 'DNSKEY')
             except dns.resolver.NoAnswer:
                 l.logError('masters_DNSKEYs got NOANSWER while querying for DNSKEY of %s' % (self.name))
                 sys.exit(1)
@@ -788,8 +836,20 @@ class SigningKey(object):
         if '1' in time_type and secondKey or '2' in time_type and not secondKey:
             return False
         
-        myTime = 0
         l.logDebug('test_if_time_reached(' + time_type + ') called')
+        myTime = self.dueTime(time_type)
+        if myTime is None:
+            return False
+        
+        now = int(time.time())
+        l.logDebug('test_if_time_reached: myTime=%s; now=%s' % (
+                        datetime.fromtimestamp(myTime).isoformat(), datetime.fromtimestamp(now).isoformat()))
+        if myTime <= now:
+            return True
+        return False 
+    
+    def dueTime(self, time_type):       # point in time, tested by test_if_time_reached
+        myTime = 0
         if time_type == 'zsk1_followup':
             myTime = self.timingData['I'] - self.zone.pcfg['Timing']['zsk']['i1a2'] * 3600 * 24 - \
             self.zone.pcfg['Timing']['zsk']['pa'] * 3600 * 24               # rollover + prepublish time before ZSK1 inactive
@@ -814,14 +874,8 @@ class SigningKey(object):
         else:
             if __debug__:
                 raise AssertionError('?Internal error: test_if_time_reached called with wrong argument "%s"' % (time_type,))
-            return False
-        
-        now = int(time.time())
-        l.logDebug('test_if_time_reached: myTime=%s; now=%s' % (
-                        datetime.fromtimestamp(myTime).isoformat(), datetime.fromtimestamp(now).isoformat()))
-        if myTime <= now:
-            return True
-        return False 
+            return None
+        return myTime
     
     # -----------------------------
     # State tables in SigningKey
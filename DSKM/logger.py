@@ -22,6 +22,7 @@ logger.py - Logger class module - centraliced logging and alarming
 
 import pprint
 import smtplib
+import threading
 from email.mime.text import MIMEText
 from email import policy
 
@@ -37,12 +38,13 @@ class Logger():
     
     _singleton = None
     debug = False
-    verbose = False
+    verbose = True
     cron = False
     debugText = ''
     verboseText = ''
     lastError = ''
     lastWarning = ''
+    lock = threading.Lock()             # registrar requests may log from threads
     
     def __new__(cls, *args, **kwargs):
         if not cls._singleton:
@@ -50,37 +52,61 @@ class Logger():
         return cls._singleton
     
     
-    def __init__(self, verbose=True, debug=False, cron=False):
-        
-        Logger.debug = debug
-        Logger.verbose = verbose
-        Logger.cron = cron    
+    def __init__(self, verbose=None, debug=None, cron=None):
+        # modules imported late (e.g. registrar backends) must not reset settings
+        if verbose is not None:
+            Logger.verbose = verbose
+        if debug is not None:
+            Logger.debug = debug
+        if cron is not None:
+            Logger.cron = cron
     
     def logError(self, text):           # Fatal error
-        Logger.lastError = '?%s' % (text)
-        print(Logger.lastError)
-        Logger.debugText = Logger.debugText + Logger.lastError + '\n'
+        with Logger.lock:
+            Logger.lastError = '?%s' % (text)
+            print(Logger.lastError)
+            Logger.debugText = Logger.debugText + Logger.lastError + '\n'
 
     
     def logWarn(self, text):            # Warning
-        Logger.lastWarning = '%%%s' % (text)
-        print(Logger.lastWarning)
-        Logger.verboseText = Logger.verboseText + Logger.lastWarning + '\n'
-        Logger.debugText = Logger.debugText + Logger.lastWarning + '\n'
+        with Logger.lock:
+            Logger.lastWarning = '%%%s' % (text)
+            print(Logger.lastWarning)
+            Logger.verboseText = Logger.verboseText + Logger.lastWarning + '\n'
+            Logger.debugText = Logger.debugText + Logger.lastWarning + '\n'
     
     def logVerbose(self, text):
         im = '[%s]' % (text)            # informal message
-        if Logger.verbose:
-            print(im)
-        Logger.verboseText = Logger.verboseText + im + '\n'
-        Logger.debugText = Logger.debugText + im + '\n'
+        with Logger.lock:
+            if Logger.verbose:
+                print(im)
+            Logger.verboseText = Logger.verboseText + im + '\n'
+            Logger.debugText = Logger.debugText + im + '\n'
     
     def logDebug(self, text, level=0):
         dm = '[%s]' % (text)            # debug message
-        if Logger.debug:
-            print(dm)
-        Logger.debugText = Logger.debugText + dm + '\n'
+        with Logger.lock:
+            if Logger.debug:
+                print(dm)
+            Logger.debugText = Logger.debugText + dm + '\n'
     
+    def collect(self):                  # hand over texts collected so far and start over
+        texts = (Logger.debugText, Logger.verboseText, Logger.lastError, Logger.lastWarning)
+        Logger.debugText = ''
+        Logger.verboseText = ''
+        Logger.lastError = ''
+        Logger.lastWarning = ''
+        return texts
+
+    def merge(self, texts):             # merge texts, collected by a worker process
+        (debugText, verboseText, lastError, lastWarning) = texts
+        Logger.debugText = Logger.debugText + debugText
+        Logger.verboseText = Logger.verboseText + verboseText
+        if len(lastError) > 0:
+            Logger.lastError = lastError
+        if len(lastWarning) > 0:
+            Logger.lastWarning = lastWarning
+
     def mailErrors(self):               # called by main on exit
         if len(Logger.lastError) > 0:
             self.sendMail(Logger.lastError, Logger.debugText, True)
@@ -110,5 +136,8 @@ class Logger():
             print('Linr too long for SMTP relaying')
         s.quit
     
+    def setCron(self, cron):
+        Logger.cron = cron
+    
     def cronjob(self):
         return Logger.cron
@@ -23,10 +23,13 @@ misc.py - miscellaneous classes and functions
 import dns.resolver, dns.message, dns.query, dns.rdatatype, dns.rdtypes.ANY.DNSKEY, dns.rcode
 import dns.dnssec, dns.zone
 
+import os
 import sys
 
 import DSKM.config as conf
+import DSKM.cache as cache
 import DSKM.key
+import DSKM.transport as transport
 
 import DSKM.logger as logger
 l = logger.Logger()
@@ -41,6 +44,9 @@ auth_resolver = {}
 zone_dirs = []
 zones = {}
 
+# local parents, whose <child>.ds files changed in this run: name -> zone file name
+parents_to_update = {}
+
 #--------------------------
 #   classes
 #--------------------------
@@ -61,7 +67,7 @@ class CompletedZone(Exception):
 
 def doQuery(theQuery, theRRtype):
     try:
-        answer = DSKM.key.master_resolver.query(theQuery, theRRtype)
+        answer = transport.resolve(DSKM.key.master_resolver, theQuery, theRRtype)
         return answer
     except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN, KeyError):
         (exc_type, exc_value, exc_traceback) = sys.exc_info()
@@ -74,6 +80,45 @@ def doQuery(theQuery, theRRtype):
         l.logError('Failed to query %s of zone %s (NoNameservers)' % (theRRtype, repr(theQuery)))
         raise
 
+def negativeTTL(exc):       # TTL of negative answer from SOA in authority section
+    responses = []
+    try:
+        if isinstance(exc, dns.resolver.NXDOMAIN):
+            responses = list(exc.responses().values())
+        elif 'response' in exc.kwargs and exc.kwargs['response']:
+            responses = [exc.kwargs['response']]
+    except (AttributeError, KeyError):
+        pass
+    for response in responses:
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return min(rrset.ttl, rrset[0].minimum)
+    return conf.DNS_CACHE_NEGATIVE_TTL
+
+def doCachedQuery(theQuery, theRRtype): # like doQuery, but return list of rdata texts from/via persistent cache
+    c = cache.DnsCache()
+    (hit, value) = c.get(theQuery, theRRtype)
+    if hit:
+        return value
+    try:
+        answer = transport.resolve(DSKM.key.master_resolver, theQuery, theRRtype)
+    except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN) as e:
+        l.logDebug('doCachedQuery(): Query: %s failed with %s' % (theQuery, type(e)))
+        c.put(theQuery, theRRtype, None, negativeTTL(e))
+        return None
+    except (KeyError):
+        l.logDebug('doCachedQuery(): Query: %s failed with KeyError' % (theQuery, ))
+        return None
+    except (dns.exception.Timeout):
+        l.logError('Failed to query %s of zone %s (Timeout)' % (theRRtype, repr(theQuery)))
+        raise
+    except (dns.resolver.NoNameservers):
+        l.logError('Failed to query %s of zone %s (NoNameservers)' % (theRRtype, repr(theQuery)))
+        raise
+    value = [rdata.to_text() for rdata in answer]
+    c.put(theQuery, theRRtype, value, answer.rrset.ttl)
+    return value
+
 def authNS(theZone):        # return list of NS addresses, authoritative for theZone
     global auth_NS
     
@@ -86,24 +131,34 @@ def authNS(theZone):        # return list of NS addresses, authoritative for the
     a1 = None
     while len(ll) > 1:
     	n = dns.name.Name(ll)
-    	a1 = doQuery(n, 'NS')
+    	a1 = doCachedQuery(n, 'NS')
     	if a1:
     		break
     	del(ll[0])
     if a1:
-        for ns in a1:
-            a2 = doQuery(ns.target, 'A')
+        for target in a1:
+            a2 = doCachedQuery(target, 'A')
             if a2:
-                nslist.append(a2[0].address)
-            a2 = doQuery(ns.target, 'AAAA')
+                nslist.append(a2[0])
+            a2 = doCachedQuery(target, 'AAAA')
             if a2:
-                nslist.append(a2[0].address)
+                nslist.append(a2[0])
         auth_NS[theZone] = nslist
         return nslist
-    l.logWarn("Unable to find NS of zone %s (or it's parent" % (repr(theQuery)))
+    l.logWarn("Unable to find NS of zone %s (or it's parent" % (repr(theZone)))
     e = AbortedZone("")
     raise e
 
+def scanZoneDirs():        # (re)build list of zone directories, children before parents
+    global zone_dirs
+    zone_dirs[:] = []
+    for entry in os.scandir(conf.ROOT_PATH):   # type from directory entry: no stat per zone
+        if not entry.name.startswith('.') and entry.is_dir():
+            zone_dirs.append(entry.name)
+    zone_dirs.sort(key = len)
+    zone_dirs.reverse()
+    return zone_dirs
+
 def authResolver(theZone):        # return a resolver bound to NS addresses, authoritative for theZone
     global auth_resolver
     if theZone in auth_resolver:
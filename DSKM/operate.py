@@ -31,6 +31,11 @@ import DSKM.logger as logger
 import DSKM.registrar as reg
 import DSKM.zone as zone
 import DSKM.misc as misc
+import DSKM.outbox as outbox
+import DSKM.scheduler as scheduler
+import DSKM.statestore as statestore
+import DSKM.transactions as transactions
+import DSKM.watcher as watcher
 
 def execute_from_command_line():
 
@@ -47,25 +52,25 @@ def execute_from_command_line():
     
     if opts.registrar_status or opts.query_status or \
             opts.purge_all_registrar_completion_info:
-        cl = reg.getResultList(opts.query_status)
-        if not cl:
-            l.logError('Failed')
-            return 1
+        transactions.sync(opts.refresh)
+        if opts.query_status:
+            cl = transactions.detail(opts.query_status)
+            if not cl:
+                l.logError('Failed')
+                return 1
+            for k in sorted(cl.keys()):
+                print('%s:\t%s' % (k, cl[k]))
+            return 0
+        selected = transactions.mirror().select(zone_name=opts.zone, state=opts.state)
         if opts.purge_all_registrar_completion_info:
-            for line in cl['result']:
-                if len(line) < 10: continue
-                tid = line.split(' ')[1]
-                if reg.deleteResult(tid):
-                    print('.', end='', flush=true)
+            n = transactions.purge(selected, lambda: print('.', end='', flush=True))
             print()
-        elif opts.registrar_status:
-            print('- timestamp -- ---------- Tracking-Id --------- Proc-ID  --- task ---  domain    result')
-            for line in cl['result']:
-                print(line)
+            l.logVerbose('Purged %d of %d transactions' % (n, len(selected)))
         else:
-            for k in sorted(cl.keys()):
-                if k != 'result':
-                    print('%s:\t%s' % (k, cl[k]))
+            print('- timestamp -- ---------- Tracking-Id --------- Proc-ID  --- task ---  domain    result')
+            for t in selected:
+                print('%s %s %s %s %s %s' % (t['timestamp'], t['tracking_id'], t['proc_id'],
+                                             t['task'], t['domain'], t['state']))
         return 0
     
     if not root.exists:
@@ -77,12 +82,21 @@ def execute_from_command_line():
     l.logVerbose('Scanning ' + root)
     
     root.cd()
-    root = path('.')
-    for dir in root.list('*'):
-        if dir.is_dir:
-            misc.zone_dirs.append(dir.name)
-    misc.zone_dirs.sort(key = len)
-    misc.zone_dirs.reverse()
+    misc.scanZoneDirs()
+    
+    if opts.import_state or opts.export_state:
+        if conf.STATE_STORE == 'files':
+            l.logError('STATE_STORE is "files"; nothing to import or export')
+            return 1
+        if opts.import_state:
+            statestore.importState(misc.zone_dirs)
+            changes = watcher.ChangeLog()
+            changes.forget(misc.zone_dirs)
+            changes.save()
+        else:
+            statestore.exportState(misc.zone_dirs)
+        return 0
+    statestore.store().preload()
     
     if opts.stopSigningOfZone:
         zone_name = opts.stopSigningOfZone
@@ -91,6 +105,11 @@ def execute_from_command_line():
             try:
                 z = zone.managedZone(zone_name)
                 res1 = z.stopSigning(opts.force)
+                changes = watcher.ChangeLog()   # state changed out of sight of skip index
+                changes.forget([zone_name])
+                changes.save()
+                zone.updateParents()
+                outbox.drain()
                 print('[Set dnssec-secure-to-insecure to yes in zone config of named.conf]')
                 print('[Do "cd <zone_dir>; rm *.jbk *.jnl *.signed ; sleep 1 ; rndc stop ; rndc start"]')
                 print('[...repeat until no DNSKEYs and RRSIGs remain in zone]')
@@ -127,16 +146,24 @@ def execute_from_command_line():
             except misc.CompletedZone:
                 pass
         return 0
-    for zone_name in misc.zone_dirs:
-        try:
-            misc.zones[zone_name] = zone.managedZone(zone_name)
-            if not misc.zones[zone_name].verifySerial(): continue
-            misc.zones[zone_name].performStateTransition()
-            misc.zones[zone_name].validate()
-        except misc.AbortedZone as a:
-            print(a.data)
-            print('%Skipping zone ' + zone_name)
-        except misc.CompletedZone:
-            pass
+    if opts.validate:
+        if opts.zone and opts.zone not in misc.zone_dirs:
+            print('?%s not a managed zone.' % opts.zone)
+            return 1
+        zone_names = [opts.zone] if opts.zone else misc.zone_dirs
+        failed = scheduler.validateZones(zone_names, opts.jobs)
+        l.mailErrors()
+        return 1 if failed else 0
+    if opts.daemon:
+        scheduler.runDaemon(opts.jobs)
+    changes = watcher.ChangeLog()
+    now = time.time()
+    if opts.all_zones:
+        zone_names = misc.zone_dirs
+    else:                               # skip zones waiting for a point in time
+        zone_names = [zone_name for zone_name in misc.zone_dirs if not changes.skippable(zone_name, now)]
+    l.logVerbose('Skipping %d of %d zones, waiting for a point in time' % (len(misc.zone_dirs) - len(zone_names), len(misc.zone_dirs)))
+    results = scheduler.runZones(zone_names, opts.jobs)
+    scheduler.recordResults(changes, zone_names, results)
     l.mailErrors()
     
\ No newline at end of file
@@ -0,0 +1,235 @@
+"""
+ DSKM DNSsec Key Management
+
+ Copyright (c) 2012-2019 Axel Rau, axel.rau@chaos1.de
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -----------------------------------------
+outbox.py - durable queue of DS submissions to registrars
+
+A state transition, which changes the DS set at the parent, only queues
+the new DS set (one entry per zone, a newer set replaces an older one).
+drain() sends due entries after all zones have been worked on, over a
+pool of sessions per registrar, limited by REGISTRAR_LIMITS, and retries
+failures with exponential backoff. The result is written back to the
+state of the zone (pending_submission, submitted_fingerprint).
+If the state of a zone is reset, forget() drops its queued DS set; a
+queued removal of all DS is still sent, but no longer written back.
+"""
+
+import concurrent.futures
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+
+# -----------------------------------------
+
+import DSKM.logger as logger
+l = logger.Logger()
+
+import DSKM.registrar as reg
+import DSKM.statestore as statestore
+
+# -----------------------------------------
+# Configurables
+# -----------------------------------------
+import DSKM.config as conf
+#------------------------------------------------------------------------------
+
+default_limits = {'interval': 1,        # seconds between requests
+                  'burst': 50,          # max requests per drain
+                  'sessions': 1}        # max concurrent requests (sessions)
+
+#--------------------------
+#   functions
+#--------------------------
+
+def limits(registrar):
+    lim = dict(default_limits)
+    lim.update(conf.REGISTRAR_LIMITS.get(registrar, {}))
+    return lim
+
+def load():                             # zone name -> entry
+    try:
+        with open(conf.OUTBOX_FILE, 'r') as fd:
+            return json.load(fd)
+    except IOError:                     # nothing queued yet
+        return {}
+    except ValueError:
+        l.logError('Garbage found in registrar outbox %s' % (conf.OUTBOX_FILE,))
+        return {}
+
+def update(change):                     # apply change(entries) to outbox under lock
+    with open(conf.OUTBOX_FILE + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)    # worker processes may enqueue concurrently
+        entries = load()
+        result = change(entries)
+        tmp_name = conf.OUTBOX_FILE + '.tmp'
+        with open(tmp_name, 'w') as fd:
+            json.dump(entries, fd, indent=8)
+        os.replace(tmp_name, conf.OUTBOX_FILE)
+    return result
+
+def enqueue(zone, args, fingerprint):   # queue DS set of zone (empty: remove all DS)
+    now = time.time()
+    entry = {'Registrar': zone.pcfg['Registrar'],
+             'args': args,
+             'Keys': list(zone.pstat['submitted_to_parent']),
+             'fingerprint': fingerprint,
+             'queued': now,
+             'attempts': 0,
+             'next_try': now}
+    def change(entries):
+        entries[zone.name] = entry
+    try:
+        update(change)
+    except IOError:
+        (exc_type, exc_value, exc_traceback) = sys.exc_info()
+        l.logError("Can't queue DS submission of %s, because %s" % (zone.name, exc_value))
+        return False
+    l.logVerbose('DS submission of %s (keys %s) queued for registrar %s' %
+                    (zone.name, repr(entry['Keys']), entry['Registrar']))
+    return True
+
+def forget(zone_name):                  # state of zone reset: drop queued DS set; removal sent without feedback
+    def change(entries):
+        if zone_name not in entries:
+            return
+        if entries[zone_name]['args']:
+            del entries[zone_name]
+        else:                           # DS must go nevertheless
+            entries[zone_name]['detached'] = True
+    try:
+        update(change)
+    except IOError:
+        (exc_type, exc_value, exc_traceback) = sys.exc_info()
+        l.logError("Can't drop queued DS submission of %s, because %s" % (zone_name, exc_value))
+
+def queued(zone_name):
+    return zone_name in load()
+
+def feedBack(zone_name, entry, res):    # write result of submission to state of zone
+    store = statestore.store()
+    try:
+        pstat = store.load(zone_name, 'state')
+        if res.get('pending'):          # completion is looked up by next run of zone
+            pstat['pending_submission'] = {'Registrar': entry['Registrar'],
+                                           'Tracking-Id': res['Tracking-Id'],
+                                           'Submitted': int(time.time()),
+                                           'Keys': entry['Keys']}
+        else:
+            pstat.pop('pending_submission', None)
+        pstat['submitted_fingerprint'] = entry['fingerprint']
+        store.save(zone_name, 'state', pstat)
+    except (IOError, ValueError):
+        (exc_type, exc_value, exc_traceback) = sys.exc_info()
+        l.logError("Can't update state of %s after DS submission, because %s" % (zone_name, exc_value))
+
+def send(pacer, zone_name, entry):      # runs in thread of registrar's session pool
+    pacer.wait()
+    return reg.submitDS(zone_name, entry['Registrar'], entry['args'])
+
+def drain():                            # send due entries, at most burst per registrar; names of zones sent
+    entries = load()
+    if len(entries) == 0:
+        return []
+    now = time.time()
+    due = {}                            # registrar -> zone names, oldest first
+    for zone_name in sorted(entries, key=lambda z: entries[z]['queued']):
+        entry = entries[zone_name]
+        zone_names = due.setdefault(entry['Registrar'], [])
+        if entry['next_try'] <= now and len(zone_names) < limits(entry['Registrar'])['burst']:
+            zone_names.append(zone_name)
+    
+    pools = []
+    futures = {}                        # future -> zone name
+    for registrar in due:               # registrars in parallel, each with own limits
+        lim = limits(registrar)
+        pacer = Pacer(lim['interval'])
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, lim['sessions']))
+        pools.append(pool)
+        for zone_name in due[registrar]:
+            futures[pool.submit(send, pacer, zone_name, entries[zone_name])] = zone_name
+    
+    done = {}                           # zone name -> entry sent
+    failed = {}                         # zone name -> entry with new backoff
+    for f in concurrent.futures.as_completed(futures):
+        zone_name = futures[f]
+        entry = entries[zone_name]
+        registrar = entry['Registrar']
+        try:
+            res = f.result()
+        except Exception:
+            (exc_type, exc_value, exc_traceback) = sys.exc_info()
+            l.logError('DS submission of %s to registrar %s failed, because %s (%s)' %
+                            (zone_name, registrar, exc_value, exc_type))
+            res = None
+        if res:
+            l.logVerbose('DS submission of %s (keys %s) sent to registrar %s' %
+                            (zone_name, repr(entry['Keys']), registrar))
+            if not entry.get('detached'):
+                feedBack(zone_name, entry, res) # state store is used by main thread only
+            done[zone_name] = entry
+        else:
+            entry['attempts'] += 1
+            backoff = min(conf.OUTBOX_BACKOFF_MIN * 2 ** (entry['attempts'] - 1), conf.OUTBOX_BACKOFF_MAX)
+            entry['next_try'] = time.time() + backoff
+            msg = 'DS submission of %s to registrar %s failed %d time(s); retrying in %d seconds' % (
+                    zone_name, registrar, entry['attempts'], backoff)
+            if entry['attempts'] >= conf.OUTBOX_WARN_ATTEMPTS:
+                l.logError(msg)
+            else:
+                l.logWarn(msg)
+            failed[zone_name] = entry
+    for pool in pools:
+        pool.shutdown()
+    
+    def change(entries):                # keep entries, queued again meanwhile
+        for zone_name in done:
+            if zone_name in entries and entries[zone_name]['queued'] == done[zone_name]['queued']:
+                del entries[zone_name]
+        for zone_name in failed:        # keep detached flag, set by forget() meanwhile
+            if zone_name in entries and entries[zone_name]['queued'] == failed[zone_name]['queued']:
+                entries[zone_name]['attempts'] = failed[zone_name]['attempts']
+                entries[zone_name]['next_try'] = failed[zone_name]['next_try']
+    try:
+        update(change)
+    except IOError:
+        (exc_type, exc_value, exc_traceback) = sys.exc_info()
+        l.logError("Can't update registrar outbox, because %s" % (exc_value,))
+    return [zone_name for zone_name in done if not done[zone_name].get('detached')]  # state written by feedBack
+
+#--------------------------
+#   classes
+#--------------------------
+
+class Pacer(object):
+    """Spaces requests of all sessions to one registrar by interval seconds"""
+    
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_slot = 0
+        self.lock = threading.Lock()
+    
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
@@ -0,0 +1,221 @@
+"""
+ DSKM DNSsec Key Management
+
+ Copyright (c) 2012-2019 Axel Rau, axel.rau@chaos1.de
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -----------------------------------------
+probe.py - asyncio DNS probe engine
+
+All DNS probes, needed by the state checks of one zone, are sent at once,
+so one zone costs about one round trip instead of the sum of all round trips
+and timeouts. Probes, whose responses are truncated, are repeated by TCP,
+all probes of one server pipelined over its pooled connection (transport.py).
+The results are the apex snapshot of the zone: one query with DO bit for
+SOA, DNSKEY and DS per server, fetched once per run (managedZone.snapshot())
+and used by serial check, state checks and validation.
+"""
+
+import asyncio
+import socket
+import sys
+import time
+
+import dns.asyncquery, dns.exception, dns.flags, dns.message, dns.name
+import dns.query, dns.rcode, dns.rdataclass, dns.rdatatype, dns.resolver
+
+# -----------------------------------------
+
+import DSKM.logger as logger
+l = logger.Logger()
+
+import DSKM.health as health
+import DSKM.key as dnsKey
+import DSKM.misc as misc
+import DSKM.transport as transport
+
+# -----------------------------------------
+# Configurables
+# -----------------------------------------
+import DSKM.config as conf
+#------------------------------------------------------------------------------
+
+#--------------------------
+#   classes
+#--------------------------
+
+class ProbeResults(object):
+    """Responses of all probes of one zone, keyed by (server, qname, rdtype)"""
+
+    def __init__(self, results):
+        self.results = results
+
+    def __contains__(self, probe):
+        return probeKey(*probe) in self.results
+
+    def response(self, server, qname, rdtype):  # response message or raise exception of probe
+        res = self.results[probeKey(server, qname, rdtype)]
+        if isinstance(res, (dns.query.UnexpectedSource, dns.query.BadResponse, EOFError)):
+            raise dns.exception.Timeout()   # no usable response: callers handle it like a timeout
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def firstAnswer(self, servers, qname, rdtype):  # answer like a resolver, bound to servers
+        rdtype = dns.rdatatype.from_text(rdtype) if isinstance(rdtype, str) else rdtype
+        for server in health.scoreboard().order(servers):  # fastest healthy first
+            try:
+                response = self.response(server, qname, rdtype)
+            except (socket.error, dns.exception.Timeout, dns.query.UnexpectedSource,
+                    dns.exception.FormError, EOFError, KeyError):
+                continue                # failed or not probed
+            rcode = response.rcode()
+            if rcode == dns.rcode.NXDOMAIN:
+                raise dns.resolver.NXDOMAIN()
+            if rcode != dns.rcode.NOERROR:
+                continue                # SERVFAIL, REFUSED: try next server
+            qn = dns.name.from_text(qname) if isinstance(qname, str) else qname
+            answer = dns.resolver.Answer(qn, rdtype, dns.rdataclass.IN, response, server)
+            if answer.rrset is None:
+                raise dns.resolver.NoAnswer(response=response)
+            return answer
+        raise dns.exception.Timeout()   # none of the servers answered
+
+
+#--------------------------
+#   functions
+#--------------------------
+
+def probeKey(server, qname, rdtype):
+    if isinstance(rdtype, str):
+        rdtype = dns.rdatatype.from_text(rdtype)
+    return (server, str(qname).rstrip('.').lower(), rdtype)
+
+def nameServers(name):                  # auth NS of name; none, if not found: master probes go on
+    try:
+        return misc.authNS(name)
+    except (misc.AbortedZone, dns.exception.DNSException):
+        (exc_type, exc_value, exc_traceback) = sys.exc_info()
+        l.logDebug('No probes at NS of %s, because they were not found (%s)' % (name, repr(exc_value)))
+        return []
+
+def needsDS(state):                     # check or action of KSK state looks up DS at parent?
+    if not 0 <= state < len(dnsKey.SigningKey.KSTT):
+        return False
+    t = dnsKey.SigningKey.KSTT[state]
+    return 'ds' in t['ca'] or t.get('a') is dnsKey.SigningKey.submit_ds    # submit_ds: parentHasDS
+
+def zoneProbes(zone):                   # list of (server, qname, rdtype) needed by state checks of zone
+    probes = []
+    def add(server, qname, rdtype):
+        probes.append((server, qname, rdtype))
+
+    if zone.pcfg['Registrar'] == 'Local':   # server, used for inclusion tests
+        ns = conf.master[0]
+    else:
+        ns = conf.external_secondaries[-2]
+    add(ns, zone.name, dns.rdatatype.DNSKEY)    # KSK chain
+    add(ns, zone.name, dns.rdatatype.SOA)       # ZSK chain
+    add(conf.master[0], zone.name, dns.rdatatype.DNSKEY)    # test_if_deleted
+    add(conf.master[0], zone.name, dns.rdatatype.SOA)       # verifySerial, zone loaded?
+    state = zone.pstat['ksk']['State']
+    if zone.pcfg['Registrar'] != 'Local':   # NS looked up only in states, which need them
+        if needsDS(state):              # DS at parent
+            for server in nameServers(zone.parent):
+                add(server, zone.name, dns.rdatatype.DS)
+        if 3 <= state <= dnsKey.SigningKey.ksk_state_max:   # nsAliveTest of validate
+            for server in nameServers(zone.name):
+                add(server, zone.name, dns.rdatatype.SOA)
+    elif zone.parent_dir:
+        for server in conf.master:
+            add(server, zone.name, dns.rdatatype.DS)
+    return probes
+
+async def probeOne(server, qname, rdtype, timeout, half_open):
+    board = health.scoreboard()
+    if not board.available(server) and not half_open:   # circuit open: don't wait for it
+        l.logDebug('Probe of %s %s at %s skipped (failed recently)' % (qname, dns.rdatatype.to_text(rdtype), server))
+        return dns.exception.Timeout()
+    if timeout is None:
+        timeout = board.timeout(server)
+    q = dns.message.make_query(qname, rdtype, want_dnssec=True, payload=4096)
+    start = time.time()
+    try:
+        response = await dns.asyncquery.udp(q, server, timeout)   # if truncated, repeated by probeAll
+    except (socket.error, dns.exception.Timeout, dns.query.UnexpectedSource,
+            dns.exception.FormError, EOFError) as e:
+        l.logDebug('Probe of %s %s at %s failed with %s' %
+                        (qname, dns.rdatatype.to_text(rdtype), server, repr(e)))
+        return e
+    board.success(server, time.time() - start)
+    return response
+
+def repeatByTCP(server, probes, timeout):   # responses of probes of server, pipelined over pooled TCP
+    l.logDebug('%d responses of %s truncated; repeating by TCP' % (len(probes), server))
+    requests = [dns.message.make_query(qname, rdtype, want_dnssec=True, payload=4096)
+                    for (server, qname, rdtype) in probes]
+    if timeout is None:
+        timeout = health.scoreboard().timeout(server)
+    try:
+        return transport.pipeline(requests, server, timeout)
+    except (socket.error, dns.exception.Timeout, dns.query.BadResponse,
+            dns.exception.FormError, EOFError) as e:
+        l.logDebug('TCP probes at %s failed with %s' % (server, repr(e)))
+        return [e] * len(probes)
+
+async def probeAll(probes, timeout):
+    asked = {}                          # (qname, rdtype) -> servers asked for it
+    for (server, qname, rdtype) in probes:
+        asked.setdefault((qname, rdtype), []).append(server)
+    half_open = dict((k, health.scoreboard().halfOpen(asked[k])) for k in asked)
+    responses = await asyncio.gather(*[probeOne(server, qname, rdtype, timeout, half_open[(qname, rdtype)])
+                                        for (server, qname, rdtype) in probes])
+    truncated = {}                      # server -> indices of its truncated responses
+    for (i, res) in enumerate(responses):
+        if isinstance(res, dns.message.Message) and res.flags & dns.flags.TC:
+            truncated.setdefault(probes[i][0], []).append(i)
+    loop = asyncio.get_running_loop()
+    servers = list(truncated)
+    repeated = await asyncio.gather(*[loop.run_in_executor(None, repeatByTCP, server,
+                                        [probes[i] for i in truncated[server]], timeout) for server in servers])
+    for (server, results) in zip(servers, repeated):
+        for (i, res) in zip(truncated[server], results):
+            responses[i] = res
+    return responses
+
+def probe(probes, timeout=None):        # send all probes at once and return ProbeResults; timeout None: per server
+    keys = []
+    for p in probes:
+        k = probeKey(*p)
+        if k not in keys:
+            keys.append(k)
+    loop = asyncio.new_event_loop()
+    try:
+        responses = loop.run_until_complete(probeAll(keys, timeout))
+    finally:
+        loop.run_until_complete(loop.shutdown_default_executor())   # threads of TCP probes
+        loop.close()
+    results = dict(zip(keys, responses))
+    failed = {}                         # server -> all its probes failed? counted once per zone
+    for (k, res) in results.items():
+        failed[k[0]] = failed.get(k[0], True) and isinstance(res, (socket.error, dns.exception.Timeout, EOFError))
+    for server in failed:
+        if failed[server] and health.scoreboard().available(server):   # else skipped, not failed
+            health.scoreboard().failure(server)
+    l.logDebug('Sent %d probes in parallel' % (len(probes),))
+    return ProbeResults(results)
+
+def probeZone(zone):
+    return probe(zoneProbes(zone))
@@ -18,10 +18,20 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # -----------------------------------------
 registrar.py - common registrar functions
+
+Each registrar is served by a backend (a subclass of Backend), which is
+looked up by the name in the zone config ('Registrar') and imported on
+first use. Built in are Joker, Ripe and 'by hand'. Further backends are
+found by the entry point group DSKM.registrars of installed packages or
+by REGISTRAR_BACKENDS in the config file, both as 'module:class'.
 """
 
 # -----------------------------------------
+import abc
+import concurrent.futures
 import http.client
+import importlib
+import threading
 import time
 import urllib.parse
 
@@ -32,10 +42,21 @@ import sys
 # Globals
 # -----------------------------------------
 theConnection = None
+theBackends = {}                        # registrar name -> backend instance
+theSpecs = None                         # registrar name -> 'module:class'
+theViews = {}                           # registrar name -> {zone name: set of DS tuples}, prefetched
+theStatuses = {}                        # registrar name -> {Tracking-Id: status}, prefetched
+backendsLock = threading.Lock()
+ENTRY_POINT_GROUP = 'DSKM.registrars'
+builtin_backends = {'Joker': 'DSKM.REG.joker:JokerBackend',
+                    'Ripe': 'DSKM.REG.ripe:RipeBackend',
+                    'by hand': 'DSKM.registrar:ByHandBackend'}
 # -----------------------------------------
 
 import DSKM.logger as logger
 l = logger.Logger()
+
+import DSKM.statestore as statestore
 # -----------------------------------------
 
 
@@ -43,8 +64,6 @@ l = logger.Logger()
 # Configurables
 # -----------------------------------------
 import DSKM.config as conf
-import DSKM.REG.joker as reg_joker
-import DSKM.REG.ripe as reg_ripe
 
 #------------------------------------------------------------------------------
 
@@ -52,47 +71,142 @@ import DSKM.REG.ripe as reg_ripe
 # Functions
 # -----------------------------------------
 def regRemoveAllDS(zone):
-    zone_name = zone.name
-    if zone.pcfg['Registrar'] == 'Joker':
-        return reg_joker.regRemoveAllDS(zone_name)
-    elif zone.pcfg['Registrar'] == 'Ripe':
-        return reg_ripe.regRemoveAllDS(zone_name)
-    elif zone.pcfg['Registrar'] == 'by hand':
-        return handOverByEmail(zone_name, [], str('Deletion of DS-RR of zone %s required' % zone_name))
-    else:
-        l.logError('Internal inconsistency: Unknown registrar "%s" in config' % (zone.pcfg['Registrar']))
-    return None
+    return submitDS(zone.name, zone.pcfg['Registrar'], [])
     
 def regAddDS(zone, args):
-    zone_name = zone.name
-    if zone.pcfg['Registrar'] == 'Joker':
-        return reg_joker.regAddDS(zone_name, args)
-    elif zone.pcfg['Registrar'] == 'Ripe':
-        return reg_ripe.regAddDS(zone_name, args, False, False)
-    elif zone.pcfg['Registrar'] == 'by hand':
-        return handOverByEmail(zone_name, args, str('DS-RR handover to parent of zone %s required' % zone_name))
-    else:
-        l.logError('Internal inconsistency: Unknown registrar "%s" in config' % (zone.pcfg['Registrar']))
-    return None
+    return submitDS(zone.name, zone.pcfg['Registrar'], args)
+
+def submitDS(zone_name, registrar, args):   # submit DS set; remove all DS if args empty
+    b = backend(registrar)
+    if not b:
+        l.logError('Internal inconsistency: Unknown registrar "%s" in config' % (registrar))
+        return None
+    return b.submit(zone_name, args)
+
+def submissionStatus(zone, pending):    # 'done', 'failed', 'queued' or 'pending'
+    if not pending.get('Tracking-Id'):  # not yet sent
+        return 'queued'
+    status = theStatuses.get(pending['Registrar'], {}).get(pending['Tracking-Id'])
+    if status:                          # prefetched for all zones at once; inherited by workers
+        return status
+    b = backend(pending['Registrar'])
+    if not b:
+        return 'failed'
+    return b.poll([pending['Tracking-Id']]).get(pending['Tracking-Id'], 'pending')
+
+def pollStatuses(registrar, handles):   # Tracking-Id -> 'done', 'failed' or 'pending'
+    b = backend(registrar)
+    if not b:
+        return {}
+    return b.poll(handles)
 
-def getResultList(rid):
-    return reg_joker.getResultList(rid)
-    l.logWarn('No resultlists at Ripe')
+def fetchCurrent(registrar, zone_names):    # zone name -> set of DS tuples, as seen by registrar
+    b = backend(registrar)
+    if not b:
+        return {}
+    return b.fetch_current(zone_names)
 
-def deleteResult(transactionID):
-    return reg_joker.deleteResult(transactionID)
-    l.logWarn("Can't delete result info at Ripe")
+def prefetch(zone_names):               # bulk fetch of DS sets and completion of submissions, before zone loop
+    by_registrar = {}                   # registrar name -> zone names
+    pending = {}                        # registrar name -> Tracking-Ids of pending submissions
+    store = statestore.store()
+    for zone_name in zone_names:
+        try:
+            registrar = store.load(zone_name, 'config').get('Registrar')
+        except (IOError, ValueError):   # new zone
+            continue
+        if registrar and registrar != 'Local' and known(registrar):
+            by_registrar.setdefault(registrar, []).append(zone_name)
+            try:
+                submission = store.load(zone_name, 'state').get('pending_submission')
+            except (IOError, ValueError):
+                submission = None
+            if submission and submission.get('Tracking-Id'):
+                pending.setdefault(submission['Registrar'], []).append(submission['Tracking-Id'])
+    theViews.clear()
+    theStatuses.clear()
+    if not by_registrar:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(by_registrar)) as pool:
+        futures = dict((pool.submit(fetchCurrent, registrar, by_registrar[registrar]), registrar)
+                            for registrar in by_registrar)
+        polls = dict((pool.submit(pollStatuses, registrar, pending[registrar]), registrar)
+                            for registrar in pending)
+        for f in concurrent.futures.as_completed(futures):
+            registrar = futures[f]
+            try:
+                theViews[registrar] = f.result()
+            except Exception:
+                (exc_type, exc_value, exc_traceback) = sys.exc_info()
+                l.logWarn("Can't prefetch DS-RRs from registrar %s, because %s" % (registrar, exc_value))
+                continue
+            l.logDebug('Prefetched DS-RRs of %d of %d zones from registrar %s' %
+                        (len(theViews[registrar]), len(by_registrar[registrar]), registrar))
+        for f in concurrent.futures.as_completed(polls):
+            registrar = polls[f]
+            try:
+                theStatuses[registrar] = f.result()
+            except Exception:
+                (exc_type, exc_value, exc_traceback) = sys.exc_info()
+                l.logWarn("Can't look up completion of DS submissions at registrar %s, because %s" %
+                            (registrar, exc_value))
+                continue
+            l.logDebug('Looked up completion of %d DS submissions at registrar %s' %
+                        (len(pending[registrar]), registrar))
+
+def currentDS(registrar, zone_name):    # prefetched set of DS tuples of zone at registrar; None if unknown
+    return theViews.get(registrar, {}).get(zone_name)
 
 def regTest(zone, dry_run):
-    zone_name = zone.name
-    if zone.pcfg['Registrar'] == 'Joker':
-        ##return reg_joker.regTest(zone_name, dry_run)
+    b = backend(zone.pcfg['Registrar'])
+    if not b:
         return
-    elif zone.pcfg['Registrar'] == 'Ripe':
-        args = zone.argsForDSsubmission()
-        return reg_ripe.regAddDS(zone_name, args, True, dry_run)
+    return b.test(zone.name, zone.argsForDSsubmission(), dry_run)
+
+#--------------------------
+#   backend registry
+#--------------------------
+
+def entryPoints():                      # registrar name -> 'module:class' of installed plugins
+    try:
+        import importlib.metadata as metadata
+    except ImportError:                 # python < 3.8
+        return {}
+    eps = metadata.entry_points()
+    if hasattr(eps, 'select'):
+        eps = eps.select(group=ENTRY_POINT_GROUP)
     else:
-        return
+        eps = eps.get(ENTRY_POINT_GROUP, [])
+    return dict((ep.name, ep.value) for ep in eps)
+
+def backendSpecs():                     # registrar name -> 'module:class', config overrides plugins and builtins
+    global theSpecs
+    if theSpecs is None:
+        specs = dict(builtin_backends)
+        specs.update(entryPoints())
+        specs.update(conf.REGISTRAR_BACKENDS)
+        theSpecs = specs
+    return theSpecs
+
+def known(registrar):                   # valid value of 'Registrar' in zone config?
+    return registrar == 'Local' or registrar in backendSpecs()
+
+def backend(registrar):                 # backend instance of registrar, imported on first use; None if unknown
+    with backendsLock:
+        if registrar in theBackends:
+            return theBackends[registrar]
+        spec = backendSpecs().get(registrar)
+        if not spec:
+            return None
+        (module_name, x, class_name) = spec.partition(':')
+        try:
+            cls = getattr(importlib.import_module(module_name), class_name)
+            theBackends[registrar] = cls()
+        except (ImportError, AttributeError, TypeError):  # TypeError: plugin without submit()
+            (exc_type, exc_value, exc_traceback) = sys.exc_info()
+            l.logError("Can't load backend %s of registrar %s, because %s" % (spec, registrar, exc_value))
+            return None
+        return theBackends[registrar]
 
 def handOverByEmail(zone_name, args, subject):
     body = ''
@@ -117,3 +231,46 @@ Any pairs, missing at parent, must be added.\n'''
     body = body + str('\nEnd of message ----------------------------------\n')
     l.sendMail(subject, body)
     return {'TID': 'E-Mail sent'}
+
+#--------------------------
+#   classes
+#--------------------------
+
+class Backend(abc.ABC):
+    """Interface of a registrar backend. Handles are Tracking-Ids of submissions.
+       Methods may be called from several threads at once (see REGISTRAR_LIMITS)."""
+    
+    @abc.abstractmethod
+    def submit(self, zone_name, ds_set):    # ds_set: list of args (empty: remove all DS)
+        """Return dict with 'TID' (and 'Tracking-Id' and 'pending', if completion
+           must be polled) or None on failure."""
+    
+    def poll(self, handles):            # handle -> 'done', 'failed' or 'pending'
+        return dict((handle, 'done') for handle in handles)     # completed synchronously
+    
+    def fetch_current(self, zone_names):    # zone name -> set of DS tuples at registrar
+        return {}                       # not supported: caller asks DNS
+    
+    def test(self, zone_name, ds_set, dry_run):
+        l.logVerbose('Registrar of %s does not support test submissions' % (zone_name,))
+    
+    has_transactions = False            # result list of transactions available?
+    
+    def transactions(self):             # list of dicts with Tracking-Id, Proc-ID, task, domain, state, timestamp
+        return None                     # no result list
+    
+    def retrieve(self, transactionID):  # dict with details of transaction or None
+        return None
+    
+    def deleteResult(self, transactionID):
+        l.logWarn("Can't delete result info at this registrar")
+        return None
+
+
+class ByHandBackend(Backend):
+    """DS-RR handed over to parent by human on behalf of an email"""
+    
+    def submit(self, zone_name, ds_set):
+        if len(ds_set) == 0:
+            return handOverByEmail(zone_name, [], str('Deletion of DS-RR of zone %s required' % zone_name))
+        return handOverByEmail(zone_name, ds_set, str('DS-RR handover to parent of zone %s required' % zone_name))
@@ -0,0 +1,286 @@
+"""
+ DSKM DNSsec Key Management
+
+ Copyright (c) 2012-2019 Axel Rau, axel.rau@chaos1.de
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -----------------------------------------
+scheduler.py - run zones one after another, on a pool of worker processes
+                or as daemon, driven by the next due time of each zone
+
+A child zone with a local parent edits the parent's <child>.ds file and
+bumps the parent's serial. Therefore a parent is started only after all
+its local children have completed; all other zones run independently.
+Worker processes are forked, because zone and key code change the
+current directory of the process.
+"""
+
+import concurrent.futures
+from datetime import datetime
+import heapq
+import multiprocessing
+import sys
+import time
+
+# -----------------------------------------
+
+import DSKM.logger as logger
+l = logger.Logger()
+
+import DSKM.cache as cache
+import DSKM.health as health
+import DSKM.misc as misc
+import DSKM.outbox as outbox
+import DSKM.registrar as reg
+import DSKM.statestore as statestore
+import DSKM.watcher as watcher
+import DSKM.zone as zone
+
+# -----------------------------------------
+# Configurables
+# -----------------------------------------
+import DSKM.config as conf
+#------------------------------------------------------------------------------
+
+#--------------------------
+#   functions
+#--------------------------
+
+def doZone(zone_name, cron=None):      # one run of the state machine of one zone
+    result = {'due': None, 'states': None, 'completed': False}
+    if cron is not None:
+        l.setCron(cron)
+    try:
+        misc.zones[zone_name] = zone.managedZone(zone_name)
+        z = misc.zones[zone_name]
+        if z.verifySerial():
+            z.performStateTransition()
+            z.validate()
+        result['due'] = z.nextEvent()
+        result['states'] = (z.pstat['ksk']['State'], z.pstat['zsk']['State'])
+    except misc.AbortedZone as a:
+        print(a.data)
+        print('%Skipping zone ' + zone_name)
+    except misc.CompletedZone:
+        result['completed'] = True
+    if cron is not None:                # daemon: inputs as left by this run
+        result['signature'] = watcher.zoneSignature(zone_name)
+    return result
+
+def zoneWorker(zone_name, cron=None):   # runs doZone in worker process
+    l.collect()                         # drop texts inherited from parent process
+    misc.parents_to_update.clear()
+    result = doZone(zone_name, cron)
+    cache.DnsCache().save()
+    health.scoreboard().save()
+    return {'log': l.collect(), 'parents': dict(misc.parents_to_update), 'zone': result}
+
+def runZones(zone_names, jobs=1, cron=None):    # run all zones, at most jobs in parallel; cron given by daemon only
+    results = {}                        # zone name -> result of doZone
+    daemon = cron is not None           # signatures of inputs needed?
+    if cron is None:
+        cron = {}
+    reg.prefetch(zone_names)            # DS-RRs and completion of submissions at registrars; inherited by workers
+    if jobs <= 1:
+        for zone_name in zone_names:
+            results[zone_name] = doZone(zone_name, cron.get(zone_name))
+        cache.DnsCache().save()
+        health.scoreboard().save()
+        finishRun(results, daemon)
+        return results
+
+    parents = {}                        # zone name -> name of local parent
+    waiting_for = {}                    # zone name -> set of local children not yet done
+    for zone_name in zone_names:
+        waiting_for[zone_name] = set()
+    for zone_name in zone_names:
+        (parent, parent_dir) = zone.localParent(zone_name)
+        if parent_dir and parent in waiting_for:
+            parents[zone_name] = parent
+            waiting_for[parent].add(zone_name)
+
+    l.logVerbose('Running %d zones with %d jobs' % (len(zone_names), jobs))
+    pending = list(zone_names)          # preserve order of zone_dirs
+    running = {}                        # future -> zone name
+    ctx = multiprocessing.get_context('fork')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=ctx) as pool:
+        while pending or running:
+            for zone_name in pending[:]:
+                if len(running) >= jobs:
+                    break
+                if len(waiting_for[zone_name]) > 0:
+                    continue            # local children still running
+                pending.remove(zone_name)
+                running[pool.submit(zoneWorker, zone_name, cron.get(zone_name))] = zone_name
+            (done, not_done) = concurrent.futures.wait(running,
+                                return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                zone_name = running.pop(f)
+                try:
+                    result = f.result()
+                    l.merge(result['log'])
+                    misc.parents_to_update.update(result['parents'])
+                    results[zone_name] = result['zone']
+                except (Exception, SystemExit):
+                    (exc_type, exc_value, exc_traceback) = sys.exc_info()
+                    l.logError('Worker of zone %s failed, because %s (%s)' % (zone_name, exc_value, exc_type))
+                if zone_name in parents:
+                    waiting_for[parents[zone_name]].discard(zone_name)
+    health.scoreboard().save()          # take scoreboards of workers for next run
+    statestore.store().preload()        # workers saved new state; outbox feedback must not overwrite it
+    finishRun(results, daemon)          # registrar requests from parent process only
+    return results
+
+def finishRun(results, daemon=False):   # update local parents and send outbox after all zones
+    updated = list(misc.parents_to_update)
+    zone.updateParents()
+    sent = outbox.drain()
+    if not daemon:
+        return
+    for zone_name in set(updated) | set(sent):  # inputs changed by us after their zone run
+        results.setdefault(zone_name, {'due': None, 'states': None, 'completed': False})['signature'] = \
+                                                    watcher.zoneSignature(zone_name)
+
+def validateZones(zone_names, jobs=1): # validate chain of trust of zones as batch; number of failed zones
+    zones = []
+    for zone_name in zone_names:        # zone objects are made in main thread: they change directory
+        try:
+            z = zone.managedZone(zone_name)
+        except misc.AbortedZone as a:
+            print(a.data)
+            print('%Skipping zone ' + zone_name)
+            continue
+        except misc.CompletedZone:
+            continue
+        if z.chainExpected():
+            zones.append(z)
+    l.logVerbose('Validating %d of %d zones' % (len(zones), len(zone_names)))
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for ok in pool.map(zone.managedZone.validateChain, zones):
+            if not ok:
+                failed += 1
+    cache.DnsCache().save()             # keep verified DNSKEYs of parents
+    health.scoreboard().save()
+    l.logVerbose('%d of %d zones failed validation' % (failed, len(zones)))
+    return failed
+
+def recordResults(changes, zone_names, results):  # update change log and skip index
+    now = time.time()
+    for zone_name in zone_names:
+        result = results.get(zone_name, {'due': None, 'completed': False})
+        not_before = None               # run again next time
+        if result['completed']:         # unsigned zone
+            not_before = now + conf.SKIP_MAX
+        elif result['due'] is not None: # waiting for a point in time
+            not_before = min(result['due'], now + conf.SKIP_MAX)
+        changes.record(zone_name, not_before)
+    changes.save()
+
+def runDaemon(jobs=1):                  # run each zone when its next state transition is due
+    heap = []                           # (due time, zone name)
+    due = {}                            # zone name -> due time of its valid heap entry
+    poll = {}                           # zone name -> current poll interval
+    states = {}                         # zone name -> (KSK state, ZSK state) after last run
+    counted = {}                        # zone name -> time of last run, which counted as retry
+    next_scan = 0
+    changes = watcher.ChangeLog()
+    w = watcher.watcher()
+
+    def schedule(zone_name, t):
+        due[zone_name] = t
+        heapq.heappush(heap, (t, zone_name))
+
+    l.logVerbose('Running as daemon')
+    while True:
+        now = time.time()
+        if now >= next_scan:            # look for new and removed zones
+            misc.scanZoneDirs()
+            for zone_name in misc.zone_dirs:
+                if zone_name not in due:
+                    if changes.skippable(zone_name, now):   # known from previous runs
+                        schedule(zone_name, changes.entries[zone_name]['not_before'])
+                    else:
+                        schedule(zone_name, now)
+            for zone_name in list(due):
+                if zone_name not in misc.zone_dirs:
+                    del due[zone_name]
+            w.watchZones(misc.zone_dirs)
+            next_scan = now + conf.DAEMON_RESCAN
+        
+        batch = []
+        while heap and heap[0][0] <= now:
+            (t, zone_name) = heapq.heappop(heap)
+            if due.get(zone_name) == t:     # else superseded or removed
+                del due[zone_name]
+                batch.append(zone_name)
+        if len(batch) == 0:
+            wake = next_scan
+            if heap:
+                wake = min(wake, heap[0][0])
+            l.logDebug('Sleeping until %s' % (datetime.fromtimestamp(wake).isoformat(),))
+            (rescan, dirty) = w.changes(max(1, wake - now))
+            if rescan:
+                next_scan = 0
+            for zone_name in dirty:     # inputs changed: run now
+                if zone_name in due:
+                    l.logVerbose('Inputs of %s changed' % (zone_name,))
+                    schedule(zone_name, time.time())
+            continue
+        
+        batch = [zone_name for zone_name in misc.zone_dirs if zone_name in batch]  # children first
+        cron = {}                       # count a run as retry only once per cron interval
+        for zone_name in batch:
+            cron[zone_name] = now - counted.get(zone_name, 0) >= 24 * 3600 / conf.CRON_FREQ
+            if cron[zone_name]:
+                counted[zone_name] = now
+        misc.auth_NS.clear()            # may be outdated since last cycle
+        misc.auth_resolver.clear()
+        statestore.store().preload()    # worker processes may have changed state
+        results = runZones(batch, jobs, cron)
+        (rescan, dirty) = w.changes(0)  # events of our own run and of edits meanwhile
+        if rescan:
+            next_scan = 0
+        if isinstance(w, watcher.PollingWatcher):
+            w.watchZones(misc.zone_dirs)
+        recordResults(changes, batch, results)
+        
+        now = time.time()
+        for zone_name in batch:
+            result = results.get(zone_name, {'due': None, 'states': None, 'completed': False})
+            if result['completed']:     # unsigned zone: check at next rescan
+                t = now + conf.DAEMON_RESCAN
+            elif result['due'] is not None:
+                t = max(result['due'], now + 60)
+                poll.pop(zone_name, None)
+            else:                       # waiting for propagation: poll with backoff
+                if zone_name not in poll or result['states'] != states.get(zone_name):
+                    poll[zone_name] = conf.DAEMON_POLL_MIN
+                else:
+                    poll[zone_name] = min(2 * poll[zone_name], conf.DAEMON_POLL_MAX)
+                t = now + poll[zone_name]
+            states[zone_name] = result['states']
+            l.logDebug('Next run of %s at %s' % (zone_name, datetime.fromtimestamp(t).isoformat()))
+            schedule(zone_name, t)
+        for zone_name in dirty:         # inputs changed by others since (or while not) running the zone
+            if zone_name in results and results[zone_name].get('signature') == watcher.zoneSignature(zone_name):
+                continue                # only our own changes
+            if zone_name in due:
+                l.logVerbose('Inputs of %s changed' % (zone_name,))
+                schedule(zone_name, time.time())
+        
+        l.setCron(True)                 # mail errors of this cycle
+        l.mailErrors()
+        l.collect()
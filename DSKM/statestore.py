@@ -0,0 +1,186 @@
+"""
+ DSKM DNSsec Key Management
+
+ Copyright (c) 2012-2019 Axel Rau, axel.rau@chaos1.de
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -----------------------------------------
+statestore.py - storage of zone config, zone state and key meta data
+
+FileStore keeps config and state in the JSON files dnssec-conf-<zone> and
+dnssec-stat-<zone> of each zone directory (the classic layout).
+SqliteStore keeps all of them in one SQLite database (WAL mode), loads all
+zones in one query and caches key meta data.
+"""
+
+import json
+import os
+import sqlite3
+import sys
+
+# -----------------------------------------
+
+import DSKM.logger as logger
+l = logger.Logger()
+
+# -----------------------------------------
+# Configurables
+# -----------------------------------------
+import DSKM.config as conf
+#------------------------------------------------------------------------------
+
+file_prefix = {'config': 'dnssec-conf-', 'state': 'dnssec-stat-'}
+
+theStore = None
+
+#--------------------------
+#   classes
+#--------------------------
+
+class FileStore(object):
+    """Config and state in JSON files per zone directory"""
+
+    def fileName(self, zone_name, kind):
+        return conf.ROOT_PATH + '/' + zone_name + '/' + file_prefix[kind] + zone_name
+
+    def describe(self, zone_name, kind):
+        return zone_name + '/' + file_prefix[kind] + zone_name
+
+    def load(self, zone_name, kind):    # raises IOError if missing, ValueError if garbled
+        with open(self.fileName(zone_name, kind)) as fd:
+            return json.load(fd)
+
+    def save(self, zone_name, kind, data):
+        with open(self.fileName(zone_name, kind), 'w') as fd:
+            json.dump(data, fd, indent=8)
+
+    def loadKey(self, zone_name, file_name, mtime):
+        return None                     # no key meta data cache
+
+    def saveKey(self, zone_name, file_name, mtime, data):
+        pass
+
+    def preload(self):
+        pass
+
+
+class SqliteStore(FileStore):
+    """Config, state and key meta data of all zones in one SQLite database"""
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.pid = None
+        self.db = None
+        self.rows = None                # (zone, kind) -> data, if preloaded
+
+    def conn(self):                     # one connection per (worker) process
+        if self.pid != os.getpid():
+            self.db = sqlite3.connect(self.db_name, timeout=60)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            with self.db:
+                self.db.execute('CREATE TABLE IF NOT EXISTS zone_data '
+                    '(zone TEXT, kind TEXT, data TEXT, PRIMARY KEY (zone, kind))')
+                self.db.execute('CREATE TABLE IF NOT EXISTS key_data '
+                    '(zone TEXT, file_name TEXT, mtime TEXT, data TEXT, PRIMARY KEY (zone, file_name))')
+            self.pid = os.getpid()
+        return self.db
+
+    def describe(self, zone_name, kind):
+        return '%s:%s/%s' % (self.db_name, zone_name, kind)
+
+    def preload(self):                  # load all zone data in one query
+        self.rows = {}
+        for (zone_name, kind, data) in self.conn().execute('SELECT zone, kind, data FROM zone_data'):
+            self.rows[(zone_name, kind)] = data
+        l.logDebug('Preloaded %d rows of zone data from %s' % (len(self.rows), self.db_name))
+
+    def load(self, zone_name, kind):
+        if self.rows is not None:
+            if (zone_name, kind) not in self.rows:
+                raise FileNotFoundError(self.describe(zone_name, kind))
+            return json.loads(self.rows[(zone_name, kind)])
+        row = self.conn().execute('SELECT data FROM zone_data WHERE zone=? AND kind=?',
+                                    (zone_name, kind)).fetchone()
+        if not row:
+            raise FileNotFoundError(self.describe(zone_name, kind))
+        return json.loads(row[0])
+
+    def save(self, zone_name, kind, data):
+        js = json.dumps(data)
+        try:
+            with self.conn():               # one transaction
+                self.conn().execute('INSERT OR REPLACE INTO zone_data (zone, kind, data) VALUES (?,?,?)',
+                                    (zone_name, kind, js))
+        except sqlite3.Error as e:
+            raise IOError(str(e))
+        if self.rows is not None:
+            self.rows[(zone_name, kind)] = js
+
+    def loadKey(self, zone_name, file_name, mtime):
+        row = self.conn().execute('SELECT data FROM key_data WHERE zone=? AND file_name=? AND mtime=?',
+                                    (zone_name, file_name, mtime)).fetchone()
+        if not row:
+            return None
+        return json.loads(row[0])
+
+    def saveKey(self, zone_name, file_name, mtime, data):
+        try:
+            with self.conn():
+                self.conn().execute('INSERT OR REPLACE INTO key_data (zone, file_name, mtime, data) VALUES (?,?,?,?)',
+                                    (zone_name, file_name, mtime, json.dumps(data)))
+        except sqlite3.Error as e:
+            l.logWarn("Can't cache meta data of key %s, because %s" % (file_name, e))
+
+
+#--------------------------
+#   functions
+#--------------------------
+
+def store():                            # the configured store
+    global theStore
+    if not theStore:
+        if conf.STATE_STORE == 'sqlite':
+            theStore = SqliteStore(conf.STATE_DB)
+        elif conf.STATE_STORE == 'files':
+            theStore = FileStore()
+        else:
+            l.logError('Configuration error: STATE_STORE must be "files" or "sqlite"')
+            sys.exit(1)
+    return theStore
+
+def exportState(zone_names):            # copy zone config/state from store to JSON files
+    s = store()
+    files = FileStore()
+    for zone_name in zone_names:
+        for kind in ('config', 'state'):
+            try:
+                files.save(zone_name, kind, s.load(zone_name, kind))
+                l.logVerbose('Exported %s' % (files.describe(zone_name, kind),))
+            except (IOError, ValueError):
+                (exc_type, exc_value, exc_traceback) = sys.exc_info()
+                l.logWarn("Can't export %s, because %s" % (s.describe(zone_name, kind), exc_value))
+
+def importState(zone_names):            # copy zone config/state from JSON files to store
+    s = store()
+    files = FileStore()
+    for zone_name in zone_names:
+        for kind in ('config', 'state'):
+            try:
+                s.save(zone_name, kind, files.load(zone_name, kind))
+                l.logVerbose('Imported %s' % (files.describe(zone_name, kind),))
+            except (IOError, ValueError):
+                (exc_type, exc_value, exc_traceback) = sys.exc_info()
+                l.logWarn("Can't import %s, because %s" % (files.describe(zone_name, kind), exc_value))
@@ -0,0 +1,225 @@
+"""
+ DSKM DNSsec Key Management
+
+ Copyright (c) 2012-2019 Axel Rau, axel.rau@chaos1.de
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -----------------------------------------
+transactions.py - local mirror of registrar transactions (result lists)
+
+Mirror keeps Tracking-Id, Proc-ID, task, domain, state and timestamps of
+all transactions of registrars with result lists (Joker.com) in one
+SQLite database, indexed by domain and state. sync() fetches the result
+list of a registrar at most every TRANSACTION_MAX_AGE seconds and writes
+only new, changed and vanished transactions. Details of a transaction
+(result-retrieve) are kept, once it is completed.
+purge() deletes transactions at the registrar over a bounded pool of
+sessions.
+"""
+
+import concurrent.futures
+import json
+import os
+import sqlite3
+import sys
+import time
+
+# -----------------------------------------
+
+import DSKM.logger as logger
+l = logger.Logger()
+
+import DSKM.outbox as outbox
+import DSKM.registrar as reg
+
+# -----------------------------------------
+# Configurables
+# -----------------------------------------
+import DSKM.config as conf
+#------------------------------------------------------------------------------
+
+states = ('ack', 'nack', 'pending')     # 'pending': not yet completed
+columns = ('registrar', 'tracking_id', 'proc_id', 'task', 'domain', 'state', 'timestamp', 'first_seen', 'changed')
+
+theMirror = None
+
+#--------------------------
+#   classes
+#--------------------------
+
+class Mirror(object):
+    """Transactions of all registrars with result lists"""
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.pid = None
+        self.db = None
+
+    def conn(self):                     # one connection per process
+        if self.pid != os.getpid():
+            self.db = sqlite3.connect(self.db_name, timeout=60)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            with self.db:
+                self.db.execute('CREATE TABLE IF NOT EXISTS transactions '
+                    '(registrar TEXT, tracking_id TEXT, proc_id TEXT, task TEXT, domain TEXT, state TEXT, '
+                    'timestamp TEXT, first_seen REAL, changed REAL, detail TEXT, PRIMARY KEY (registrar, tracking_id))')
+                self.db.execute('CREATE INDEX IF NOT EXISTS transactions_domain ON transactions (domain)')
+                self.db.execute('CREATE INDEX IF NOT EXISTS transactions_state ON transactions (state)')
+                self.db.execute('CREATE TABLE IF NOT EXISTS syncs (registrar TEXT PRIMARY KEY, synced REAL)')
+            self.pid = os.getpid()
+        return self.db
+
+    def synced(self, registrar):        # time of last sync or 0
+        row = self.conn().execute('SELECT synced FROM syncs WHERE registrar=?', (registrar,)).fetchone()
+        return row[0] if row else 0
+
+    def sync(self, registrar, force=False):     # False if result list not available
+        now = time.time()
+        if not force and self.synced(registrar) > now - conf.TRANSACTION_MAX_AGE:
+            return True
+        rows = reg.backend(registrar).transactions()
+        if rows is None:
+            return False
+        known = dict(self.conn().execute('SELECT tracking_id, state FROM transactions WHERE registrar=?',
+                                            (registrar,)))
+        (added, changed) = (0, 0)
+        seen = set()
+        try:
+            with self.conn():           # one transaction
+                for row in rows:
+                    tid = row['Tracking-Id']
+                    seen.add(tid)
+                    if tid not in known:
+                        self.conn().execute('INSERT INTO transactions (registrar, tracking_id, proc_id, task, domain, '
+                            'state, timestamp, first_seen, changed) VALUES (?,?,?,?,?,?,?,?,?)',
+                            (registrar, tid, row['Proc-ID'], row['task'], row['domain'], row['state'],
+                             row['timestamp'], now, now))
+                        added += 1
+                    elif known[tid] != row['state']:
+                        self.conn().execute('UPDATE transactions SET state=?, changed=?, detail=NULL '
+                            'WHERE registrar=? AND tracking_id=?', (row['state'], now, registrar, tid))
+                        changed += 1
+                vanished = [(registrar, tid) for tid in known if tid not in seen]
+                self.conn().executemany('DELETE FROM transactions WHERE registrar=? AND tracking_id=?', vanished)
+                self.conn().execute('INSERT OR REPLACE INTO syncs (registrar, synced) VALUES (?,?)', (registrar, now))
+        except sqlite3.Error as e:
+            l.logError("Can't update transaction mirror %s, because %s" % (self.db_name, e))
+            return False
+        l.logDebug('Synced transactions of %s: %d new, %d changed, %d vanished' %
+                    (registrar, added, changed, len(vanished)))
+        return True
+
+    def select(self, registrar=None, zone_name=None, state=None):  # list of transactions, oldest first
+        conditions = []
+        values = []
+        for (column, value) in (('registrar', registrar), ('domain', zone_name), ('state', state)):
+            if value:
+                conditions.append(column + '=?')
+                values.append(value)
+        q = 'SELECT ' + ', '.join(columns) + ' FROM transactions'
+        if conditions:
+            q = q + ' WHERE ' + ' AND '.join(conditions)
+        return [dict(zip(columns, row)) for row in self.conn().execute(q + ' ORDER BY timestamp, tracking_id', values)]
+
+    def find(self, tracking_id):        # (registrar, state, detail or None) or None
+        row = self.conn().execute('SELECT registrar, state, detail FROM transactions WHERE tracking_id=?',
+                                    (tracking_id,)).fetchone()
+        if not row:
+            return None
+        return (row[0], row[1], json.loads(row[2]) if row[2] else None)
+
+    def setDetail(self, registrar, tracking_id, detail):
+        with self.conn():
+            self.conn().execute('UPDATE transactions SET detail=? WHERE registrar=? AND tracking_id=?',
+                                (json.dumps(detail), registrar, tracking_id))
+
+    def remove(self, registrar, tracking_ids):
+        with self.conn():
+            self.conn().executemany('DELETE FROM transactions WHERE registrar=? AND tracking_id=?',
+                                    [(registrar, tid) for tid in tracking_ids])
+
+
+#--------------------------
+#   functions
+#--------------------------
+
+def mirror():
+    global theMirror
+    if not theMirror:
+        theMirror = Mirror(conf.TRANSACTION_DB)
+    return theMirror
+
+def registrars():                       # configured registrars with result lists
+    return [name for name in sorted(conf.registrar)
+                    if reg.backend(name) and reg.backend(name).has_transactions]
+
+def sync(force=False):                  # sync mirror with all registrars; False if one failed
+    ok = True
+    for registrar in registrars():
+        if not mirror().sync(registrar, force):
+            l.logWarn('Result list of %s not available; showing transactions of %s' %
+                        (registrar, time.ctime(mirror().synced(registrar))))
+            ok = False
+    return ok
+
+def detail(tracking_id):                # result-retrieve of transaction, kept once completed
+    found = mirror().find(tracking_id)
+    if found and found[2]:
+        return found[2]
+    candidates = [found[0]] if found else registrars()
+    for registrar in candidates:
+        d = reg.backend(registrar).retrieve(tracking_id)
+        if d:
+            if found and found[1] != 'pending':
+                mirror().setDetail(registrar, tracking_id, d)
+            return d
+    return None
+
+def purge(transactions, progress=None):     # delete transactions at registrars; number deleted
+    deleted = 0
+    by_registrar = {}
+    for t in transactions:
+        by_registrar.setdefault(t['registrar'], []).append(t['tracking_id'])
+    for registrar in by_registrar:
+        b = reg.backend(registrar)
+        sessions = max(1, outbox.limits(registrar)['sessions'])
+        tids = iter(by_registrar[registrar])
+        done = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=sessions) as pool:
+            in_flight = {}              # future -> Tracking-Id, at most 2 per session
+            while True:
+                while len(in_flight) < 2 * sessions:
+                    tid = next(tids, None)
+                    if tid is None:
+                        break
+                    in_flight[pool.submit(b.deleteResult, tid)] = tid
+                if not in_flight:
+                    break
+                (finished, pending) = concurrent.futures.wait(in_flight,
+                                            return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in finished:
+                    tid = in_flight.pop(f)
+                    try:
+                        ok = f.result()
+                    except Exception:
+                        l.logWarn('Deleting %s at %s failed, because %s' % (tid, registrar, sys.exc_info()[1]))
+                        ok = None
+                    if ok:
+                        done.append(tid)
+                        if progress:
+                            progress()
+        mirror().remove(registrar, done)
+        deleted += len(done)
+    return deleted
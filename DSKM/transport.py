@@ -0,0 +1,283 @@
+"""
+ DSKM DNSsec Key Management
+
+ Copyright (c) 2012-2019 Axel Rau, axel.rau@chaos1.de
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -----------------------------------------
+transport.py - shared synchronous DNS transport
+
+query() sends a query by UDP with EDNS and repeats it by TCP only if the
+response is truncated. TCP connections are kept open, one per server and
+process, and announce EDNS TCP keepalive (RFC 7828). pipeline() sends
+several queries at once over such a connection (the probe engine repeats
+all truncated probes of one server this way); responses are matched by
+message id, so they may come in any order and late responses of timed out
+queries are skipped.
+resolve() answers like a dns.resolver.Resolver, bound to its servers.
+Timeouts, order of servers and skipping of failing servers come from the
+name server scoreboard (health.py), which query() keeps up to date.
+"""
+
+import copy
+import os
+import random
+import socket
+import struct
+import threading
+import time
+
+import dns.edns, dns.exception, dns.flags, dns.inet, dns.message, dns.name
+import dns.query, dns.rcode, dns.rdataclass, dns.rdatatype, dns.resolver
+
+# -----------------------------------------
+
+import DSKM.logger as logger
+l = logger.Logger()
+
+import DSKM.health as health
+
+# -----------------------------------------
+# Configurables
+# -----------------------------------------
+import DSKM.config as conf
+#------------------------------------------------------------------------------
+
+EDNS_TCP_KEEPALIVE = 11                 # option code of RFC 7828
+
+theTransport = None
+
+#--------------------------
+#   classes
+#--------------------------
+
+class Connection(object):
+    """Persistent TCP connection to one server"""
+
+    def __init__(self, server, port=53):
+        self.server = server
+        self.port = port
+        self.sock = None
+        self.buffer = b''
+        self.idle_timeout = conf.DNS_TCP_IDLE   # lowered by keepalive option of server
+        self.last_used = 0
+        self.lock = threading.Lock()
+
+    def open(self, timeout):
+        self.sock = socket.socket(dns.inet.af_for_address(self.server), socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self.sock.connect((self.server, self.port))
+        except socket.timeout:
+            self.close()
+            raise dns.exception.Timeout()
+        except OSError:
+            self.close()
+            raise
+        self.buffer = b''
+        self.idle_timeout = conf.DNS_TCP_IDLE
+        l.logDebug('Opened TCP connection to %s' % (self.server,))
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+
+    def usable(self):                   # open and not idle for too long?
+        return self.sock is not None and time.time() - self.last_used < self.idle_timeout
+
+    def exchange(self, requests, timeout):  # list of responses, in order of requests
+        with self.lock:
+            for attempt in (1, 2):      # 2nd attempt, if server closed a kept connection
+                reused = self.usable()
+                if not reused:
+                    self.close()
+                    self.open(timeout)
+                try:
+                    return self.sendAndReceive(requests, timeout)
+                except (EOFError, ConnectionError):
+                    self.close()
+                    if attempt == 2 or not reused:
+                        raise
+                    l.logDebug('TCP connection to %s closed by server; reopening' % (self.server,))
+                except Exception:
+                    self.close()        # stream out of sync
+                    raise
+
+    def sendAndReceive(self, requests, timeout):
+        ids = set()
+        wires = []
+        requests = [copy.copy(request) for request in requests]    # id and keepalive option: TCP only
+        for request in requests:
+            while request.id in ids:    # ids must be unique on one connection
+                request.id = random.randint(0, 65535)
+            ids.add(request.id)
+            announceKeepalive(request)
+            wire = request.to_wire()
+            wires.append(struct.pack('!H', len(wire)) + wire)
+        expiration = time.time() + timeout
+        self.sock.settimeout(timeout)
+        self.sock.sendall(b''.join(wires))  # all queries in one go
+        waiting = dict((request.id, i) for (i, request) in enumerate(requests))
+        responses = [None] * len(requests)
+        while waiting:
+            response = dns.message.from_wire(self.readMessage(expiration))
+            i = waiting.pop(response.id, None)
+            if i is None:
+                continue                # late response of an earlier, timed out query
+            if not requests[i].is_response(response):
+                raise dns.query.BadResponse()
+            responses[i] = response
+            self.keepalive(response)
+        self.last_used = time.time()
+        return responses
+
+    def readMessage(self, expiration):  # one length prefixed message
+        while True:
+            if len(self.buffer) >= 2:
+                length = struct.unpack('!H', self.buffer[:2])[0]
+                if len(self.buffer) >= 2 + length:
+                    wire = self.buffer[2:2 + length]
+                    self.buffer = self.buffer[2 + length:]
+                    return wire
+            remaining = expiration - time.time()
+            if remaining <= 0:
+                raise dns.exception.Timeout()
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(65535)
+            except socket.timeout:
+                raise dns.exception.Timeout()
+            if not data:
+                raise EOFError()
+            self.buffer = self.buffer + data
+
+    def keepalive(self, response):      # idle timeout announced by server (units of 100 ms)
+        for option in response.options:
+            if option.otype == EDNS_TCP_KEEPALIVE:
+                data = option.to_wire()
+                if len(data) == 2:
+                    self.idle_timeout = min(conf.DNS_TCP_IDLE, struct.unpack('!H', data)[0] / 10.0)
+
+
+class Transport(object):
+    """Pool of TCP connections of this process, one per server"""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.connections = {}           # (server, port) -> Connection
+        self.lock = threading.Lock()
+
+    def connection(self, server, port=53):
+        with self.lock:
+            if self.pid != os.getpid(): # forked worker: don't share sockets with parent
+                self.connections = {}
+                self.pid = os.getpid()
+            if (server, port) not in self.connections:
+                self.connections[(server, port)] = Connection(server, port)
+            return self.connections[(server, port)]
+
+    def close(self):
+        with self.lock:
+            for c in self.connections.values():
+                c.close()
+            self.connections = {}
+
+
+#--------------------------
+#   functions
+#--------------------------
+
+def transport():
+    global theTransport
+    if not theTransport:
+        theTransport = Transport()
+    return theTransport
+
+def announceKeepalive(request):         # add EDNS TCP keepalive option to request
+    if request.edns < 0:
+        request.use_edns(0, 0, 4096)
+    for option in request.options:
+        if option.otype == EDNS_TCP_KEEPALIVE:
+            return
+    request.use_edns(request.edns, request.ednsflags, request.payload,
+                     options=list(request.options) + [dns.edns.GenericOption(EDNS_TCP_KEEPALIVE, b'')])
+
+def query(request, server, timeout=None, half_open=False):  # UDP first, TCP (pooled) only if truncated
+    board = health.scoreboard()
+    if not board.available(server) and not half_open:   # circuit open: fail at once
+        l.logDebug('Skipping %s (failed recently)' % (server,))
+        raise dns.exception.Timeout()
+    if timeout is None:
+        timeout = board.timeout(server)
+    if request.edns < 0:
+        request.use_edns(0, 0, 4096)
+    start = time.time()
+    try:
+        response = dns.query.udp(request, server, timeout, ignore_unexpected=True)
+        if response.flags & dns.flags.TC:
+            l.logDebug('Response of %s truncated; repeating query by TCP' % (server,))
+            response = tcp(request, server, timeout)
+    except (socket.error, dns.exception.Timeout, EOFError):
+        board.failure(server)
+        raise
+    board.success(server, time.time() - start)
+    return response
+
+def pipeline(requests, server, timeout=None):  # queries at once over pooled TCP connection; responses in order
+    if timeout is None:
+        timeout = conf.NS_TIMEOUT
+    return transport().connection(server).exchange(requests, timeout)
+
+def tcp(request, server, timeout=None): # one query over pooled TCP connection
+    return pipeline([request], server, timeout)[0]
+
+def resolve(resolver, qname, rdtype):   # like resolver.query(qname, rdtype), bound to its name servers
+    if isinstance(qname, str):
+        qname = dns.name.from_text(qname)
+    if isinstance(rdtype, str):
+        rdtype = dns.rdatatype.from_text(rdtype)
+    request = dns.message.make_query(qname, rdtype, use_edns=max(0, resolver.edns),
+                                     ednsflags=resolver.ednsflags, payload=max(resolver.payload, 1232))
+    expiration = time.time() + resolver.lifetime
+    timed_out = True                    # all servers timed out?
+    board = health.scoreboard()
+    half_open = board.halfOpen(resolver.nameservers)
+    for server in board.order(resolver.nameservers):    # fastest healthy first
+        remaining = expiration - time.time()
+        if remaining <= 0:
+            break
+        try:
+            response = query(request, server, min(board.timeout(server), resolver.timeout, remaining), half_open)
+        except dns.exception.Timeout:
+            continue
+        except (socket.error, dns.query.UnexpectedSource, dns.query.BadResponse,
+                dns.exception.FormError, EOFError):
+            timed_out = False
+            continue
+        rcode = response.rcode()
+        if rcode == dns.rcode.NXDOMAIN:
+            raise dns.resolver.NXDOMAIN(qnames=[qname], responses={qname: response})
+        if rcode != dns.rcode.NOERROR:
+            timed_out = False
+            continue                    # SERVFAIL, REFUSED: try next server
+        answer = dns.resolver.Answer(qname, rdtype, dns.rdataclass.IN, response, str(server))
+        if answer.rrset is None:
+            raise dns.resolver.NoAnswer(response=response)
+        return answer
+    if timed_out:
+        raise dns.exception.Timeout()
+    raise dns.resolver.NoNameservers(request=request, errors=[])
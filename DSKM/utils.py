@@ -62,6 +62,17 @@ parser.add_option('--purge_all_registrar_completion_info', '-p', action='store_t
 parser.add_option('--query_status', '-q', action='store',
                    help='Give detailed registrar result status about <request-id>.'),
 
+parser.add_option('--zone', action='store',
+                   help='Show or purge only registrar requests of this zone (with -r or -p) or validate only this zone (with -V).')
+
+parser.add_option('--state', action='store', choices=['ack', 'nack', 'pending'],
+                   help='Show or purge only registrar requests in this state: ack, nack or pending (with -r or -p).')
+
+parser.add_option('--refresh', action='store_true',
+                   default=False,
+                   help=('Fetch result lists from registrars, even if the local copy is younger '
+                        'than TRANSACTION_MAX_AGE (with -r, -q or -p).'))
+
 parser.add_option('--test_registrar_DS_submission', '-t', action='store_true',
                    default=False,
                    help='Delete and re-submit current DS-RR to registrar.')
@@ -71,6 +82,36 @@ parser.add_option('--dry-run', '-n', dest='dry_run', action='store_true',
                    help=('Do not really change any data at registrar with '
                         '--test_registrar_DS_submission.')),
 
+parser.add_option('--validate', '-V', action='store_true',
+                   default=False,
+                   help=('Validate chain of trust from parent of all zones (or of --zone) '
+                        'locally, with --jobs in parallel, and terminate.'))
+
+parser.add_option('--daemon', '-D', action='store_true',
+                   default=False,
+                   help=('Run forever: work on each zone when its next state transition is due '
+                        'and poll zones, waiting for propagation, with backoff.'))
+
+parser.add_option('--all_zones', '-a', action='store_true',
+                   default=False,
+                   help=('Work on all zones, even those with unchanged inputs, '
+                        'which are waiting for a point in time (ignore skip index).'))
+
+parser.add_option('--import_state', action='store_true',
+                   default=False,
+                   help=('Copy config and state of all zones from the dnssec-conf-* and '
+                        'dnssec-stat-* files into the state data base and terminate.'))
+
+parser.add_option('--export_state', action='store_true',
+                   default=False,
+                   help=('Copy config and state of all zones from the state data base '
+                        'into dnssec-conf-* and dnssec-stat-* files and terminate.'))
+
+parser.add_option('--jobs', '-j', action='store', type='int',
+                   default=1,
+                   help=('Number of zones to work on in parallel. '
+                        'A zone is never worked on together with its local parent.'))
+
 parser.add_option('--debug', '-d', action='store_true',
                    default=False,
                    help='Turn on debugging.'),
@@ -0,0 +1,281 @@
+"""
+ DSKM DNSsec Key Management
+
+ Copyright (c) 2012-2019 Axel Rau, axel.rau@chaos1.de
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -----------------------------------------
+watcher.py - notice changes of zone directories and their input files
+
+Inputs of a zone are its config and state files, its key files (written
+by dnssec-keygen or BIND), its zone file and the .ds files of its children.
+ChangeLog persists names and mtimes of all inputs per zone between runs,
+together with the skip index: the point in time, before which a zone with
+unchanged inputs needs no run.
+InotifyWatcher (Linux) and PollingWatcher (elsewhere) tell a long running
+process (--daemon), which zones changed while it waited.
+"""
+
+import ctypes
+import ctypes.util
+import fcntl
+import fnmatch
+import hashlib
+import json
+import os
+import select
+import struct
+import sys
+import time
+
+# -----------------------------------------
+
+import DSKM.logger as logger
+l = logger.Logger()
+
+# -----------------------------------------
+# Configurables
+# -----------------------------------------
+import DSKM.config as conf
+#------------------------------------------------------------------------------
+
+input_patterns = ('dnssec-conf-*', 'dnssec-stat-*', 'K*.key', 'K*.private', '*.zone', '*.ds')
+
+# inotify event masks from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+event_header = struct.Struct('iIII')    # wd, mask, cookie, len
+
+#--------------------------
+#   functions
+#--------------------------
+
+def isInput(file_name):
+    for pattern in input_patterns:
+        if fnmatch.fnmatch(file_name, pattern):
+            return True
+    return False
+
+def zoneSignature(zone_name):           # digest of names and mtimes of all inputs of zone
+    zone_path = conf.ROOT_PATH + '/' + zone_name
+    h = hashlib.sha1()
+    try:
+        for file_name in sorted(os.listdir(zone_path)):
+            if isInput(file_name):
+                st = os.stat(zone_path + '/' + file_name)
+                h.update(('%s %d %d\n' % (file_name, st.st_mtime_ns, st.st_size)).encode())
+    except OSError:                     # zone directory removed
+        return None
+    return h.hexdigest()
+
+def watcher():                          # best watcher of this platform
+    try:
+        return InotifyWatcher()
+    except (AttributeError, OSError):   # no inotify in libc or no more instances
+        (exc_type, exc_value, exc_traceback) = sys.exc_info()
+        l.logDebug('No inotify (%s), polling zone directories' % (exc_value,))
+        return PollingWatcher()
+
+#--------------------------
+#   classes
+#--------------------------
+
+class ChangeLog(object):
+    """Inputs of zones after their last run and skip index, persisted between runs"""
+
+    def __init__(self):
+        self.entries = self.load()      # zone name -> {'dir': mtime, 'files': {name: [mtime, size]},
+        self.forgotten = set()          #               'not_before': time or None}
+        self.dirty = False
+
+    def load(self):
+        if not conf.CHANGE_LOG:
+            return {}
+        try:
+            with open(conf.CHANGE_LOG, 'r') as fd:
+                entries = json.load(fd)
+        except IOError:                 # first run
+            return {}
+        except ValueError:
+            l.logWarn('Ignoring garbled change log %s' % (conf.CHANGE_LOG,))
+            return {}
+        for zone_name in list(entries):
+            if not isinstance(entries[zone_name], dict) or 'files' not in entries[zone_name]:
+                del entries[zone_name]  # written by older version
+        return entries
+
+    def unchanged(self, zone_name):     # inputs unchanged since last run? (stat only, no listing)
+        if zone_name not in self.entries:
+            return False
+        entry = self.entries[zone_name]
+        zone_path = conf.ROOT_PATH + '/' + zone_name
+        try:
+            if os.stat(zone_path).st_mtime_ns != entry['dir']:
+                return False            # file created, removed or renamed
+            for file_name in entry['files']:
+                st = os.stat(zone_path + '/' + file_name)
+                if [st.st_mtime_ns, st.st_size] != entry['files'][file_name]:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def changedZones(self, zone_names): # zones, which are new or whose inputs changed since last run
+        return set(zone_name for zone_name in zone_names if not self.unchanged(zone_name))
+
+    def skippable(self, zone_name, now):    # zone waiting for a point in time with unchanged inputs?
+        if zone_name not in self.entries:
+            return False
+        not_before = self.entries[zone_name].get('not_before')
+        return not_before is not None and now < not_before and self.unchanged(zone_name)
+
+    def record(self, zone_name, not_before=None):   # remember inputs of zone just worked on
+        zone_path = conf.ROOT_PATH + '/' + zone_name
+        files = {}
+        try:
+            dir_mtime = os.stat(zone_path).st_mtime_ns
+            for file_name in os.listdir(zone_path):
+                if isInput(file_name):
+                    st = os.stat(zone_path + '/' + file_name)
+                    files[file_name] = [st.st_mtime_ns, st.st_size]
+        except OSError:                 # zone directory removed
+            return
+        self.entries[zone_name] = {'dir': dir_mtime, 'files': files, 'not_before': not_before}
+        self.forgotten.discard(zone_name)
+        self.dirty = True
+
+    def forget(self, zone_names):       # inputs changed out of sight (e.g. imported state)
+        for zone_name in zone_names:
+            self.entries.pop(zone_name, None)
+            self.forgotten.add(zone_name)
+        self.dirty = True
+
+    def save(self):                     # merge our entries into change log file
+        if not conf.CHANGE_LOG or not self.dirty:
+            return
+        try:
+            with open(conf.CHANGE_LOG + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                entries = self.load()
+                entries.update(self.entries)
+                for zone_name in list(entries):
+                    if zone_name in self.forgotten or not os.path.isdir(conf.ROOT_PATH + '/' + zone_name):
+                        del entries[zone_name]
+                tmp_name = conf.CHANGE_LOG + '.tmp'
+                with open(tmp_name, 'w') as fd:
+                    json.dump(entries, fd)
+                os.replace(tmp_name, conf.CHANGE_LOG)
+        except IOError:
+            (exc_type, exc_value, exc_traceback) = sys.exc_info()
+            l.logWarn("Can't save change log, because %s" % (exc_value))
+            return
+        self.entries = entries
+        self.forgotten = set()
+        self.dirty = False
+
+
+class PollingWatcher(object):
+    """Compare signatures of zone directories every DAEMON_WATCH_INTERVAL seconds"""
+
+    def __init__(self):
+        self.root_mtime = None
+        self.signatures = {}
+
+    def watchZones(self, zone_names):
+        self.root_mtime = os.stat(conf.ROOT_PATH).st_mtime_ns
+        self.signatures = {}
+        for zone_name in zone_names:
+            self.signatures[zone_name] = zoneSignature(zone_name)
+
+    def changes(self, timeout):         # wait up to timeout seconds, return (rescan, dirty zones)
+        end = time.time() + timeout
+        while True:
+            rescan = os.stat(conf.ROOT_PATH).st_mtime_ns != self.root_mtime
+            dirty = set()
+            for zone_name in self.signatures:
+                signature = zoneSignature(zone_name)
+                if signature != self.signatures[zone_name]:
+                    self.signatures[zone_name] = signature
+                    dirty.add(zone_name)
+            if rescan or dirty or time.time() >= end:
+                return (rescan, dirty)
+            time.sleep(max(0, min(conf.DAEMON_WATCH_INTERVAL, end - time.time())))
+
+
+class InotifyWatcher(object):
+    """Kernel events of ROOT_PATH and all zone directories (Linux only)"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.add_watch = libc.inotify_add_watch     # raises AttributeError if not Linux
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.watches = {}               # watch descriptor -> zone name ('' for ROOT_PATH)
+        self.watch('', IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+
+    def watch(self, zone_name, mask):
+        dir_name = conf.ROOT_PATH + ('/' + zone_name if zone_name else '')
+        wd = self.add_watch(self.fd, os.fsencode(dir_name), mask)
+        if wd < 0:
+            l.logWarn("Can't watch %s, because %s" % (dir_name, os.strerror(ctypes.get_errno())))
+            return
+        self.watches[wd] = zone_name
+
+    def watchZones(self, zone_names):   # idempotent: kernel returns same wd for same directory
+        for zone_name in zone_names:
+            self.watch(zone_name, IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_CREATE |
+                                    IN_DELETE | IN_ATTRIB | IN_DELETE_SELF)
+
+    def changes(self, timeout):         # wait up to timeout seconds, return (rescan, dirty zones)
+        rescan = False
+        dirty = set()
+        (readable, w, x) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return (rescan, dirty)
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return (rescan, dirty)
+        i = 0
+        while i + event_header.size <= len(buf):
+            (wd, mask, cookie, length) = event_header.unpack_from(buf, i)
+            name = buf[i + event_header.size:i + event_header.size + length].rstrip(b'\0')
+            i += event_header.size + length
+            if mask & IN_Q_OVERFLOW:    # lost events: treat everything as changed
+                rescan = True
+                dirty.update(z for z in self.watches.values() if z)
+                continue
+            if wd not in self.watches:
+                continue
+            zone_name = self.watches[wd]
+            if mask & IN_IGNORED:       # directory removed
+                del self.watches[wd]
+                continue
+            if zone_name == '':
+                if mask & IN_ISDIR:
+                    rescan = True
+            elif isInput(os.fsdecode(name)):
+                dirty.add(zone_name)
+        return (rescan, dirty)
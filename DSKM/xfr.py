@@ -0,0 +1,137 @@
+"""
+ DSKM DNSsec Key Management
+
+ Copyright (c) 2012-2019 Axel Rau, axel.rau@chaos1.de
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# -----------------------------------------
+xfr.py - local copies of signed zones, kept current by zone transfer
+
+With ZONE_TRANSFER, each zone is copied once per run from the server,
+which state checks of its keys ask (master for local zones, else a
+secondary): IXFR from the serial of the copy in ZONE_COPY_DIR, AXFR if
+there is no copy or IXFR fails. Inclusion, exclusion and deletion checks
+of KSK and ZSK are then answered from the copy.
+"""
+
+import os
+import socket
+import sys
+
+import dns.dnssec, dns.exception, dns.name, dns.query, dns.rdatatype, dns.xfr, dns.zone
+
+# -----------------------------------------
+
+import DSKM.logger as logger
+l = logger.Logger()
+
+# -----------------------------------------
+# Configurables
+# -----------------------------------------
+import DSKM.config as conf
+#------------------------------------------------------------------------------
+
+xfr_errors = (dns.exception.DNSException, socket.error, EOFError)
+
+#--------------------------
+#   classes
+#--------------------------
+
+class ZoneCopy(object):
+    """Local copy of one zone, updated by IXFR (AXFR, if needed)"""
+
+    def __init__(self, zone_name, server):
+        self.name = zone_name
+        self.server = server
+        self.origin = dns.name.from_text(zone_name)
+        self.file_name = os.path.join(conf.ZONE_COPY_DIR, zone_name)
+        self.zone = None
+
+    def load(self):                     # copy of previous run, if any
+        try:
+            self.zone = dns.zone.from_file(self.file_name, self.origin, relativize=False)
+        except (IOError, dns.exception.DNSException):
+            self.zone = None
+
+    def save(self):
+        tmp_name = self.file_name + '.tmp'
+        self.zone.to_file(tmp_name, relativize=False)
+        os.replace(tmp_name, self.file_name)
+
+    def serial(self):
+        soa = self.zone.get_rdataset(self.origin, dns.rdatatype.SOA) if self.zone else None
+        return soa[0].serial if soa else None
+
+    def transfer(self):                 # bring copy up to date; raises one of xfr_errors
+        if self.zone is not None and self.serial() is not None:
+            serial = self.serial()
+            try:
+                (query, x) = dns.xfr.make_query(self.zone)
+                dns.query.inbound_xfr(self.server, self.zone, query,
+                                        timeout=conf.NS_TIMEOUT, lifetime=conf.XFR_LIFETIME)
+                l.logDebug('IXFR of %s from %s: serial %d -> %d' % (self.name, self.server, serial, self.serial()))
+                return
+            except xfr_errors:
+                (exc_type, exc_value, exc_traceback) = sys.exc_info()
+                l.logDebug('IXFR of %s from %s failed (%s); trying AXFR' % (self.name, self.server, exc_value))
+        zone = dns.zone.Zone(self.origin, relativize=False)
+        dns.query.inbound_xfr(self.server, zone, timeout=conf.NS_TIMEOUT, lifetime=conf.XFR_LIFETIME)
+        self.zone = zone
+        l.logDebug('AXFR of %s from %s: serial %d' % (self.name, self.server, self.serial()))
+
+    def rrsigs(self, covers):           # RRSIGs at apex, covering type covers
+        rds = self.zone.get_rdataset(self.origin, dns.rdatatype.RRSIG, covers)
+        return list(rds) if rds else []
+
+    def keytags(self):                  # key tags of DNSKEY RRset
+        rds = self.zone.get_rdataset(self.origin, dns.rdatatype.DNSKEY)
+        return [dns.dnssec.key_id(rdata) for rdata in rds] if rds else []
+
+    def signers(self):                  # covered type -> key tags of RRSIGs, in whole zone
+        signed = {}
+        for (name, rds) in self.zone.iterate_rdatasets():
+            if rds.rdtype != dns.rdatatype.RRSIG:
+                continue
+            for rrsig in rds:
+                signed.setdefault(dns.rdatatype.to_text(rrsig.type_covered), set()).add(rrsig.key_tag)
+        return signed
+
+
+#--------------------------
+#   functions
+#--------------------------
+
+def zoneCopy(zone_name, server):        # current copy of zone, None if transfer failed
+    copy = ZoneCopy(zone_name, server)
+    copy.load()
+    serial = copy.serial()
+    try:
+        copy.transfer()
+    except xfr_errors:
+        (exc_type, exc_value, exc_traceback) = sys.exc_info()
+        l.logWarn('Zone transfer of %s from %s failed, because %s; querying instead' % (zone_name, server, exc_value))
+        return None
+    try:
+        if serial == copy.serial():
+            return copy                 # unchanged
+        if not os.path.isdir(conf.ZONE_COPY_DIR):
+            os.mkdir(conf.ZONE_COPY_DIR, 0o750)
+        copy.save()
+    except (IOError, dns.exception.DNSException):
+        (exc_type, exc_value, exc_traceback) = sys.exc_info()
+        l.logWarn("Can't save copy of zone %s, because %s" % (zone_name, exc_value))
+    if logger.Logger.debug:             # full walk of zone
+        l.logDebug('Keys signing in %s: %s' % (zone_name, repr(copy.signers())))
+    return copy
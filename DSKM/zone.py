@@ -33,6 +33,7 @@ from Crypto import Random as rand
 import binascii
 
 import copy
+import hashlib
 
 ##import dns.resolver, dns.message, dns.query, dns.rdatatype, dns.rdtypes.ANY.DNSKEY, dns.rcode
 import dns.resolver, dns.message, dns.query, dns.rdatatype, dns.rcode
@@ -49,8 +50,14 @@ import socket
 
 # -----------------------------------------
 
+import DSKM.chain as chain
+import DSKM.outbox as outbox
 import DSKM.registrar as reg
 import DSKM.key as dnsKey
+import DSKM.probe as probe
+import DSKM.statestore as statestore
+import DSKM.transport as transport
+import DSKM.xfr as xfr
 
 import DSKM.logger as logger
 l = logger.Logger()
@@ -65,6 +72,8 @@ import DSKM.misc as misc
 import DSKM.config as conf
 #------------------------------------------------------------------------------
 
+SOA_SEARCH_SIZE = 16384             # serial number must be within that many bytes at top of zone file
+
 ext_recursive_resolver = dns.resolver.Resolver()
 ext_recursive_resolver.lifetime = conf.NS_TIMEOUT
 ext_recursive_resolver.nameservers = conf.external_recursives
@@ -126,45 +135,52 @@ class managedZone(object):
         
         self.master_DNSKEY_cache = []
         
+        self.probes = None                  # apex snapshot of this run (ProbeResults), see snapshot()
+        self.zone_copy = None               # xfr.ZoneCopy of this run (ZONE_TRANSFER)
+        self.zone_copy_tried = False
+        
         #-----------------------------
         # functions in managedZone.__init__
         #-----------------------------
-        def readConfig(cfg, domain_name, file_name):
-            self.mypath.cd()                    # change to zone directory
-            l.logDebug('Opening ' + domain_name + '/' + file_name)
+        def readConfig(cfg, domain_name, kind):
+            store = statestore.store()
+            description = store.describe(domain_name, kind)
+            l.logDebug('Opening ' + description)
             timingAdded = False
             try:
-                with open(file_name) as fd:     # open config/status file for read
-                    try:
-                        k = ''
-                        tstcfg = json.load(fd)
-                        for k in iter(cfg):   # do simple syntax check
-                            if k == 'Timing' and k not in tstcfg:
-                                timingAdded = True
-                                tstcfg['Timing'] = copy.deepcopy(cfg['Timing'])
-                            vt = tstcfg[k]    # raises if key missed
-                            vo = cfg[k]
-                            if isinstance(vo, dict):
-                                for k in iter(vo):
-                                    vo1 = vo[k] # raises if key missed
-                                    if isinstance(vo1, dict):
-                                        for k in iter(vo1):
-                                            vo2 = vo1[k] # raises if key missed
-                    except:                     # missing key: syntax error in cfg file
-                        l.logError('Garbage found/Missing option ' + k + ' in configuration/status file "' + domain_name + '/' + file_name + '"')
-                        e = misc.misc.AbortedZone("")
-                        raise e
-                    cfg = tstcfg
+                k = ''
+                tstcfg = store.load(domain_name, kind)  # config/status from file or data base
+                try:
+                    for k in iter(cfg):   # do simple syntax check
+                        if k == 'Timing' and k not in tstcfg:
+                            timingAdded = True
+                            tstcfg['Timing'] = copy.deepcopy(cfg['Timing'])
+                        vt = tstcfg[k]    # raises if key missed
+                        vo = cfg[k]
+                        if isinstance(vo, dict):
+                            for k in iter(vo):
+                                vo1 = vo[k] # raises if key missed
+                                if isinstance(vo1, dict):
+                                    for k in iter(vo1):
+                                        vo2 = vo1[k] # raises if key missed
+                except:                     # missing key: syntax error in cfg file
+                    l.logError('Garbage found/Missing option ' + k + ' in configuration/status file "' + description + '"')
+                    e = misc.AbortedZone("")
+                    raise e
+                cfg = tstcfg
+            except ValueError:                  # no valid JSON
+                l.logError('Garbage found in configuration/status file "' + description + '"')
+                e = misc.AbortedZone("")
+                raise e
             except IOError:                     # file not found
                 try:
-                    with open(file_name, 'w') as fd:
-                        json.dump(cfg, fd, indent=8)
+                    store.save(domain_name, kind, cfg)
                 except IOError:                 # no write permission
                     (exc_type, exc_value, exc_traceback) = sys.exc_info()
                     l.logError("Can't create file, because %s" % (exc_value))
-                    e = misc.misc.AbortedZone("")
+                    e = misc.AbortedZone("")
                     raise e
-            l.logDebug('Config/status ' + domain_name + '/' + file_name + ' contains:\n' + str(cfg))
+            l.logDebug('Config/status ' + description + ' contains:\n' + str(cfg))
             return (cfg, timingAdded)
                 
         def deleteKeyFiles():
@@ -197,13 +213,10 @@ class managedZone(object):
         #-----------------------------
         # end of functions in managedZone.__init__
         #-----------------------------
-        (x,y,self.parent) = self.name.partition('.')
-        pd = path(conf.ROOT_PATH + '/' + self.parent)
-        l.logDebug('Parent directory would be %s' % (pd,))
+        (self.parent, self.parent_dir) = localParent(self.name)
         zl = ''
-        if pd.exists:
+        if self.parent_dir:
             zl = ' <local>'
-            self.parent_dir = pd
         if l.verbose:
             print('')
         l.logVerbose('Working at %s on %s (%s %s)' % 
@@ -211,7 +224,7 @@ class managedZone(object):
 
         try:
             cfg_file_name = 'dnssec-conf-' + self.name
-            (self.pcfg, timingAdded) = readConfig(self.pcfg, name, cfg_file_name)
+            (self.pcfg, timingAdded) = readConfig(self.pcfg, name, 'config')
             if self.pcfg['Timing']['ksk']['ai'] <= self.pcfg['Timing']['ksk']['pa'] + \
                 self.pcfg['Timing']['ksk']['i1a2'] + self.pcfg['Timing']['ksk']['id']:
                 l.logError('Configuration error in %s: Timimg:ksk:ai must be greater than pa + i1a2 + id' % (cfg_file_name))
@@ -225,13 +238,12 @@ class managedZone(object):
             if timingAdded:
                 self.saveCfgOrState('config')
 
-            stat_file_name = 'dnssec-stat-' + self.name
-            (self.pstat, timingAdded) = readConfig(self.pstat, name, stat_file_name)
+            (self.pstat, timingAdded) = readConfig(self.pstat, name, 'state')
             if self.pcfg['Method'] not in ('unsigned', 'NSEC', 'NSEC3'):
                 l.logError(' Wrong Method "%s" in zone config of %s' % (self.pcfg['Method'], self.name))
                 e = misc.AbortedZone("")
                 raise e
-            if self.pcfg['Registrar'] not in ('Local', 'by hand', 'Joker', 'Ripe'):
+            if not reg.known(self.pcfg['Registrar']):
                 l.logError(' Wrong Registrar "%s" in zone config of %s' % (self.pcfg['Registrar'], self.name))
                 e = misc.AbortedZone("")
                 raise e
@@ -310,7 +322,7 @@ class managedZone(object):
         
         zone_loaded = True
         try:
-            if misc.doQuery(self.name, 'SOA') == None:
+            if self.masterSOA() == None:
                 zone_loaded = False
         except Exception:
             zone_loaded = False
@@ -319,6 +331,8 @@ class managedZone(object):
             l.logError('Zone not loaded? Skipping zone.')
             return
         try:
+            self.checkPendingSubmission()
+            self.snapshot()
             self.ksks.sort(key=dnsKey.SigningKey.activeTime)
             second = False
             for k in self.ksks:
@@ -337,29 +351,9 @@ class managedZone(object):
                 l.logVerbose('About to call registrar. List of keys to request DS-RR: %s ' % (repr(self.pstat['submitted_to_parent'])))
                 
                 args = self.argsForDSsubmission()
-                if len(args) == 0: # removed all DS from remote parents
-                    res = reg.regRemoveAllDS(self)
-                    if not res:
-                        l.logError("Failed to delete all DS-RR of %s at registrar %s" % (self.name, self.pcfg['Registrar']))
-                        e = misc.AbortedZone()
-                        raise e
-                    l.logVerbose("DS-RRs of %s at registrar %s deleted" % (
-                            self.name, self.pcfg['Registrar']))
-                    for c in res.keys():
-                        if c in ('Proc-ID', 'Tracking-Id'):
-                            print(c + ':   ' + res[c])
-                else:
-                    res = reg.regAddDS(self, args)
-                    if not res:
-                        l.logError("Failed to update DS-RRs for keys %s of %s at registrar %s" % (
-                            repr(self.pstat['submitted_to_parent']), self.name, self.pcfg['Registrar']))
-                        e = misc.AbortedZone('')
-                        raise e
-                    l.logVerbose("DS-RRs for keys %s of %s at registrar %s updated" % (
-                            repr(self.pstat['submitted_to_parent']), self.name, self.pcfg['Registrar']))
-                    for c in res.keys():
-                        if c in ('Your mail was received at ......', 'TID'):
-                            print(c + ':   ' + res[c])
+                fingerprint = self.dsFingerprint(args)
+                if not self.dsUnchanged(args, fingerprint):
+                    self.queueSubmission(args, fingerprint)    # sent by outbox.drain() after all zones
     
         except misc.AbortedZone:
             l.logError('Aborting zone ' + self.name)
@@ -438,6 +432,7 @@ class managedZone(object):
                     (exc_type, exc_value, exc_traceback) = sys.exc_info()
                     l.logError("Can't delete keyfile, because %s" % (exc_value))
         if key_tag == 0:
+            outbox.forget(self.name)    # queued DS set would be fed back into fresh state
             self.pcfg = copy.deepcopy(self.icfg)               # initialize
             self.pstat = copy.deepcopy(self.istat)
             self.saveCfgOrState('config')
@@ -459,22 +454,139 @@ class managedZone(object):
         l.logDebug('submitted_to_parent contains now: %s ' % (repr(self.pstat['submitted_to_parent'])))
         return True   
     
+    def zoneCopy(self):                     # local copy of zone, transferred once per run; None if not used
+        if conf.ZONE_TRANSFER and not self.zone_copy_tried:
+            self.zone_copy_tried = True
+            self.zone_copy = xfr.zoneCopy(self.name, dnsKey.inclusionServer(self))
+        return self.zone_copy
+    
+    def snapshot(self):                     # SOA, DNSKEY and DS of apex at all servers of state checks, probed once per run
+        if self.probes is None:
+            self.probes = probe.probeZone(self)
+        return self.probes
+    
+    def masterSOA(self):                    # answer of master for SOA, from snapshot; None if not served
+        try:
+            return self.snapshot().firstAnswer(conf.master, self.name, 'SOA')
+        except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+            return None
+        except dns.exception.Timeout:       # probe of master failed: ask all masters
+            return misc.doQuery(self.name, 'SOA')
+    
+    def submissionPending(self):            # DS submission to registrar not yet completed?
+        return 'pending_submission' in self.pstat   # optional key of state
+    
+    def dsFingerprint(self, args):          # canonical hash of DS set, to be submitted to registrar
+        lines = sorted('%d %d %d %s\n' % dsTuple(arg) for arg in args)
+        return hashlib.sha256((self.pcfg['Registrar'] + '\n' + ''.join(lines)).encode('ASCII')).hexdigest()
+    
+    def dsUnchanged(self, args, fingerprint):   # DS set already submitted or served by parent?
+        if fingerprint == self.pstat.get('submitted_fingerprint'):  # optional key of state
+            l.logVerbose('DS-RRs of %s unchanged since last submission to registrar %s; not submitting again' %
+                            (self.name, self.pcfg['Registrar']))
+            return True
+        if reg.currentDS(self.pcfg['Registrar'], self.name) == set(dsTuple(arg) for arg in args):
+            l.logVerbose('Registrar %s has DS-RRs of %s already; not submitting again' %
+                            (self.pcfg['Registrar'], self.name))
+            self.pstat['submitted_fingerprint'] = fingerprint
+            return True
+        if conf.DS_CHECK_PARENT and self.parentHasDS(args):
+            l.logVerbose('Parent of %s serves DS-RRs already; not submitting to registrar %s' %
+                            (self.name, self.pcfg['Registrar']))
+            self.pstat['submitted_fingerprint'] = fingerprint
+            return True
+        return False
+    
+    def parentHasDS(self, args):            # DS RRset at auth NS of parent equals DS set of args?
+        r = misc.authResolver(self.parent)
+        try:
+            if self.probes and any((server, self.name, 'DS') in self.probes for server in r.nameservers):
+                res = self.probes.firstAnswer(r.nameservers, self.name, 'DS')
+            else:
+                res = transport.resolve(r, self.name, 'DS')
+            served = set((ds.key_tag, ds.algorithm, ds.digest_type, binascii.hexlify(ds.digest).decode('ASCII').upper())
+                            for ds in res.rrset.items)
+        except dns.resolver.NoAnswer:
+            served = set()
+        except Exception:                   # don't know: submit
+            (exc_type, exc_value, exc_traceback) = sys.exc_info()
+            l.logDebug('parentHasDS(): DS query of %s failed, because %s' % (self.name, exc_value))
+            return False
+        return served == set(dsTuple(arg) for arg in args)
+    
+    def queueSubmission(self, args, fingerprint):   # DS set to registrar outbox; pending until sent and completed
+        if not outbox.enqueue(self, args, fingerprint):
+            e = misc.AbortedZone('')
+            raise e
+        self.pstat['pending_submission'] = {'Registrar': self.pcfg['Registrar'],
+                                            'Tracking-Id': None,
+                                            'Queued': int(time.time()),
+                                            'Keys': list(self.pstat['submitted_to_parent'])}
+    
+    def checkPendingSubmission(self):       # look up completion of DS submission of previous run
+        if not self.submissionPending():
+            return
+        pending = self.pstat['pending_submission']
+        status = reg.submissionStatus(self, pending)
+        if status == 'queued':
+            if outbox.queued(self.name):
+                l.logVerbose('DS submission of %s still queued for registrar %s' % (self.name, pending['Registrar']))
+                return
+            status = 'failed'               # lost from outbox
+        if status == 'pending':
+            l.logVerbose('DS submission of %s (Tracking-Id %s) still pending at registrar %s' %
+                            (self.name, pending['Tracking-Id'], pending['Registrar']))
+            return
+        del self.pstat['pending_submission']
+        if status != 'done':                # allow submission of same DS set again
+            self.pstat.pop('submitted_fingerprint', None)
+        if status == 'done':
+            l.logVerbose('DS submission of %s (Tracking-Id %s) completed at registrar %s' %
+                            (self.name, pending['Tracking-Id'], pending['Registrar']))
+        else:
+            l.logError('DS submission of %s (Tracking-Id %s) failed at registrar %s; submitting again' %
+                            (self.name, pending['Tracking-Id'], pending['Registrar']))
+            self.remoteDSchanged = True
+    
+    def nextEvent(self):                    # time of next possible state transition or None, if it must be polled
+        due = []
+        for (keys, stt, key) in ((self.ksks, dnsKey.KSTT, 'ksk'), (self.zsks, dnsKey.ZSTT, 'zsk')):
+            state = self.pstat[key]['State']
+            if state < 0 or state >= len(stt):
+                return None
+            st = stt[state]
+            if st['t'] != 'N' or st['c'] is not dnsKey.SigningKey.test_if_time_reached:
+                return None                 # waiting for propagation: poll
+            keys = [k for k in keys if k.keytag not in self.keys_toBeDeleted]
+            keys.sort(key=dnsKey.SigningKey.activeTime)
+            if '1' in st['ca']:
+                keys = keys[:1]
+            elif '2' in st['ca']:
+                keys = keys[1:2]
+            times = [k.dueTime(st['ca']) for k in keys]
+            times = [t for t in times if t is not None]
+            if len(times) == 0:
+                return None
+            due.append(min(times))
+        return min(due)
+    
+    def parentChanged(self):                # our DS-RR in local parent changed
+        misc.parents_to_update[self.parent] = self.parent_dir + '/' + self.parent + '.zone'
+        l.logDebug('Parent %s of %s to be updated at end of run' % (self.parent, self.name))
+    
     def saveCfgOrState(self, action):       # action is 'config' or 'state'
-        self.mypath.cd()                    # change to zone directory
         if action == 'config':
             cfg = self.pcfg
-            filename = 'dnssec-conf-' + self.name
         elif action == 'state':
             cfg = self.pstat
-            filename = 'dnssec-stat-' + self.name
         else:
             raise AssertionError('?Wrong action "%s" in saveCfgOrState() with zone %s' % (action, self.name))
         
-        l.logDebug('Saving config/state in file %s/%s\nNew %s of %s contains:\n %s ' %
-                    (os.getcwd(), filename, action, self.name, str(cfg)))
+        store = statestore.store()
+        l.logDebug('Saving config/state in %s\nNew %s of %s contains:\n %s ' %
+                    (store.describe(self.name, action), action, self.name, str(cfg)))
         try:
-            with open(filename, 'w') as fd:
-                json.dump(cfg, fd, indent=8)
+            store.save(self.name, action, cfg)
         except:                  # no write permission
         ##except IOError:                 # no write permission
             (exc_type, exc_value, exc_traceback) = sys.exc_info()
@@ -482,68 +594,40 @@ class managedZone(object):
             e = misc.AbortedZone('')
             raise e
     
+    def chainExpected(self):                # DS at registrar published and not yet withdrawn?
+        return 3 <= self.pstat['ksk']['State'] <= dnsKey.SigningKey.ksk_state_max and self.pcfg['Registrar'] != 'Local'
+    
     def validate(self):                     # validate zone
-        global ext_recursive_resolver
-         
-        if self.pstat['ksk']['State'] < 3 or self.pstat['ksk']['State'] > dnsKey.SigningKey.ksk_state_max or self.pcfg['Registrar'] == 'Local':
+        if not self.chainExpected():
             return True
         
-        nsAliveTest(self.name)
+        nsAliveTest(self.name, self.probes)
+        return self.validateChain()
+    
+    def validateChain(self):                # validate chain of trust from parent locally
+        if not self.chainExpected():
+            return True
         
         l.logVerbose('Validating %s...' % (self.name))
-        r = ext_recursive_resolver
         try:
-            qname = dns.name.from_text(self.name)
-            request = dns.message.make_query(qname, rdtype=dns.rdatatype.SOA, rdclass=dns.rdataclass.INTERNET)
-            request.use_edns(r.edns, r.ednsflags, r.payload)
-            request.want_dnssec(True)
-            response = None
-            nameservers = r.nameservers[:]
-            for nameserver in nameservers[:]:
-                try:
-                    l.logDebug('Querying %s via UDP' % (nameserver, ))
-                    response = dns.query.udp(request, nameserver, conf.NS_TIMEOUT)
-                    if response.flags & dns.flags.TC:
-                        # Response truncated; retry with TCP.
-                        l.logDebug('Querying %s via TCP' % (nameserver, ))
-                        response = dns.query.tcp(request, nameserver, conf.NS_TIMEOUT)
-                except (socket.error, dns.exception.Timeout, dns.query.UnexpectedSource, dns.exception.FormError, EOFError):
-                    l.logDebug('Queryerror')
-                    response = None
-                    continue
-                rcode = response.rcode()
-                if rcode == dns.rcode.NOERROR or \
-                       rcode == dns.rcode.NXDOMAIN:
-                    l.logDebug('Query gave NOERROR or NXDOMAIN')
-                    break
-                response = None
-            ## end of for nameserver in r.nameservers
-
-            if response is None:
-                e = dns.resolver.NoAnswer
-                raise e
-            ans = dns.resolver.Answer(qname, dns.rdatatype.SOA, dns.rdataclass.INTERNET, response, False)
-
-            l.logDebug('Flags are %x; %x should be set' % (ans.response.flags, dns.flags.AD))
-            if ans.response.flags & dns.flags.AD:
-                l.logVerbose('OK')
-                return True
-        except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
-            pass
-        except (dns.exception.Timeout):
-            (exc_type, exc_value, exc_traceback) = sys.exc_info()
-            errmsg = "%s: DS query timed out. %s, %s" % \
-                (self.name, exc_type, exc_value)
-            l.logError('Validation of %s FAILED' % (self.name))
-            l.logError(errmsg)
-        l.logError('Validation of %s FAILED' % (self.name))
+            failed = chain.validateZone(self)
+        except misc.AbortedZone as a:       # NS of parent not found
+            failed = 'NS lookup (%s)' % (a.data,)
+        except dns.exception.DNSException as e: # NS, A or AAAA lookup timed out
+            failed = 'NS lookup (%s)' % (repr(e),)
+        if failed is None:
+            l.logVerbose('OK')
+            return True
+        l.logError('Validation of %s FAILED at %s' % (self.name, failed))
         return False
     
     # compare SOA serial of master with zone file (bind 9.11 may be out of sync) 
     def verifySerial(self):
         try:
-            answer = misc.doQuery(self.name, 'SOA')
+            answer = self.masterSOA()
         except Exception:
+            answer = None
+        if answer is None:                  # zone not served by master (yet)
             l.logError('Failed to compare serial with zone file')
             return False
         result = [ str(rdata) for rdata in answer ][0].split()[2]
@@ -598,21 +682,60 @@ class managedZone(object):
         self.saveCfgOrState('state')
         if self.remoteDSchanged and len(self.pstat['submitted_to_parent']) > 0:
             l.logVerbose('About to call registrar. List of keys to request DS-RR: %s ' % (repr(self.pstat['submitted_to_parent'])))
-            res = reg.regRemoveAllDS(self)
-            if not res:
-                em = str("Failed to delete all DS-RR of %s at registrar %s" % (self.name, self.pcfg['Registrar']))
-                l.logError(em)
-                e = misc.AbortedZone(em)
-                raise e
-            l.logVerbose("DS-RRs of %s at registrar %s deleted" % (
-                    self.name, self.pcfg['Registrar']))
-            for c in res.keys():
-                if c in ('Proc-ID', 'Tracking-Id'):
-                    print(c + ':   ' + res[c])
+            self.queueSubmission([], self.dsFingerprint([]))
+            self.saveCfgOrState('state')
         return 0         
 
 
-def nsAliveTest(theZone):         # query all authoritative NS for SOA of zone
+def dsTuple(arg):                   # canonical DS (key tag, algorithm, digest type, digest) of registrar arg
+    return (int(arg['tag']), int(arg['alg']), int(arg['digest_type']), str(arg['digest']).replace(' ', '').upper())
+
+def localParent(zone_name):         # return name and directory of parent; directory is None if parent not managed by us
+    (x,y,parent) = zone_name.partition('.')
+    pd = path(conf.ROOT_PATH + '/' + parent)
+    l.logDebug('Parent directory would be %s' % (pd,))
+    if pd.exists:
+        return (parent, pd)
+    return (parent, None)
+
+def updateSOA(filename):            # increment serial of SOA in zone file in place
+    timestamp = datetime.now()
+    current_date = timestamp.strftime('%Y%m%d')
+    try:
+        with open(filename, 'rb+') as fd:
+            zf = fd.read(SOA_SEARCH_SIZE)   # SOA is at top of zone file
+            sea = re.search(rb'(\d{10})(\s*;\s*)(Serial number)', zf)
+            if not sea:
+                l.logError("Can't find serial number in zone file " + filename)
+                return False
+            serial = max(int(current_date) * 100 + 1, int(sea.group(1)) + 1)
+            fd.seek(sea.start(1))
+            fd.write(str('%010d' % (serial,)).encode('ASCII'))
+    except IOError:                 # file not found or not writable
+        (exc_type, exc_value, exc_traceback) = sys.exc_info()
+        l.logError("Can't update serial in zone file %s, because %s" % (filename, exc_value))
+        return False
+    l.logDebug('Serial of %s incremented to %d' % (filename, serial))
+    return True
+
+def reloadZone(zone_name):
+    res = ''
+    try:
+        res = str(shell(str('rndc reload %s' % (zone_name)), stderr='PIPE').stderr)
+        l.logDebug('Rndc reload %s returned: %s' % (zone_name, res))
+    except script.CommandFailed:
+        l.logError('Error while reloading zone %s after updating SOA ( %s )' % (zone_name, res))
+        return False
+    return True
+
+def updateParents():                # increment serial once and reload each changed local parent
+    for parent in sorted(misc.parents_to_update):
+        l.logVerbose('Updating SOA of %s and reloading it' % (parent,))
+        if updateSOA(misc.parents_to_update[parent]):
+            reloadZone(parent)
+    misc.parents_to_update.clear()
+
+def nsAliveTest(theZone, probes=None): # query all authoritative NS for SOA of zone
     global ext_recursive_resolver
         
     r = ext_recursive_resolver
@@ -625,8 +748,11 @@ def nsAliveTest(theZone):         # query all authoritative NS for SOA of zone
     nameservers = misc.authNS(theZone)
     for nameserver in nameservers[:]:
         try:
-            l.logDebug('Querying {} for SOA of {} via TCP'.format(nameserver, theZone))
-            response = dns.query.tcp(request, nameserver, 10)
+            if probes and (nameserver, theZone, dns.rdatatype.SOA) in probes:
+                response = probes.response(nameserver, theZone, dns.rdatatype.SOA)
+            else:
+                l.logDebug('Querying {} for SOA of {}'.format(nameserver, theZone))
+                response = transport.query(request, nameserver)   # timeout from scoreboard
             rcode = response.rcode()
             if rcode == 0: continue
         except (socket.error, dns.exception.Timeout, dns.query.UnexpectedSource,
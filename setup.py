@@ -42,7 +42,8 @@ setup(
         'Natural Language :: English',
     ],
     install_requires=[
-        'dnspython>=1.16.0',
+        'cryptography>=2.6',
+        'dnspython>=2.1.0',
         'ecdsa>=0.13',  
         'pycryptodome>=3.7.3',
         'script>=1.7.2',